@@ -0,0 +1 @@
+../../1.00deg-15km/data/hrrr_grid.py
\ No newline at end of file
@@ -0,0 +1,427 @@
+"""
+Run the ufs2arco data recipes (hrrr.yaml, gfs.yaml) on a single node with a process pool, instead of with MPI.
+
+This does what ufs2arco.MultiDriver.run does, with the same sources, transforms, and anemoi target,
+but the initial conditions (t0) are spread across a pool of worker processes:
+
+* the main process creates the (preallocated) anemoi zarr container, exactly as ufs2arco does,
+  unless it already exists, in which case the run picks up where the last one left off
+* each worker reads, transforms, and writes one sample at a time, as a region write into the container
+* each finished sample is recorded in "{store}.completed.txt", by its t0 (the first source's),
+  so rerunning skips everything that's already been written
+* once everything has been attempted, the main process reports missing data and computes the statistics,
+  again exactly as ufs2arco does
+
+The horizontal_regrid transform normally has xesmf reread the weights file for every sample.
+Here the main process reads the weights once, and puts them in shared memory as a sparse (CSR) matrix,
+which every worker applies directly. Note that the weights file has to exist,
+which it will after the container is created, since that regrids the first sample.
+
+For rebuilding data without access to AWS, --archive points to a local directory laid out like the bucket,
+e.g. for HRRR
+
+    {archive}/hrrr.20150201/conus/hrrr.t06z.wrfprsf00.grib2
+
+which is what "aws s3 sync --no-sign-request s3://noaa-hrrr-bdp-pds/hrrr.20150201 {archive}/hrrr.20150201" gives.
+The files are then read in place, rather than copied to the cache.
+
+The mover section of the recipe is ignored.
+
+Everything here goes through ufs2arco's public API (Driver.setup, DataMover.sample_indices and find_my_region,
+Target.apply_transforms_to_sample), except --archive, which replaces each source's _build_path,
+the hook that the ufs2arco grib sources use to build their file paths.
+That was written against ufs2arco==0.19.0, as pinned in ../production/environment.yaml,
+and check_ufs2arco_api stops early with a clear error if another version doesn't have it.
+
+Usage:
+    python local_ingest.py hrrr.yaml -n 16
+    python local_ingest.py hrrr.testing.yaml -n 4 --archive /data/noaa-hrrr-bdp-pds --overwrite
+"""
+import os
+import time
+import shutil
+import logging
+import argparse
+import importlib.metadata
+from urllib.parse import urlparse
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import yaml
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy.sparse import csr_matrix
+
+from ufs2arco.driver import Driver
+from ufs2arco.multidriver import MultiDriver
+from ufs2arco.transforms import Transformer
+
+logger = logging.getLogger("ufs2arco")
+
+# the ufs2arco version that --archive was written against
+ufs2arco_version = "0.19.0"
+
+# set in each worker by init_worker
+_worker = {}
+
+
+def load_driver(config_path):
+    """The ufs2arco driver for this recipe, always without MPI"""
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+    driver = MultiDriver(config_path) if "multisource" in config else Driver(config_path)
+    driver.config["mover"] = {"name": "datamover", "batch_size": 1}
+    return driver
+
+
+def get_sources(driver):
+    return driver.sources if hasattr(driver, "sources") else [driver.source]
+
+
+def get_targets(driver):
+    return driver.targets if hasattr(driver, "targets") else [driver.target]
+
+
+def get_movers(driver):
+    return driver.movers if hasattr(driver, "movers") else [driver.mover]
+
+
+def get_transform_options(config):
+    """Transforms for each source, combined the same way as MultiDriver._init_transformer"""
+    common = config.get("transforms", {})
+    if "multisource" not in config:
+        return [common]
+    return [{**local.get("transforms", {}), **common} for local in config["multisource"]]
+
+
+def get_sample_key(dims):
+    return pd.Timestamp(dims.get("t0", dims.get("time", None))).isoformat()
+
+
+def check_ufs2arco_api(sources):
+    """Make sure these sources build their file paths with _build_path, which use_local_archive replaces"""
+    installed = importlib.metadata.version("ufs2arco")
+    if installed != ufs2arco_version:
+        logger.warning(f"local_ingest --archive was written against ufs2arco=={ufs2arco_version}, but {installed} is installed")
+
+    missing = [type(source).__name__ for source in sources if not callable(getattr(source, "_build_path", None))]
+    if missing:
+        raise RuntimeError(
+            f"check_ufs2arco_api: {missing} from ufs2arco=={installed} have no _build_path, "
+            f"so --archive can't redirect them, it needs ufs2arco=={ufs2arco_version}"
+        )
+
+
+def use_local_archive(sources, archive):
+    """Read files from archive, laid out like the bucket or server, instead of downloading them"""
+    check_ufs2arco_api(sources)
+    for source in sources:
+        build_path = source._build_path
+
+        def local_path(*args, build_path=build_path, **kwargs):
+            url = build_path(*args, **kwargs).split("::")[-1]
+            return os.path.join(archive, urlparse(url).path.lstrip("/"))
+
+        source._build_path = local_path
+
+
+def read_ledger(store_path):
+    """t0s that have already been written, as ISO strings"""
+    fname = f"{store_path}.completed.txt"
+    if not os.path.isfile(fname):
+        return set()
+    with open(fname, "r") as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def append_ledger(store_path, key):
+    with open(f"{store_path}.completed.txt", "a") as f:
+        f.write(f"{key}\n")
+
+
+def to_shared_memory(arrays):
+    """Copy arrays into shared memory
+
+    Returns:
+        handles (list of SharedMemory): keep these around, then close and unlink them when done
+        spec (dict): key -> (name, shape, dtype), to pass to from_shared_memory
+    """
+    handles, spec = [], {}
+    for key, array in arrays.items():
+        shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+        handles.append(shm)
+        spec[key] = (shm.name, array.shape, array.dtype.str)
+    return handles, spec
+
+
+def from_shared_memory(spec):
+    """Views of arrays put in shared memory by to_shared_memory, without copying"""
+    handles, arrays = [], {}
+    for key, (name, shape, dtype) in spec.items():
+        shm = SharedMemory(name=name)
+        handles.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return handles, arrays
+
+
+def get_target_grid(options):
+    kw = options.get("open_target_kwargs", None) or {}
+    return xr.open_dataset(os.path.expandvars(options["target_grid_path"]), **kw)
+
+
+def get_weights_path(options):
+    return os.path.expandvars(options["regridder_kwargs"]["filename"])
+
+
+def share_weights(options):
+    """Read the xesmf weights file for a horizontal_regrid transform, and put it in shared memory as CSR arrays"""
+    fname = get_weights_path(options)
+    if not os.path.isfile(fname):
+        raise FileNotFoundError(
+            f"local_ingest: could not find regrid weights {fname}, "
+            f"rerun with --overwrite to create the container, which also computes the weights"
+        )
+    with xr.open_dataset(fname) as wds:
+        # ESMF format, 1 based
+        S, row, col = wds["S"].values, wds["row"].values - 1, wds["col"].values - 1
+
+    with get_target_grid(options) as ds_out:
+        n_out = int(ds_out["lat"].size if ds_out["lat"].ndim == 2 else ds_out["lat"].size * ds_out["lon"].size)
+
+    weights = csr_matrix((S, (row, col)), shape=(n_out, int(col.max()) + 1))
+    return to_shared_memory({"data": weights.data, "indices": weights.indices, "indptr": weights.indptr})
+
+
+class SharedRegridder:
+    """Stand in for ufs2arco's horizontal_regrid transform, applying weights from shared memory
+
+    This gives the same result as the xesmf regridder does in ufs2arco.transforms.horizontal_regrid,
+    i.e. weights @ data flattened over the horizontal dims, with the target grid's lat/lon,
+    and anything without the horizontal dims dropped.
+
+    Args:
+        options (dict): the horizontal_regrid transform options from the recipe
+        spec (dict): from share_weights
+    """
+
+    def __init__(self, options, spec):
+        self.handles, self.arrays = from_shared_memory(spec)
+        self.n_out = len(self.arrays["indptr"]) - 1
+
+        ds_out = get_target_grid(options)
+        if ds_out["lat"].ndim == 2:
+            self.out_dims = ds_out["lat"].dims
+            self.out_coords = {key: (ds_out[key].dims, ds_out[key].values) for key in ["lat", "lon"]}
+        else:
+            self.out_dims = ("lat", "lon")
+            self.out_coords = {key: ds_out[key].values for key in ["lat", "lon"]}
+        self.out_shape = tuple(ds_out.sizes[d] for d in self.out_dims)
+        ds_out.close()
+
+        self._weights = {}
+
+    def weights(self, n_in):
+        """The weights as a sparse matrix, sized for this input grid, still pointing at shared memory"""
+        if n_in not in self._weights:
+            self._weights[n_in] = csr_matrix(
+                (self.arrays["data"], self.arrays["indices"], self.arrays["indptr"]),
+                shape=(self.n_out, n_in),
+                copy=False,
+            )
+        return self._weights[n_in]
+
+    def __call__(self, xds):
+        rename = {"longitude": "lon", "latitude": "lat"}
+        xds = xds.rename({key: val for key, val in rename.items() if key in xds})
+        in_dims = xds["lat"].dims if xds["lat"].ndim == 2 else ("lat", "lon")
+        n_in = int(np.prod([xds.sizes[d] for d in in_dims]))
+        weights = self.weights(n_in)
+
+        result = xr.Dataset(attrs=xds.attrs.copy())
+        for name, xda in xds.data_vars.items():
+            if not all(d in xda.dims for d in in_dims):
+                continue
+            xda = xda.transpose(..., *in_dims)
+            extra_dims = xda.dims[:-len(in_dims)]
+            extra_shape = xda.shape[:-len(in_dims)]
+            data = xda.values.reshape(-1, n_in)
+            data = (weights @ data.T).T.reshape(extra_shape + self.out_shape).astype(xda.dtype, copy=False)
+            result[name] = xr.DataArray(
+                data,
+                dims=extra_dims + self.out_dims,
+                coords={key: xds[key] for key in extra_dims if key in xds.coords},
+                attrs=xda.attrs.copy(),
+            )
+
+        # non horizontal coordinates, e.g. t0, fhr, lead_time, valid_time
+        for key, coord in xds.coords.items():
+            if key not in result.coords and not any(d in coord.dims for d in in_dims + ("lat", "lon")):
+                result = result.assign_coords({key: coord})
+
+        result = result.assign_coords(self.out_coords)
+        return result.rename({"lon": "longitude", "lat": "latitude"})
+
+
+def get_transforms(options, weights_specs):
+    """A function for each source that does the same as ufs2arco's Transformer, with the regridding from SharedRegridder"""
+    before = {key: val for key, val in options.items() if key not in ("horizontal_regrid", "mappings")}
+    before = Transformer(options=before) if len(before) > 0 else None
+    regrid = None
+    if "horizontal_regrid" in options:
+        regrid = SharedRegridder(options["horizontal_regrid"], weights_specs[get_weights_path(options["horizontal_regrid"])])
+    after = Transformer(options={"mappings": options["mappings"]}) if "mappings" in options else None
+
+    def transform(xds):
+        for step in [before, regrid, after]:
+            if step is not None:
+                xds = step(xds)
+        return xds
+
+    return transform
+
+
+def init_worker(config_path, archive, weights_specs, log_dir):
+    """Set up the sources, targets, and transforms once per worker"""
+
+    # each worker logs to its own directory, "create" keeps setup from adding a suffix to it
+    driver = load_driver(config_path)
+    driver.config["directories"]["logs"] = f"{log_dir}/worker.{os.getpid()}"
+    driver.setup(runtype="create")
+
+    sources = get_sources(driver)
+    if archive is not None:
+        use_local_archive(sources, archive)
+
+    _worker.update({
+        "sources": sources,
+        "targets": get_targets(driver),
+        "movers": get_movers(driver),
+        "transforms": [get_transforms(options, weights_specs) for options in get_transform_options(driver.config)],
+        "samples": [mover.sample_indices for mover in get_movers(driver)],
+        "store_path": driver.store_path,
+        "cache_dir": None if archive is not None else f"{os.path.expandvars(driver.config['directories']['cache'])}/local-ingest/{os.getpid()}",
+    })
+
+
+def ingest_sample(index):
+    """Read, transform, and write the index-th sample from every source
+
+    Returns:
+        index (int): same as the input
+        missing (list of dict): sample dims of any source that couldn't be read, in which case nothing was written
+    """
+    w = _worker
+    cache_dir = None if w["cache_dir"] is None else f"{w['cache_dir']}/{index}"
+
+    dslist, missing = [], []
+    for source, target, transform, samples in zip(w["sources"], w["targets"], w["transforms"], w["samples"]):
+        dims = samples[index]
+        xds = source.open_sample_dataset(
+            dims=dims,
+            open_static_vars=target.always_open_static_vars,
+            cache_dir=cache_dir,
+        )
+        if len(xds) == 0:
+            missing.append(dims)
+            continue
+        xds = transform(xds)
+        xds = target.apply_transforms_to_sample(xds)
+        dslist.append(xds.reset_coords(drop=True))
+
+    if len(missing) == 0:
+        target = w["targets"][0]
+        xds = dslist[0] if len(dslist) == 1 else target.merge_multisource(dslist)
+        xds.to_zarr(w["store_path"], region=w["movers"][0].find_my_region(xds))
+
+    if cache_dir is not None:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    logger.info(f"Done with sample {index}, missing = {missing}")
+    return index, missing
+
+
+def main(config_path, n_workers=1, archive=None, overwrite=False):
+
+    driver = load_driver(config_path)
+    driver.setup(runtype="local-ingest")
+    sources = get_sources(driver)
+    if archive is not None:
+        use_local_archive(sources, archive)
+
+    store_path = driver.store_path
+    if overwrite or not os.path.isdir(store_path):
+        driver.write_container(overwrite=overwrite)
+        if os.path.isfile(f"{store_path}.completed.txt"):
+            os.remove(f"{store_path}.completed.txt")
+
+    samples = driver.mover.sample_indices
+    completed = read_ledger(store_path)
+    todo = [i for i, dims in enumerate(samples) if get_sample_key(dims) not in completed]
+    print(f"{len(samples) - len(todo)} / {len(samples)} samples already in {store_path}, {len(todo)} to go")
+
+    # one shared copy of each set of regrid weights
+    handles, weights_specs = [], {}
+    for options in get_transform_options(driver.config):
+        if "horizontal_regrid" in options:
+            fname = get_weights_path(options["horizontal_regrid"])
+            if fname not in weights_specs:
+                these_handles, weights_specs[fname] = share_weights(options["horizontal_regrid"])
+                handles += these_handles
+
+    missing, failed = [], []
+    t0 = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=init_worker,
+            initargs=(config_path, archive, weights_specs, driver.topo.log_dir),
+        ) as executor:
+            futures = {executor.submit(ingest_sample, i): i for i in todo}
+            for n_done, future in enumerate(as_completed(futures), start=1):
+                index = futures[future]
+                try:
+                    _, these_missing = future.result()
+                except Exception:
+                    logger.exception(f"local_ingest: sample {index} = {samples[index]} failed")
+                    failed.append(index)
+                    continue
+
+                if len(these_missing) == 0:
+                    append_ledger(store_path, get_sample_key(samples[index]))
+                missing += these_missing
+                if n_done % 100 == 0 or n_done == len(todo):
+                    elapsed = time.perf_counter() - t0
+                    print(f" ... {n_done} / {len(todo)} samples, {elapsed:.0f} s, {elapsed/n_done:.2f} s/sample")
+    finally:
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+
+    if len(failed) > 0:
+        raise RuntimeError(
+            f"local_ingest: {len(failed)} samples failed, see the logs in {driver.topo.log_dir}. "
+            f"Rerun to try them again, they are not in {store_path}.completed.txt"
+        )
+
+    driver.report_missing_data(missing)
+    driver.target.finalize(driver.topo)
+    driver.finalize_attributes()
+    print(f"Done, {len(missing)} missing samples, in {time.perf_counter() - t0:.0f} s")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run a ufs2arco recipe with a local process pool")
+    parser.add_argument("config", help="ufs2arco recipe, e.g. hrrr.yaml")
+    parser.add_argument("-n", "--n-workers", type=int, default=1)
+    parser.add_argument("--archive", default=None, help="local directory laid out like the bucket, instead of downloading")
+    parser.add_argument("--overwrite", action="store_true", help="recreate the container and start over")
+    args = parser.parse_args()
+
+    main(
+        args.config,
+        n_workers=args.n_workers,
+        archive=args.archive,
+        overwrite=args.overwrite,
+    )
@@ -0,0 +1,196 @@
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+pytest.importorskip("ufs2arco")
+
+import local_ingest
+
+
+def source_dataset():
+    lat = np.arange(20., 56., 1.)
+    lon = np.arange(230., 301., 1.)
+    rng = np.random.default_rng(0)
+    return xr.Dataset(
+        {
+            "t2m": (("t0", "latitude", "longitude"), 280 + rng.normal(size=(1, len(lat), len(lon)))),
+            "t": (("t0", "level", "latitude", "longitude"), 250 + rng.normal(size=(1, 2, len(lat), len(lon)))),
+        },
+        coords={"t0": [pd.Timestamp("2015-02-01T06")], "level": [500, 850], "latitude": lat, "longitude": lon},
+    )
+
+
+def regular_target():
+    lat, lon = np.arange(25., 50., 2.), np.arange(240., 290., 2.)
+    return xr.Dataset(coords={
+        "lat": lat,
+        "lon": lon,
+        "lat_b": np.append(lat - 1, lat[-1] + 1),
+        "lon_b": np.append(lon - 1, lon[-1] + 1),
+    })
+
+
+def curvilinear_target():
+    """A small rotated grid, with 2D lat/lon and corners, like hrrr_06km.nc"""
+    def rotate(y, x):
+        return 25 + 0.9*y + 0.1*x, 240 + 1.2*x - 0.1*y
+
+    y, x = np.meshgrid(np.arange(20.), np.arange(30.), indexing="ij")
+    y_b, x_b = np.meshgrid(np.arange(21.) - 0.5, np.arange(31.) - 0.5, indexing="ij")
+    lat, lon = rotate(y, x)
+    lat_b, lon_b = rotate(y_b, x_b)
+    return xr.Dataset(coords={
+        "lat": (("y", "x"), lat),
+        "lon": (("y", "x"), lon),
+        "lat_b": (("y_b", "x_b"), lat_b),
+        "lon_b": (("y_b", "x_b"), lon_b),
+    })
+
+
+@pytest.mark.parametrize("method", ["bilinear", "conservative"])
+@pytest.mark.parametrize("make_target", [regular_target, curvilinear_target])
+def test_shared_regridder_matches_xesmf(tmp_path, method, make_target):
+    pytest.importorskip("xesmf")
+    from ufs2arco.transforms import horizontal_regrid
+
+    target_path = str(tmp_path / "target.nc")
+    make_target().to_netcdf(target_path)
+    options = {
+        "target_grid_path": target_path,
+        "regridder_kwargs": {"method": method, "filename": str(tmp_path / f"{method}_weights.nc")},
+    }
+
+    # the first call computes and writes the weights, which the second reads back, as in ufs2arco
+    xds = source_dataset()
+    horizontal_regrid(xds, **options)
+    expected = horizontal_regrid(xds, **options)
+
+    handles, spec = local_ingest.share_weights(options)
+    try:
+        regridder = local_ingest.SharedRegridder(options, spec)
+        result = regridder(xds)
+        for key in expected.data_vars:
+            np.testing.assert_allclose(result[key].values, expected[key].transpose(*result[key].dims).values, rtol=1e-10)
+        for key in ["latitude", "longitude"]:
+            np.testing.assert_array_equal(result[key].values, expected[key].values)
+        for shm in regridder.handles:
+            shm.close()
+    finally:
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+
+
+def value(t0):
+    return float(t0.day*100 + t0.hour)
+
+
+class FakeSource:
+    """Returns a sample filled with value(t0), and can be told to fail on some t0s"""
+
+    sample_dims = ("t0",)
+    opened = []
+    fail = set()
+
+    def __init__(self, t0):
+        self.t0 = t0
+
+    def open_sample_dataset(self, dims, open_static_vars, cache_dir=None):
+        t0 = dims["t0"]
+        FakeSource.opened.append(t0)
+        if t0 in FakeSource.fail:
+            raise OSError(f"could not read {t0}")
+        return xr.Dataset({"data": (("t0", "cell"), np.full((1, 4), value(t0)))}, coords={"t0": [t0]})
+
+
+class FakeTarget:
+    always_open_static_vars = False
+    renamed_sample_dims = ("t0",)
+
+    def __init__(self, t0):
+        self.t0 = t0
+
+    def apply_transforms_to_sample(self, xds):
+        return xds
+
+    def finalize(self, topo):
+        pass
+
+
+class FakeMover:
+    """With the same find_my_region as ufs2arco.DataMover"""
+
+    def __init__(self, source, target):
+        self.target = target
+        self.sample_indices = [{"t0": t0} for t0 in source.t0]
+
+    def find_my_region(self, xds):
+        region = {k: slice(None, None) for k in xds.dims}
+        for key in self.target.renamed_sample_dims:
+            indices = [list(getattr(self.target, key)).index(v) for v in xds[key].values]
+            region[key] = slice(indices[0], indices[-1] + 1)
+        return region
+
+
+class FakeDriver:
+    """The parts of ufs2arco.Driver that local_ingest uses, writing to a real zarr store"""
+
+    def __init__(self, tmp_path, t0):
+        self.config = {"directories": {"logs": str(tmp_path / "logs"), "cache": str(tmp_path / "cache")}}
+        self.store_path = str(tmp_path / "data.zarr")
+        self.source = FakeSource(t0)
+        self.target = FakeTarget(t0)
+        self.mover = FakeMover(self.source, self.target)
+
+    def setup(self, runtype):
+        self.topo = SimpleNamespace(log_dir=self.config["directories"]["logs"])
+
+    def write_container(self, overwrite):
+        xr.Dataset(
+            {"data": (("t0", "cell"), np.full((len(self.target.t0), 4), np.nan))},
+            coords={"t0": self.target.t0},
+        ).to_zarr(self.store_path, mode="w")
+
+    def report_missing_data(self, missing):
+        pass
+
+    def finalize_attributes(self):
+        pass
+
+
+def test_resume_skips_ledgered_t0s(tmp_path, monkeypatch):
+    t0 = pd.date_range("2015-02-01T06", periods=6, freq="6h")
+    monkeypatch.setattr(local_ingest, "load_driver", lambda config_path: FakeDriver(tmp_path, t0))
+    monkeypatch.setattr(local_ingest, "ProcessPoolExecutor", ThreadPoolExecutor)
+    FakeSource.opened = []
+    FakeSource.fail = {t0[2], t0[4]}
+
+    # the first run writes everything but the failures, and says so
+    with pytest.raises(RuntimeError, match="2 samples failed"):
+        local_ingest.main("fake.yaml", n_workers=2)
+    store_path = str(tmp_path / "data.zarr")
+    assert local_ingest.read_ledger(store_path) == {t.isoformat() for t in t0.delete([2, 4])}
+    assert sorted(FakeSource.opened) == list(t0)
+
+    # the rerun only reads the failures
+    FakeSource.opened = []
+    FakeSource.fail = set()
+    local_ingest.main("fake.yaml", n_workers=2)
+    assert sorted(FakeSource.opened) == [t0[2], t0[4]]
+    assert local_ingest.read_ledger(store_path) == {t.isoformat() for t in t0}
+
+    xds = xr.open_zarr(store_path)
+    np.testing.assert_array_equal(xds["data"].values, np.broadcast_to([[value(t)] for t in t0], (6, 4)))
+
+    # and with nothing left to do, nothing gets read
+    FakeSource.opened = []
+    local_ingest.main("fake.yaml", n_workers=2)
+    assert FakeSource.opened == []
+
+    # overwrite starts over
+    local_ingest.main("fake.yaml", n_workers=2, overwrite=True)
+    assert sorted(FakeSource.opened) == list(t0)
@@ -0,0 +1,176 @@
+"""
+Read any number of unsorted latent grids, sort them as we would with anemoi, and store them as npz files.
+
+This generalizes the sort_and_store_npz.py scripts in global/ and global-2stage/
+(and ../../1.00deg-15km/mesh-gen/global-mesh/):
+
+* grids are sorted in parallel across a process pool
+* each ordering is memoized by a hash of the coordinates, so re-sorting an unchanged grid just reads it back
+* the permutation is stored alongside lon and lat, so that data on the unsorted grid
+  can be put in the same order with apply_order, without sorting again
+
+For each input, e.g. global-2stage/latent.stage1.global_quarter_degree.unsorted.nc, this writes
+
+    global-2stage/latent.stage1.global_quarter_degree.sorted.npz
+
+with "lon", "lat", and "order", where sorted = unsorted.flatten()[order].
+
+Inputs can be netcdf files with 1D lat(lat) and lon(lon) (which get meshgridded, like the original scripts)
+or lat/lon that share their dims, e.g. (y, x) or (cell,) (which get flattened), or npz files with flat lat/lon.
+
+Usage:
+    python sort_latent_grids.py global-2stage/latent.stage*.unsorted.nc -n 2
+    python sort_latent_grids.py global/*.unsorted.nc --sort-coords latlon
+"""
+import os
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import xarray as xr
+
+from anemoi.graphs.generate.utils import get_coordinates_ordering
+
+default_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".sort-cache")
+
+
+def read_unsorted_grid(path):
+    """Flat lon, lat from an unsorted latent grid"""
+    if path.endswith(".npz"):
+        with np.load(path) as npz:
+            lon, lat = npz["lon"], npz["lat"]
+    else:
+        xds = xr.open_dataset(path)
+        lon, lat = xds["lon"].values, xds["lat"].values
+        # 1D lon(lon) and lat(lat) are a regular grid, otherwise they're already paired up
+        is_regular = xds["lon"].dims != xds["lat"].dims
+        xds.close()
+        if is_regular:
+            lon, lat = np.meshgrid(lon, lat)
+    return np.ravel(lon), np.ravel(lat)
+
+
+def get_sorted_path(path):
+    """e.g. latent.stage1.unsorted.nc -> latent.stage1.sorted.npz"""
+    root, _ = os.path.splitext(path)
+    if root.endswith(".unsorted"):
+        root = root[:-len(".unsorted")]
+    return f"{root}.sorted.npz"
+
+
+def coordinates_key(lon, lat, sort_coords):
+    h = hashlib.sha1()
+    h.update(sort_coords.encode())
+    for array in (lon, lat):
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        h.update(str(array.shape).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()[:16]
+
+
+def get_order(lon, lat, sort_coords="lonlat"):
+    """The anemoi ordering, from anemoi.graphs.generate.utils.get_coordinates_ordering
+
+    Args:
+        lon, lat (np.ndarray): flat coordinates
+        sort_coords (str): "lonlat" stacks (lon, lat) in degrees, as the sort_and_store_npz.py scripts did,
+            "latlon" stacks (lat, lon) in radians, as anemoi documents and as some of the notebooks do
+
+    Returns:
+        order (np.ndarray): so that sorted = unsorted[order]
+    """
+    if sort_coords == "lonlat":
+        coords = np.stack([lon, lat], axis=-1)
+    elif sort_coords == "latlon":
+        coords = np.deg2rad(np.stack([lat, lon], axis=-1))
+    else:
+        raise NotImplementedError(f"get_order: sort_coords = {sort_coords} not implemented, use lonlat or latlon")
+    return get_coordinates_ordering(coords)
+
+
+def sort_grid(path, output_path=None, sort_coords="lonlat", cache_dir=default_cache_dir):
+    """Sort one grid and store it, reusing a memoized ordering if the coordinates have been seen before
+
+    Returns:
+        output_path (str): where the sorted npz went
+        n_points (int): number of grid points
+        cached (bool): if the ordering came from the cache
+    """
+    output_path = get_sorted_path(path) if output_path is None else output_path
+    lon, lat = read_unsorted_grid(path)
+
+    key = coordinates_key(lon, lat, sort_coords)
+    cache_file = f"{cache_dir}/order.{key}.npy"
+    cached = os.path.isfile(cache_file)
+    if cached:
+        order = np.load(cache_file)
+    else:
+        order = get_order(lon, lat, sort_coords=sort_coords)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{cache_file}.{os.getpid()}.npy"
+        np.save(tmp, order)
+        os.replace(tmp, cache_file)
+
+    np.savez_compressed(output_path, lon=lon[order], lat=lat[order], order=order)
+    return output_path, len(order), cached
+
+
+def apply_order(data, order):
+    """Put data from the unsorted grid in the sorted order
+
+    Args:
+        data (np.ndarray): with the grid as the last dimension(s), either flattened, or 2D (lat, lon)
+            for grids that were meshgridded from 1D lat/lon
+        order (np.ndarray): from the "order" entry in the sorted npz
+
+    Returns:
+        data (np.ndarray): with a flat, sorted grid as the last dimension
+    """
+    data = np.asarray(data)
+    if data.shape[-1] != len(order):
+        data = data.reshape(data.shape[:-2] + (-1,))
+    return data[..., order]
+
+
+def _sort_grid(args):
+    return sort_grid(*args)
+
+
+def main(paths, n_workers=1, sort_coords="lonlat", cache_dir=default_cache_dir, output_dir=None):
+
+    tasks = []
+    for path in paths:
+        output_path = get_sorted_path(path)
+        if output_dir is not None:
+            output_path = os.path.join(output_dir, os.path.basename(output_path))
+        tasks.append((path, output_path, sort_coords, cache_dir))
+
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_sort_grid, task): task[0] for task in tasks}
+        for future in as_completed(futures):
+            output_path, n_points, cached = future.result()
+            status = "cached" if cached else "sorted"
+            print(f" ... {futures[future]} -> {output_path} ({n_points} points, {status})")
+    print(f"Done with {len(tasks)} grids in {time.perf_counter() - t0:.1f} s")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Sort unsorted latent grids the anemoi way and store them as npz")
+    parser.add_argument("paths", nargs="+", help="unsorted grids, netcdf or npz")
+    parser.add_argument("-n", "--n-workers", type=int, default=1)
+    parser.add_argument("--sort-coords", default="lonlat", choices=["lonlat", "latlon"])
+    parser.add_argument("--cache-dir", default=default_cache_dir)
+    parser.add_argument("-o", "--output-dir", default=None, help="default is next to each input")
+    args = parser.parse_args()
+
+    main(
+        args.paths,
+        n_workers=args.n_workers,
+        sort_coords=args.sort_coords,
+        cache_dir=args.cache_dir,
+        output_dir=args.output_dir,
+    )
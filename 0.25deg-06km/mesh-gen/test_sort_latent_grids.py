@@ -0,0 +1,33 @@
+import numpy as np
+import xarray as xr
+import pytest
+
+pytest.importorskip("anemoi.graphs")
+
+import sort_latent_grids
+
+
+def test_read_regular_grid(tmp_path):
+    """1D lat(lat) and lon(lon) get meshgridded, even with the same number of points"""
+    path = str(tmp_path / "regular.unsorted.nc")
+    lon, lat = np.arange(0., 360., 90.), np.array([-67.5, -22.5, 22.5, 67.5])
+    xr.Dataset(coords={"lon": lon, "lat": lat}).to_netcdf(path)
+
+    flat_lon, flat_lat = sort_latent_grids.read_unsorted_grid(path)
+    expected_lon, expected_lat = np.meshgrid(lon, lat)
+    np.testing.assert_array_equal(flat_lon, expected_lon.ravel())
+    np.testing.assert_array_equal(flat_lat, expected_lat.ravel())
+
+
+@pytest.mark.parametrize("dims", [("cell",), ("y", "x")])
+def test_read_paired_grid(tmp_path, dims):
+    """lat/lon that share their dims are already paired up, and just get flattened"""
+    path = str(tmp_path / "paired.unsorted.nc")
+    rng = np.random.default_rng(0)
+    shape = (16,) if len(dims) == 1 else (4, 4)
+    lon, lat = rng.uniform(0, 360, shape), rng.uniform(-90, 90, shape)
+    xr.Dataset(coords={"lon": (dims, lon), "lat": (dims, lat)}).to_netcdf(path)
+
+    flat_lon, flat_lat = sort_latent_grids.read_unsorted_grid(path)
+    np.testing.assert_array_equal(flat_lon, lon.ravel())
+    np.testing.assert_array_equal(flat_lat, lat.ravel())
@@ -0,0 +1,181 @@
+"""
+Cached observation -> grid matchups, for interpolating forecasts to observation locations.
+
+``eagle-tools obs-metrics`` builds a new xesmf regridder from the forecast grid to the observation
+locations at every valid time, for every model, and so the neighbor search gets repeated over and over.
+Here, the ESMF bilinear weights for each grid and set of observation locations are computed once,
+with exactly the same xesmf.Regridder call as eagle.tools.obs_metrics, and stored in
+
+    {cache_path}/matchup.{grid hash}.{obs hash}.npz
+
+so that reruns, and other models on the same grid and observations, just read them back.
+Since the weights are ESMF's own, the interpolated values are the same as eagle-tools obs-metrics.
+
+This is opt-in, and nothing in eagle.tools is modified: the production submit scripts still run
+``eagle-tools obs-metrics``. Use it directly, e.g. in a notebook or a custom verification loop:
+
+    from cached_obs_metrics import ObsInterpolator
+    interp = ObsInterpolator(cache_path="${SCRATCH}/nested-eagle/obs-matchups")
+    interpolated = interp(fds.sel(time=vtime), matched_obs)
+
+Usage, to check the cache against xesmf for one forecast and a set of obs locations:
+    python cached_obs_metrics.py forecast.nc obs.csv --cache-path ${SCRATCH}/nested-eagle/obs-matchups
+"""
+import os
+import hashlib
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import scipy.sparse
+
+logger = logging.getLogger("eagle.tools")
+
+
+def _hash_arrays(*arrays):
+    h = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        h.update(str(array.shape).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def get_spatial_dims(xds):
+    """The dims that xesmf flattens, in the order it flattens them"""
+    if xds["latitude"].ndim == 2:
+        return xds["latitude"].dims
+    return ("latitude", "longitude")
+
+
+def get_grid_key(xds):
+    """Hash of the forecast grid's lat/lon"""
+    return _hash_arrays(xds["latitude"].values, xds["longitude"].values)
+
+
+def get_regridder(fds_time_slice, lat, lon):
+    """The same xesmf.Regridder as in eagle.tools.obs_metrics._interp_to_obs_locations"""
+    import xesmf
+
+    src = xr.Dataset(
+        coords={"latitude": fds_time_slice["latitude"], "longitude": fds_time_slice["longitude"]},
+    ).rename({"latitude": "lat", "longitude": "lon"})
+    obs_loc = xr.Dataset({
+        "lat": xr.DataArray(lat, dims=("locations",)),
+        "lon": xr.DataArray(lon, dims=("locations",)),
+    })
+    return xesmf.Regridder(
+        src,
+        obs_loc,
+        method="bilinear",
+        locstream_out=True,
+        unmapped_to_nan=True,
+    )
+
+
+def reference_interp(fds_time_slice, matched_obs_df):
+    """Interpolate with a new regridder, as eagle-tools obs-metrics does, to check the cache against"""
+    regridder = get_regridder(fds_time_slice, matched_obs_df["LAT"].values, matched_obs_df["LON"].values)
+    src = fds_time_slice.rename({"latitude": "lat", "longitude": "lon"})
+    return regridder(src)
+
+
+def compute_weights(fds_time_slice, lat, lon):
+    """ESMF bilinear weights from the forecast grid to these locations
+
+    Returns:
+        weights (scipy.sparse.csr_matrix): with shape (n_locations, n_grid),
+            rows for unmapped locations have a NaN, so they interpolate to NaN
+    """
+    weights = get_regridder(fds_time_slice, lat, lon).weights
+    weights = getattr(weights, "data", weights)
+    return scipy.sparse.csr_matrix(weights.tocsr() if hasattr(weights, "tocsr") else weights)
+
+
+class ObsInterpolator:
+    """Interpolate forecasts to observation locations, reusing ESMF weights per grid and obs locations
+
+    Weights are kept in memory for the life of this object, and in cache_path if given.
+
+    Args:
+        cache_path (str, optional): directory to store and read weights, shared between runs and models
+    """
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self._weights = {}
+
+    def get_weights(self, fds_time_slice, lat, lon):
+        """Weights from memory, from the cache, or computed with xesmf and then cached"""
+        key = f"{get_grid_key(fds_time_slice)[:16]}.{_hash_arrays(lat, lon)[:16]}"
+        if key in self._weights:
+            return self._weights[key]
+
+        fname = None if self.cache_path is None else f"{self.cache_path}/matchup.{key}.npz"
+        if fname is not None and os.path.isfile(fname):
+            weights = scipy.sparse.load_npz(fname).tocsr()
+        else:
+            weights = compute_weights(fds_time_slice, lat, lon)
+            if fname is not None:
+                os.makedirs(self.cache_path, exist_ok=True)
+                tmp = f"{fname}.{os.getpid()}.npz"
+                scipy.sparse.save_npz(tmp, weights)
+                os.replace(tmp, fname)
+                logger.info(f"ObsInterpolator: stored {fname}")
+
+        self._weights[key] = weights
+        return weights
+
+    def __call__(self, fds_time_slice, matched_obs_df):
+        """Same inputs and output as eagle.tools.obs_metrics._interp_to_obs_locations
+
+        Args:
+            fds_time_slice (xr.Dataset): for a single time, with latitude and longitude coordinates
+            matched_obs_df (pd.DataFrame): with LAT and LON columns
+
+        Returns:
+            xr.Dataset interpolated to observation locations (dim ``locations``).
+        """
+        lat = matched_obs_df["LAT"].values
+        lon = matched_obs_df["LON"].values
+        weights = self.get_weights(fds_time_slice, lat, lon)
+        spatial_dims = get_spatial_dims(fds_time_slice)
+
+        result = xr.Dataset()
+        for key in fds_time_slice.data_vars:
+            xda = fds_time_slice[key]
+            if not set(spatial_dims).issubset(xda.dims):
+                continue
+            xda = xda.transpose(..., *spatial_dims)
+            lead_dims = xda.dims[:-2]
+            values = xda.values.reshape((-1, weights.shape[1]))
+            result[key] = xr.DataArray(
+                (weights @ values.T).T.reshape(xda.shape[:-2] + (len(lat),)),
+                coords={d: xda[d] for d in lead_dims if d in xda.coords},
+                dims=lead_dims + ("locations",),
+                attrs=xda.attrs.copy(),
+            )
+        result["lat"] = xr.DataArray(lat, dims="locations")
+        result["lon"] = xr.DataArray(lon, dims="locations")
+        return result.set_coords(["lat", "lon"])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare cached obs matchups to a fresh xesmf regridder")
+    parser.add_argument("forecast", help="netcdf file with one forecast time, with latitude and longitude")
+    parser.add_argument("obs", help="csv file with LAT and LON columns")
+    parser.add_argument("--cache-path", default=None)
+    args = parser.parse_args()
+
+    fds = xr.load_dataset(args.forecast)
+    obs = pd.read_csv(args.obs)
+    obs["LON"] = obs["LON"] % 360
+
+    reference = reference_interp(fds, obs)
+    cached = ObsInterpolator(cache_path=args.cache_path)(fds, obs)
+    for key in cached.data_vars:
+        diff = np.nanmax(np.abs(cached[key].values - reference[key].values))
+        print(f"{key}: max |cached - xesmf| = {diff:.3e}")
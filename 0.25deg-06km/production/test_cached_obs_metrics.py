@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import scipy.sparse
+import pytest
+
+import cached_obs_metrics
+
+
+def regular_forecast():
+    lat = np.arange(20., 56., 1.)
+    lon = np.arange(230., 301., 1.)
+    rng = np.random.default_rng(0)
+    return xr.Dataset(
+        {
+            "t2m": (("latitude", "longitude"), 280 + rng.normal(size=(len(lat), len(lon)))),
+            "t": (("level", "latitude", "longitude"), 250 + rng.normal(size=(2, len(lat), len(lon)))),
+        },
+        coords={"latitude": lat, "longitude": lon, "level": [500, 850]},
+    )
+
+
+def lcc_forecast():
+    y, x = np.meshgrid(np.arange(30.), np.arange(50.), indexing="ij")
+    lat = 25 + 0.9*y + 0.05*x
+    lon = 240 + 1.1*x - 0.1*y
+    rng = np.random.default_rng(1)
+    return xr.Dataset(
+        {"t2m": (("y", "x"), 280 + rng.normal(size=lat.shape))},
+        coords={"latitude": (("y", "x"), lat), "longitude": (("y", "x"), lon)},
+    )
+
+
+def random_obs(n=500, seed=2):
+    """Mostly inside the grids, some outside, which should be NaN"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"LAT": rng.uniform(15, 60, n), "LON": rng.uniform(225, 305, n)})
+
+
+@pytest.mark.parametrize("make_forecast", [regular_forecast, lcc_forecast])
+def test_cache_reproduces_xesmf(tmp_path, make_forecast):
+    pytest.importorskip("xesmf")
+    fds = make_forecast()
+    obs = random_obs()
+    reference = cached_obs_metrics.reference_interp(fds, obs)
+
+    # a cache miss computes and stores the weights, a new interpolator reads them back
+    for _ in range(2):
+        interp = cached_obs_metrics.ObsInterpolator(cache_path=str(tmp_path))
+        cached = interp(fds, obs)
+        for key in fds.data_vars:
+            np.testing.assert_allclose(cached[key].values, reference[key].values, rtol=1e-12, equal_nan=True)
+    assert len(list(tmp_path.glob("matchup.*.npz"))) == 1
+
+
+def test_cache_hit_and_miss(tmp_path, monkeypatch):
+    """Without xesmf, check that weights are only computed once per grid and obs locations, and applied right"""
+    fds = regular_forecast()
+    n_grid = fds.sizes["latitude"] * fds.sizes["longitude"]
+    calls = []
+
+    def fake_weights(fds_time_slice, lat, lon):
+        calls.append(len(lat))
+        rng = np.random.default_rng(len(lat))
+        return scipy.sparse.random(len(lat), n_grid, density=0.01, random_state=rng, format="csr")
+
+    monkeypatch.setattr(cached_obs_metrics, "compute_weights", fake_weights)
+
+    obs = random_obs(100)
+    result = cached_obs_metrics.ObsInterpolator(cache_path=str(tmp_path))(fds, obs)
+    result = cached_obs_metrics.ObsInterpolator(cache_path=str(tmp_path))(fds, obs)
+    assert calls == [100]
+
+    cached_obs_metrics.ObsInterpolator(cache_path=str(tmp_path))(fds, random_obs(50, seed=3))
+    assert calls == [100, 50]
+
+    weights = fake_weights(fds, obs["LAT"].values, obs["LON"].values).toarray()
+    np.testing.assert_allclose(result["t2m"].values, weights @ fds["t2m"].values.ravel())
+    np.testing.assert_allclose(result["t"].sel(level=850).values, weights @ fds["t"].sel(level=850).values.ravel())
+    assert result["t"].dims == ("level", "locations")
@@ -1,12 +1,12 @@
 import os
+import numpy as np
 import xesmf
-import cf_xarray as cfxr
-
-from ufs2arco import sources
 
 from anemoi.datasets.grids import cutout_mask
 from anemoi.graphs.generate.utils import get_coordinates_ordering
 
+from hrrr_grid import get_grid
+
 
 def get_global_data_grid():
     ds = xesmf.util.grid_global(1, 1, cf=True, lon1=360)
@@ -16,49 +16,13 @@ def get_global_data_grid():
     ds = ds.sortby("lat", ascending=False)
     return ds
 
-def get_conus_data_grid():
-    hrrr = sources.AWSHRRRArchive(
-        t0={"start": "2015-01-15T00", "end": "2015-01-15T06", "freq": "6h"},
-        fhr={"start": 0, "end": 0, "step": 6},
-        variables=["orog"],
-    )
-    hds = hrrr.open_sample_dataset(
-        dims={"t0": hrrr.t0[0], "fhr": hrrr.fhr[0]},
-        open_static_vars=True,
-        cache_dir=f"{store_dir}/cache/grid-creation",
-    )
-    hds = hds.rename({"latitude": "lat", "longitude": "lon"})
-
-    # Get bounds as vertices
-    hds = hds.cf.add_bounds(["lat", "lon"])
-
-    for key in ["lat", "lon"]:
-        corners = cfxr.bounds_to_vertices(
-            bounds=hds[f"{key}_bounds"],
-            bounds_dim="bounds",
-            order=None,
-        )
-        hds = hds.assign_coords({f"{key}_b": corners})
-        hds = hds.drop_vars(f"{key}_bounds")
-
-    hds = hds.rename({"x_vertices": "x_b", "y_vertices": "y_b"})
-
-    # Get the nodes and bounds by subsampling carefully...
-    # see notebooks
-    hds = hds.isel(
-        x=slice(None, -4, None),
-        y=slice(None, -4, None),
-        x_b=slice(None, -4, None),
-        y_b=slice(None, -4, None),
-    )
-    chds = hds.isel(
-        x=slice(2, None, 5),
-        y=slice(2, None, 5),
-        x_b=slice(0, None, 5),
-        y_b=slice(0, None, 5),
-    )
-    chds = chds.drop_vars("orog")
-    return chds
+def get_conus_data_grid(coarsen=5, trim=0):
+    """15 km HRRR grid, computed from the projection parameters in hrrr_grid.py
+
+    This is the same as subsampling the native grid with x=slice(2, None, 5), x_b=slice(0, None, 5), etc.,
+    after dropping the last 4 rows and columns, but the vertices are exact and it needs no sample file.
+    """
+    return get_grid(coarsen=coarsen, trim=trim)
 
 def get_global_latent_grid():
     """For the high rez version, this will process the original grid.
@@ -87,8 +51,11 @@ def get_conus_latent_grid(xds, trim=10, coarsen=2):
     return mesh
 
 def combine_global_and_conus_meshes(gds, cds):
+    """Note: ../mesh-gen/mesh_builder.py does this from a recipe, with sponge layers and caching,
+    use that to try out different meshes
+    """
 
-    glon, glat = np.meshgrid(gmesh["lon"], gmesh["lat"])
+    glon, glat = np.meshgrid(gds["lon"], gds["lat"])
     mask = cutout_mask(
         lats=cds["lat"].values.flatten(),
         lons=cds["lon"].values.flatten(),
@@ -125,7 +92,7 @@ if __name__ == "__main__":
 
     # Latent meshes
     gmesh = get_global_latent_grid()
-    cmesh = get_conus_latent_grid()
+    cmesh = get_conus_latent_grid(cds)
     coords = combine_global_and_conus_meshes(gmesh, cmesh)
     np.savez(
         f"{store_dir}/latentx2.spongex1.combined.sorted.npz",
@@ -0,0 +1,134 @@
+"""
+The HRRR grid, or any coarsened and trimmed version of it, computed from the projection parameters.
+
+create_grids.py used to open a sample HRRR file from AWS, estimate the cell bounds with cf_xarray,
+and subsample by hand, e.g. slice(2, None, 5) for the 15 km centers and slice(0, None, 5) for their vertices.
+Here the cell centers and vertices are computed directly on the Lambert Conformal plane and
+transformed to lat/lon with pyproj, so there is no network access, and the vertices are exact rather than
+estimated from neighboring centers.
+
+A coarsened cell is made of coarsen x coarsen native 3 km cells, starting from the southwest corner,
+after removing trim native cells from each side. Any native cells left over at the north and east edges are dropped,
+which is how the original grids were made:
+
+    coarsen=5   # 15 km, 1.00deg-15km/data/hrrr_15km.nc, 211 x 359 cells
+    coarsen=2   #  6 km, 0.25deg-06km/data/hrrr_06km.nc, 529 x 899 cells
+    coarsen=3   #  9 km
+    coarsen=4   # 12 km
+
+Grids are cached as netcdf, keyed by coarsen and trim, in {cache_dir}/hrrr.coarsen{coarsen}.trim{trim}.nc
+
+Usage:
+    from hrrr_grid import get_grid
+    cds = get_grid(coarsen=5)
+
+    python hrrr_grid.py --coarsen 2 3 4 5 --trim 0 -o ${SCRATCH}/nested-eagle/candidate-grids
+"""
+import os
+import argparse
+import functools
+
+import numpy as np
+import xarray as xr
+import pyproj
+
+# from the HRRR grib2 files, grid definition template 3.30
+hrrr_projection = {
+    "proj": "lcc",
+    "lat_0": 38.5,
+    "lon_0": 262.5,
+    "lat_1": 38.5,
+    "lat_2": 38.5,
+    "R": 6371229.0,
+}
+hrrr_shape = {"y": 1059, "x": 1799}
+hrrr_dx = 3000.0
+hrrr_first_point = {"lat": 21.138123, "lon": 237.280472}
+
+default_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".grid-cache")
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer():
+    """From the Lambert Conformal plane to lat/lon, and the plane coordinates of the first (southwest) cell center"""
+    crs = pyproj.CRS.from_dict(hrrr_projection)
+    transformer = pyproj.Transformer.from_crs(crs, crs.geodetic_crs, always_xy=True)
+    x0, y0 = transformer.transform(hrrr_first_point["lon"], hrrr_first_point["lat"], direction="INVERSE")
+    return transformer, x0, y0
+
+
+def get_shape(coarsen=1, trim=0):
+    """Number of coarsened cells, as (n_y, n_x)"""
+    n_y, n_x = ((hrrr_shape[d] - 2*trim) // coarsen for d in ["y", "x"])
+    if n_y < 1 or n_x < 1:
+        raise ValueError(f"hrrr_grid: coarsen = {coarsen} and trim = {trim} leaves no cells")
+    return n_y, n_x
+
+
+def compute_grid(coarsen=1, trim=0):
+    """Cell centers and vertices of the coarsened HRRR grid
+
+    Args:
+        coarsen (int): number of native 3 km cells along each side of a coarse cell
+        trim (int): number of native cells removed from each side before coarsening
+
+    Returns:
+        xds (xr.Dataset): with lat, lon (y, x) at cell centers and lat_b, lon_b (y_b, x_b) at the vertices,
+            lon in [0, 360)
+    """
+    transformer, x0, y0 = get_transformer()
+    n_y, n_x = get_shape(coarsen, trim)
+
+    # native vertex j is at x0 + (j - 1/2) * dx, and coarse vertex i is native vertex trim + i * coarsen
+    vertex = lambda start, n: start + (trim + coarsen*np.arange(n + 1) - 0.5) * hrrr_dx
+    x_b, y_b = vertex(x0, n_x), vertex(y0, n_y)
+    x, y = 0.5*(x_b[1:] + x_b[:-1]), 0.5*(y_b[1:] + y_b[:-1])
+
+    lon, lat = transformer.transform(*np.meshgrid(x, y))
+    lon_b, lat_b = transformer.transform(*np.meshgrid(x_b, y_b))
+
+    xds = xr.Dataset(
+        coords={
+            "lat": (("y", "x"), lat),
+            "lon": (("y", "x"), lon % 360),
+            "lat_b": (("y_b", "x_b"), lat_b),
+            "lon_b": (("y_b", "x_b"), lon_b % 360),
+        },
+    )
+    xds.attrs["description"] = f"HRRR grid coarsened by {coarsen} after trimming {trim} native cells from each side"
+    xds.attrs["coarsen"] = coarsen
+    xds.attrs["trim"] = trim
+    xds.attrs["dx"] = coarsen * hrrr_dx
+    return xds
+
+
+def get_grid(coarsen=1, trim=0, cache_dir=default_cache_dir):
+    """compute_grid, or read it from the cache, with cache_dir=None to skip the cache"""
+    if cache_dir is None:
+        return compute_grid(coarsen, trim)
+
+    fname = f"{cache_dir}/hrrr.coarsen{coarsen}.trim{trim}.nc"
+    if not os.path.isfile(fname):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{fname}.{os.getpid()}.nc"
+        compute_grid(coarsen, trim).to_netcdf(tmp)
+        os.replace(tmp, fname)
+    return xr.load_dataset(fname)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Create coarsened HRRR grids from the projection parameters")
+    parser.add_argument("--coarsen", type=int, nargs="+", default=[5])
+    parser.add_argument("--trim", type=int, nargs="+", default=[0])
+    parser.add_argument("--cache-dir", default=default_cache_dir)
+    parser.add_argument("-o", "--output-dir", default=None, help="also store each grid as hrrr_{dx}km.trim{trim}.nc here")
+    args = parser.parse_args()
+
+    for coarsen in args.coarsen:
+        for trim in args.trim:
+            xds = get_grid(coarsen, trim, cache_dir=args.cache_dir)
+            print(f"coarsen={coarsen} trim={trim}: {xds.sizes['y']} x {xds.sizes['x']} cells, dx = {xds.attrs['dx']/1000:g} km")
+            if args.output_dir is not None:
+                os.makedirs(args.output_dir, exist_ok=True)
+                xds.to_netcdf(f"{args.output_dir}/hrrr_{int(xds.attrs['dx']/1000):02d}km.trim{trim}.nc")
@@ -0,0 +1,452 @@
+"""
+Check the encoder/decoder connectivity of a graph recipe without building the graph.
+
+The README describes finding isolated data nodes (at the GFS/HRRR boundary and across the poles)
+by building and inspecting the full graph, and then raising the encoder num_nearest_neighbours by trial
+(18 didn't work, 20 did).
+This reads the same recipe.yaml, builds only the nodes, and computes the KNNEdges and CutOffEdges
+between them with KD-tree queries on unit sphere coordinates, all vectorized. For each edge set it reports
+
+* the number of edges, and the in/out degree histogram of the target and source nodes
+* the isolated source and target nodes, i.e. those with no edges at all, overall and within a region
+* for KNNEdges, the minimum num_nearest_neighbours that leaves no isolated source nodes within the region
+
+RestrictEdgeLength post processors are applied to the edges they refer to, so e.g. heal5-trim10/recipe.yaml
+gives the same edge counts as heal5-trim10/inspection.cut148-15.txt.
+Other edge builders (e.g. MultiScaleEdges in the processor) are skipped.
+
+The minimum num_nearest_neighbours does not need any rebuilding:
+the nearest k_max sources are found once for every target, so each source node's degree for any k <= k_max
+is just a count over the first k columns, and the smallest k that reaches a source is where it first appears.
+If some source in the region is not reached within k_max, k_max is doubled and the query is repeated.
+
+Node coordinates come from
+
+* NPZFileNodes: the npz file, relative to the recipe's directory
+* AnemoiDatasetNodes: anemoi.datasets.open_dataset, with CutOutMask (and BooleanNot of it) attributes
+  set from the first grid in the cutout
+* anything else: the anemoi.graphs node builder itself, keeping its boolean attributes as masks
+* or any of these can be replaced with an npz with lon, lat, and any boolean masks, via --nodes
+
+Usage:
+    python graph_diagnostics.py mmgt-nbd/recipe.yaml --region cutout_mask
+    python graph_diagnostics.py heal5-trim10/recipe.yaml --bbox 20 55 230 300 -o heal5-trim10/connectivity.yaml
+    python graph_diagnostics.py mmgt/recipe.yaml --nodes data=data_nodes.npz
+"""
+import os
+import argparse
+
+import yaml
+import numpy as np
+from scipy.spatial import cKDTree
+
+import mesh_builder
+
+# anemoi.graphs computes the cutoff radius with this, and compares it to unit sphere chord distances
+earth_radius_km = mesh_builder.earth_radius_km
+
+
+def read_recipe(path):
+    """Read a graph recipe, making NPZFileNodes paths relative to the recipe's directory"""
+    with open(path, "r") as f:
+        recipe = yaml.safe_load(f)
+
+    recipe_dir = os.path.dirname(os.path.abspath(path))
+    for nodes in recipe.get("nodes", {}).values():
+        builder = nodes["node_builder"]
+        if builder["_target_"].endswith("NPZFileNodes"):
+            builder["npz_file"] = os.path.join(recipe_dir, os.path.expandvars(builder["npz_file"]))
+    return recipe
+
+
+def _builder_name(config):
+    return config["_target_"].split(".")[-1]
+
+
+def read_npz_nodes(path, lat_key="lat", lon_key="lon"):
+    with np.load(path) as npz:
+        nodes = {"lon": np.ravel(npz[lon_key]), "lat": np.ravel(npz[lat_key]), "masks": {}}
+        for key in npz.files:
+            if npz[key].dtype == bool and npz[key].size == nodes["lon"].size:
+                nodes["masks"][key] = np.ravel(npz[key])
+    return nodes
+
+
+def read_dataset_nodes(builder, attributes):
+    """Nodes for AnemoiDatasetNodes, with any CutOutMask or BooleanNot(CutOutMask) attributes"""
+    from anemoi.datasets import open_dataset
+
+    ds = open_dataset(builder["dataset"])
+    nodes = {"lon": np.asarray(ds.longitudes), "lat": np.asarray(ds.latitudes), "masks": {}}
+
+    first_grid = np.zeros(len(nodes["lon"]), dtype=bool)
+    first_grid[:ds.grids[0]] = True
+    for name, attr in (attributes or {}).items():
+        if _builder_name(attr) == "CutOutMask":
+            nodes["masks"][name] = first_grid
+        elif _builder_name(attr) == "BooleanNot" and _builder_name(attr["masks"]) == "CutOutMask":
+            nodes["masks"][name] = ~first_grid
+    return nodes
+
+
+def read_graph_nodes(recipe, name, graph):
+    """Nodes from the anemoi.graphs builder, for anything that isn't a file or dataset
+
+    Returns the updated graph too, since builders like StretchedTriNodes refer to other node sets.
+    """
+    import torch
+    from hydra.utils import instantiate
+
+    config = recipe["nodes"][name]
+    graph = instantiate(config["node_builder"], name=name).update_graph(
+        graph, attrs_config=config.get("attributes", {}),
+    )
+    latlon = np.rad2deg(graph[name].x.cpu().numpy())
+    nodes = {"lon": latlon[:, 1], "lat": latlon[:, 0], "masks": {}}
+    for key in graph[name].node_attrs():
+        value = graph[name][key]
+        if key != "x" and value.dtype == torch.bool:
+            nodes["masks"][key] = value.cpu().numpy().reshape(-1)
+    return nodes, graph
+
+
+def get_nodes(recipe, overrides=None):
+    """Lon, lat (degrees), and boolean masks for every node set in the recipe
+
+    Args:
+        recipe (dict): from read_recipe
+        overrides (dict): optional, node set name -> npz path, used instead of the recipe's builder
+
+    Returns:
+        nodes (dict): name -> {"lon", "lat", "masks"}
+    """
+    overrides = overrides or {}
+    nodes = {}
+    graph = None
+    for name, config in recipe["nodes"].items():
+        builder = config["node_builder"]
+        if name in overrides:
+            nodes[name] = read_npz_nodes(overrides[name])
+        elif _builder_name(builder) == "NPZFileNodes":
+            nodes[name] = read_npz_nodes(
+                builder["npz_file"],
+                lat_key=builder.get("lat_key", "latitudes"),
+                lon_key=builder.get("lon_key", "longitudes"),
+            )
+        elif _builder_name(builder) == "AnemoiDatasetNodes":
+            nodes[name] = read_dataset_nodes(builder, config.get("attributes", {}))
+        else:
+            if graph is None:
+                from torch_geometric.data import HeteroData
+                graph = HeteroData()
+                # builders like StretchedTriNodes need the nodes they refer to already in the graph
+                for other in nodes:
+                    if other in recipe["nodes"]:
+                        graph = _register_nodes(graph, other, nodes[other])
+            nodes[name], graph = read_graph_nodes(recipe, name, graph)
+        nodes[name]["xyz"] = mesh_builder.lonlat_to_xyz(nodes[name]["lon"], nodes[name]["lat"])
+    return nodes
+
+
+def _register_nodes(graph, name, nodes):
+    import torch
+    graph[name].x = torch.tensor(np.deg2rad(np.stack([nodes["lat"], nodes["lon"]], axis=-1)), dtype=torch.float32)
+    for key, mask in nodes["masks"].items():
+        graph[name][key] = torch.tensor(mask[:, None])
+    return graph
+
+
+def get_region(nodes, mask_name=None, bbox=None):
+    """Which nodes are in the region, with everything in it by default
+
+    Args:
+        nodes (dict): one node set from get_nodes
+        mask_name (str): optional, a boolean node attribute, e.g. cutout_mask, ignored if the node set doesn't have it
+        bbox (tuple): optional, (lat_min, lat_max, lon_min, lon_max) in degrees, lon in [0, 360)
+    """
+    region = np.ones(len(nodes["lon"]), dtype=bool)
+    if mask_name is not None and mask_name in nodes["masks"]:
+        region &= nodes["masks"][mask_name]
+    if bbox is not None:
+        lat_min, lat_max, lon_min, lon_max = bbox
+        lon = nodes["lon"] % 360
+        region &= (nodes["lat"] >= lat_min) & (nodes["lat"] <= lat_max)
+        region &= (lon >= lon_min) & (lon <= lon_max)
+    return region
+
+
+def chord_to_km(chord):
+    """Great circle distance of unit sphere chords, keeping inf for missing neighbours"""
+    chord = np.asarray(chord)
+    return np.where(np.isfinite(chord), 2 * np.arcsin(np.minimum(chord / 2, 1)) * earth_radius_km, np.inf)
+
+
+def _subset(nodes, mask_name):
+    """Indices of the nodes used by an edge builder, with source_mask_attr_name or target_mask_attr_name"""
+    if mask_name is None:
+        return np.arange(len(nodes["lon"]))
+    return np.flatnonzero(nodes["masks"][mask_name])
+
+
+def get_restrictions(recipe, source_name, target_name):
+    """RestrictEdgeLength post processors for these edges"""
+    return [
+        p for p in recipe.get("post_processors", []) or []
+        if _builder_name(p) == "RestrictEdgeLength"
+        and p["source_name"] == source_name and p["target_name"] == target_name
+    ]
+
+
+def keep_edges(distance_km, source, target, source_nodes, target_nodes, restrictions):
+    """Which edges survive the RestrictEdgeLength post processors, as anemoi.graphs applies them"""
+    keep = np.isfinite(distance_km)
+    for p in restrictions:
+        this = distance_km <= p["max_length_km"]
+        if p.get("source_mask_attr_name", None):
+            this |= ~source_nodes["masks"][p["source_mask_attr_name"]][source]
+        if p.get("target_mask_attr_name", None):
+            this |= ~target_nodes["masks"][p["target_mask_attr_name"]][target]
+        keep &= this
+    return keep
+
+
+def query_knn(source_nodes, target_nodes, k, source_index, target_index, chunk_size=65536):
+    """The k nearest sources of every target
+
+    Returns:
+        source (np.ndarray): shape (n_targets, k), node indices, nearest first
+        distance_km (np.ndarray): shape (n_targets, k)
+    """
+    k = min(k, len(source_index))
+    tree = cKDTree(source_nodes["xyz"][source_index])
+    source = np.empty((len(target_index), k), dtype=np.int64)
+    chord = np.empty((len(target_index), k))
+    for start in range(0, len(target_index), chunk_size):
+        block = slice(start, start + chunk_size)
+        d, i = tree.query(target_nodes["xyz"][target_index[block]], k=k)
+        chord[block] = np.reshape(d, (-1, k))
+        source[block] = source_index[np.reshape(i, (-1, k))]
+    return source, chord_to_km(chord)
+
+
+def get_cutoff_radius(builder, target_nodes, target_index):
+    """Cutoff radius as a unit sphere chord, the way anemoi.graphs.edges.CutOffEdges gets it"""
+    if builder.get("cutoff_distance_km", None) is not None:
+        return builder["cutoff_distance_km"] / earth_radius_km
+    xyz = target_nodes["xyz"][target_index]
+    d, _ = cKDTree(xyz).query(xyz, k=2)
+    return d[:, 1][d[:, 1] > 0].max() * builder["cutoff_factor"]
+
+
+def query_cutoff(source_nodes, target_nodes, radius, max_num_neighbours, source_index, target_index, chunk_size=4096):
+    """Sources within radius of every target, keeping at most the max_num_neighbours nearest
+
+    Returns:
+        source, distance_km (np.ndarray): as in query_knn, padded with -1 and inf
+    """
+    k = min(max_num_neighbours, len(source_index))
+    tree = cKDTree(source_nodes["xyz"][source_index])
+    source = np.full((len(target_index), k), -1, dtype=np.int64)
+    chord = np.full((len(target_index), k), np.inf)
+    for start in range(0, len(target_index), chunk_size):
+        block = slice(start, start + chunk_size)
+        d, i = tree.query(target_nodes["xyz"][target_index[block]], k=k, distance_upper_bound=radius)
+        d, i = np.reshape(d, (-1, k)), np.reshape(i, (-1, k))
+        found = np.isfinite(d)
+        chord[block] = d
+        source[block][found] = source_index[i[found]]
+    return source, chord_to_km(chord)
+
+
+def degree_histogram(degree, max_bins=12):
+    """Compact histogram, as [low, high, count] with inclusive integer bounds"""
+    lo, hi = int(degree.min()), int(degree.max())
+    if hi - lo + 1 <= max_bins:
+        counts = np.bincount(degree - lo, minlength=hi - lo + 1)
+        return [[lo + i, lo + i, int(c)] for i, c in enumerate(counts)]
+    edges = np.unique(np.linspace(lo, hi + 1, max_bins + 1).astype(int))
+    counts, _ = np.histogram(degree, bins=edges)
+    return [[int(a), int(b) - 1, int(c)] for a, b, c in zip(edges[:-1], edges[1:], counts)]
+
+
+def degree_summary(degree, region, nodes):
+    isolated = np.flatnonzero(degree == 0)
+    in_region = isolated[region[isolated]]
+    return {
+        "min": int(degree.min()),
+        "median": float(np.median(degree)),
+        "max": int(degree.max()),
+        "histogram": degree_histogram(degree),
+        "isolated": len(isolated),
+        "isolated_in_region": len(in_region),
+        "isolated_lat_range": [float(nodes["lat"][isolated].min()), float(nodes["lat"][isolated].max())] if len(isolated) else None,
+    }, isolated
+
+
+def min_knn(source, keep, region, n_sources):
+    """The smallest k that gives every source in the region at least one edge
+
+    Returns:
+        k (int): or None if some source in the region isn't reached by the k_max nearest
+        first_k (np.ndarray): for each source node, the smallest k that reaches it, k_max + 1 if none do
+    """
+    k_max = source.shape[1]
+    first_k = np.full(n_sources, k_max + 1, dtype=np.int64)
+    rank = np.broadcast_to(np.arange(1, k_max + 1), source.shape)
+    np.minimum.at(first_k, source[keep], rank[keep])
+    worst = int(first_k[region].max()) if region.any() else 0
+    return (worst if worst <= k_max else None), first_k
+
+
+def diagnose_edges(recipe, nodes, edges, region_mask=None, bbox=None, k_max=64):
+    """Connectivity of one entry in the recipe's edges, or None if its builders aren't supported
+
+    Returns:
+        report (dict): compact summary
+        isolated (dict): "source" and "target" node indices with no edges
+    """
+    source_name, target_name = edges["source_name"], edges["target_name"]
+    source_nodes, target_nodes = nodes[source_name], nodes[target_name]
+    source_region = get_region(source_nodes, region_mask, bbox)
+    restrictions = get_restrictions(recipe, source_name, target_name)
+
+    sources, targets, keeps, builders = [], [], [], []
+    report = {}
+    for builder in edges["edge_builders"]:
+        kind = _builder_name(builder)
+        source_index = _subset(source_nodes, builder.get("source_mask_attr_name", None))
+        target_index = _subset(target_nodes, builder.get("target_mask_attr_name", None))
+
+        if kind == "KNNEdges":
+            k = builder["num_nearest_neighbours"]
+            this_k_max = max(k, k_max)
+            while True:
+                source, distance = query_knn(source_nodes, target_nodes, this_k_max, source_index, target_index)
+                target = np.broadcast_to(target_index[:, None], source.shape)
+                keep = keep_edges(distance, source, target, source_nodes, target_nodes, restrictions)
+                k_min, _ = min_knn(source, keep, source_region, len(source_nodes["lon"]))
+                if k_min is not None or source.shape[1] >= len(source_index):
+                    break
+                this_k_max *= 2
+            report["min_num_nearest_neighbours"] = k_min
+            source, keep = source[:, :k], keep[:, :k]
+            target = target[:, :k]
+            builders.append(f"KNNEdges({k})")
+
+        elif kind == "CutOffEdges":
+            radius = get_cutoff_radius(builder, target_nodes, target_index)
+            max_num_neighbours = builder.get("max_num_neighbours", 64)
+            source, distance = query_cutoff(
+                source_nodes, target_nodes, radius, max_num_neighbours, source_index, target_index,
+            )
+            target = np.broadcast_to(target_index[:, None], source.shape)
+            keep = keep_edges(distance, source, target, source_nodes, target_nodes, restrictions)
+            report["cutoff_radius_km"] = float(chord_to_km(radius))
+            builders.append(f"CutOffEdges({report['cutoff_radius_km']:.1f} km, max {max_num_neighbours})")
+
+        else:
+            print(f"graph_diagnostics: skipping {kind} for {source_name} -> {target_name}, it isn't supported")
+            continue
+
+        sources.append(source[keep])
+        targets.append(target[keep])
+
+    if not builders:
+        return None, None
+
+    # edges from every builder, as a single id per (source, target) pair
+    edge_ids = np.unique(
+        np.concatenate(sources) * len(target_nodes["lon"]) + np.concatenate(targets)
+    )
+    source_degree = np.bincount(edge_ids // len(target_nodes["lon"]), minlength=len(source_nodes["lon"]))
+    target_degree = np.bincount(edge_ids % len(target_nodes["lon"]), minlength=len(target_nodes["lon"]))
+
+    report = {
+        "edges": f"{source_name} -> {target_name}",
+        "builders": builders,
+        "post_processors": [f"RestrictEdgeLength({p['max_length_km']} km)" for p in restrictions],
+        "num_edges": len(edge_ids),
+        **report,
+    }
+    report["source"], isolated_source = degree_summary(source_degree, source_region, source_nodes)
+    report["target"], isolated_target = degree_summary(
+        target_degree, get_region(target_nodes, region_mask, bbox), target_nodes,
+    )
+    return report, {"source": isolated_source, "target": isolated_target}
+
+
+def diagnose(recipe, nodes, region_mask=None, bbox=None, k_max=64):
+    """Connectivity of every supported edge set between different node sets, e.g. the encoder and decoder"""
+    reports, isolated = [], {}
+    for edges in recipe.get("edges", []):
+        if edges["source_name"] == edges["target_name"]:
+            continue
+        report, this_isolated = diagnose_edges(recipe, nodes, edges, region_mask=region_mask, bbox=bbox, k_max=k_max)
+        if report is not None:
+            reports.append(report)
+            name = f"{edges['source_name']}_to_{edges['target_name']}"
+            isolated[f"{name}.isolated_source"] = this_isolated["source"]
+            isolated[f"{name}.isolated_target"] = this_isolated["target"]
+    return reports, isolated
+
+
+def format_report(recipe_path, nodes, reports):
+    lines = [f"Recipe: {recipe_path}", ""]
+    for name, n in nodes.items():
+        masks = ", ".join(f"{k}={int(v.sum())}" for k, v in n["masks"].items())
+        lines.append(f"  {name:<8s} {len(n['lon']):>9d} nodes  {masks}")
+    for r in reports:
+        lines += ["", f"{r['edges']}: {', '.join(r['builders'] + r['post_processors'])}"]
+        lines.append(f"  edges: {r['num_edges']}")
+        if "min_num_nearest_neighbours" in r:
+            lines.append(f"  min num_nearest_neighbours with no isolated sources in region: {r['min_num_nearest_neighbours']}")
+        for side in ["source", "target"]:
+            s = r[side]
+            lines.append(
+                f"  {side:<6s} degree min/median/max {s['min']}/{s['median']:g}/{s['max']}, "
+                f"isolated {s['isolated']} ({s['isolated_in_region']} in region)"
+            )
+            lines.append("         histogram " + " ".join(
+                f"{lo}:{c}" if lo == hi else f"{lo}-{hi}:{c}" for lo, hi, c in s["histogram"]
+            ))
+    return "\n".join(lines)
+
+
+def main(recipe_path, overrides=None, region_mask=None, bbox=None, k_max=64, output=None):
+
+    recipe = read_recipe(recipe_path)
+    nodes = get_nodes(recipe, overrides=overrides)
+    reports, isolated = diagnose(recipe, nodes, region_mask=region_mask, bbox=bbox, k_max=k_max)
+    print(format_report(recipe_path, nodes, reports))
+
+    if output is not None:
+        with open(output, "w") as f:
+            yaml.safe_dump(
+                {"recipe": recipe_path, "region_mask": region_mask, "bbox": bbox, "edges": reports},
+                f, sort_keys=False, default_flow_style=None,
+            )
+        root, _ = os.path.splitext(output)
+        np.savez(f"{root}.isolated.npz", **isolated)
+        print(f"\nStored {output} and {root}.isolated.npz")
+    return reports, isolated
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Encoder/decoder connectivity of a graph recipe, without building the graph")
+    parser.add_argument("recipe", help="graph recipe yaml, e.g. mmgt-nbd/recipe.yaml")
+    parser.add_argument("--nodes", nargs="+", default=[], metavar="NAME=NPZ", help="use this npz (lon, lat, masks) for a node set")
+    parser.add_argument("--region", default=None, help="boolean node attribute defining the region, e.g. cutout_mask")
+    parser.add_argument("--bbox", type=float, nargs=4, default=None, metavar=("LAT_MIN", "LAT_MAX", "LON_MIN", "LON_MAX"))
+    parser.add_argument("--k-max", type=int, default=64, help="initial bound when searching for the minimum num_nearest_neighbours")
+    parser.add_argument("-o", "--output", default=None, help="yaml report, with the isolated node indices next to it as npz")
+    args = parser.parse_args()
+
+    main(
+        args.recipe,
+        overrides=dict(item.split("=", 1) for item in args.nodes),
+        region_mask=args.region,
+        bbox=args.bbox,
+        k_max=args.k_max,
+        output=args.output,
+    )
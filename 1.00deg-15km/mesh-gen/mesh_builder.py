@@ -0,0 +1,319 @@
+"""
+Build nested (global + CONUS) latent meshes from a small recipe, without the notebooks.
+
+This does what the create_hrrr_latent_mesh*.ipynb and combine_latent_meshes*.ipynb notebooks do:
+
+1. take the HRRR data grid vertices (lat_b, lon_b, e.g. from data/create_grids.py),
+   trim them, coarsen them, and optionally extend them outward with a sponge layer
+2. remove the global latent mesh points that fall inside of, or too close to, the CONUS mesh
+3. concatenate, and sort the anemoi way
+
+Here the cutout in step 2 is done with a KD-tree on unit sphere coordinates plus a
+point-in-polygon test against the CONUS mesh outline, all vectorized, so it takes well under a second.
+Results are cached by a hash of the recipe, so rebuilding the same mesh just reads the cached npz:
+
+    {cache_dir}/latent.{recipe hash}.sorted.npz
+
+Recipe, e.g. csmswt-trim10/mesh.yaml:
+
+    global:
+      type: regular           # regular, healpix, or file
+      resolution: 2           # regular: grid spacing in degrees, cell centers, lon in [0, 360)
+      # level: 5              # healpix: resolution passed to anemoi.graphs HEALPixNodes
+      # path: ../global-mesh/latentx2.global1degree.unsorted.nc   # file: nc with 1D lat/lon, or npz with flat lat/lon
+    conus:
+      path: ${SCRATCH}/nested-eagle/1.00deg-15km/data/hrrr_15km.nc
+      trim: 10                # trim+1 vertices removed from each side of x and y, before coarsening
+      coarsen: 2              # take every nth vertex
+      sponge: 1               # number of coarse layers to extend outward, into the trimmed region, default 0
+    min_distance_km: 30       # also remove global points this close to any CONUS mesh point, default 0
+    sort_coords: latlon       # latlon (default) or lonlat, which column get_coordinates_ordering sees first
+    output: latentx2.spongex1.combined.sorted.npz  # optional, also write it here
+
+Usage:
+    python mesh_builder.py csmswt-trim10/mesh.yaml
+    python mesh_builder.py csmswt-trim10/mesh.yaml --trim 10 15 20 --coarsen 2 4 --sponge 0 1 2  # sweep
+"""
+import os
+import copy
+import json
+import time
+import hashlib
+import argparse
+import itertools
+
+import yaml
+import numpy as np
+import xarray as xr
+from scipy.spatial import cKDTree
+from matplotlib.path import Path
+
+from anemoi.graphs.generate.utils import get_coordinates_ordering
+
+earth_radius_km = 6371.0
+default_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".mesh-cache")
+
+# HRRR vertices, keyed by file path
+_conus_vertices = {}
+
+
+def read_recipe(path):
+    """Read a mesh recipe, expanding environment variables like ${SCRATCH}
+    and making file paths relative to the recipe's directory
+    """
+    with open(path, "r") as f:
+        recipe = yaml.safe_load(f)
+
+    recipe_dir = os.path.dirname(os.path.abspath(path))
+    for section in ["global", "conus"]:
+        if "path" in recipe.get(section, {}):
+            p = os.path.expandvars(recipe[section]["path"])
+            recipe[section]["path"] = os.path.join(recipe_dir, p)
+    if "output" in recipe:
+        recipe["output"] = os.path.join(recipe_dir, os.path.expandvars(recipe["output"]))
+    return recipe
+
+
+def recipe_key(recipe):
+    """Hash of everything in the recipe that changes the mesh, including the content of any input files"""
+    recipe = copy.deepcopy(recipe)
+    recipe.pop("output", None)
+    h = hashlib.sha1(json.dumps(recipe, sort_keys=True).encode())
+    for section in ["global", "conus"]:
+        if "path" in recipe.get(section, {}):
+            with open(recipe[section]["path"], "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+    return h.hexdigest()[:16]
+
+
+def lonlat_to_xyz(lon, lat):
+    """Unit sphere cartesian coordinates, with the last dim as (x, y, z)"""
+    lon = np.deg2rad(lon)
+    lat = np.deg2rad(lat)
+    return np.stack(
+        [np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)],
+        axis=-1,
+    )
+
+
+def get_global_mesh(options):
+    """Flat lon, lat of the global latent mesh, in degrees, lon in [0, 360)"""
+
+    mesh_type = options.get("type", "regular")
+    if mesh_type == "regular":
+        # same as xesmf.util.grid_global(d, d, cf=True, lon1=360)
+        d = options["resolution"]
+        lon = np.arange(d/2, 360, d)
+        lat = np.arange(-90 + d/2, 90, d)
+        lon, lat = np.meshgrid(lon, lat)
+
+    elif mesh_type == "healpix":
+        from anemoi.graphs.nodes.builders.from_healpix import HEALPixNodes
+        coords = HEALPixNodes(resolution=options["level"], name="global").get_coordinates()
+        coords = np.rad2deg(np.asarray(coords))
+        lat, lon = coords[:, 0], coords[:, 1]
+
+    elif mesh_type == "file":
+        path = options["path"]
+        if path.endswith(".npz"):
+            with np.load(path) as npz:
+                lon, lat = npz["lon"], npz["lat"]
+        else:
+            xds = xr.load_dataset(path)
+            lon, lat = xds["lon"].values, xds["lat"].values
+            # 1D lon(lon) and lat(lat) are a regular grid, otherwise they're already paired up
+            if xds["lon"].dims != xds["lat"].dims:
+                lon, lat = np.meshgrid(lon, lat)
+
+    else:
+        raise NotImplementedError(f"get_global_mesh: type = {mesh_type} not implemented, use regular, healpix, or file")
+
+    return np.ravel(lon) % 360, np.ravel(lat)
+
+
+def get_conus_mesh(options):
+    """Trimmed, coarsened, and sponged CONUS latent mesh from the HRRR data grid vertices
+
+    With sponge = 0 this is the "latentx2" mesh in csmswt-trim*/create_hrrr_latent_meshx2.ipynb,
+    which starts at vertex trim+1 on each side, and with sponge = n the mesh is extended by
+    n coarse layers, i.e. n*coarsen vertices, on each side,
+    e.g. sponge = 1 is the "spongex1" mesh in csmswt-trim*/create_hrrr_latent_meshx2_sponge.ipynb
+
+    Returns:
+        lon, lat (np.ndarray): 2D, with shape (n_y, n_x), lon in [0, 360)
+    """
+    path = options["path"]
+    if path not in _conus_vertices:
+        xds = xr.load_dataset(path)
+        _conus_vertices[path] = (xds["lon_b"].values % 360, xds["lat_b"].values)
+    lon_b, lat_b = _conus_vertices[path]
+
+    trim = options.get("trim", 10)
+    coarsen = options.get("coarsen", 2)
+    sponge = options.get("sponge", 0)
+    offset = trim + 1 - sponge*coarsen
+    if offset < 0:
+        raise ValueError(f"get_conus_mesh: sponge = {sponge} layers of {coarsen} vertices extends past the edge with trim = {trim}")
+
+    stop = -offset
+    slc = slice(offset, stop if stop < 0 else None, coarsen)
+    return lon_b[slc, slc], lat_b[slc, slc]
+
+
+def get_outline(lon, lat):
+    """Closed outline of a 2D (y, x) mesh, going around its edge"""
+    ring = lambda a: np.concatenate([a[0, :], a[1:, -1], a[-1, -2::-1], a[-2:0:-1, 0], a[:1, 0]])
+    return ring(lon), ring(lat)
+
+
+def cutout_mask(lon, lat, global_lon, global_lat, min_distance_km=0):
+    """Which global points to keep, i.e. not inside the regional mesh or within min_distance_km of it
+
+    This is meant to do the same job as anemoi.datasets.grids.cutout_mask for a structured regional mesh,
+    but the inside test is a point in polygon test of the mesh outline on the plane tangent to its center,
+    and the distance test is a single KD-tree query.
+
+    Args:
+        lon, lat (np.ndarray): 2D regional mesh, with shape (n_y, n_x)
+        global_lon, global_lat (np.ndarray): flat global mesh
+
+    Returns:
+        mask (np.ndarray): boolean, True for global points to keep
+    """
+    xyz = lonlat_to_xyz(lon, lat).reshape(-1, 3)
+    global_xyz = lonlat_to_xyz(global_lon, global_lat)
+
+    # gnomonic projection about the center of the regional mesh
+    center = xyz.mean(axis=0)
+    center /= np.linalg.norm(center)
+    e1 = np.cross([0., 0., 1.], center)
+    e1 /= np.linalg.norm(e1)
+    e2 = np.cross(center, e1)
+
+    def project(p):
+        p = p / np.sum(p * center, axis=-1, keepdims=True)
+        return np.stack([p @ e1, p @ e2], axis=-1)
+
+    olon, olat = get_outline(lon, lat)
+    outline = Path(project(lonlat_to_xyz(olon, olat)))
+
+    # points on the far side of the globe can't be projected, and are outside anyway
+    facing = global_xyz @ center > 0
+    inside = np.zeros(len(global_xyz), dtype=bool)
+    inside[facing] = outline.contains_points(project(global_xyz[facing]))
+
+    too_close = np.zeros(len(global_xyz), dtype=bool)
+    if min_distance_km > 0:
+        chord = 2 * np.sin(min_distance_km / earth_radius_km / 2)
+        distance, _ = cKDTree(xyz).query(global_xyz, k=1, distance_upper_bound=chord)
+        too_close = np.isfinite(distance)
+
+    return ~(inside | too_close)
+
+
+def sort_mesh(lon, lat, sort_coords="latlon"):
+    """Sort the anemoi way, as in anemoi.graphs.generate.utils.get_coordinates_ordering
+
+    Returns:
+        lon, lat (np.ndarray): sorted
+        order (np.ndarray): the permutation, so that sorted = unsorted[order]
+    """
+    if sort_coords == "latlon":
+        coords = np.deg2rad(np.stack([lat, lon], axis=-1))
+    elif sort_coords == "lonlat":
+        coords = np.stack([lon, lat], axis=-1)
+    else:
+        raise NotImplementedError(f"sort_mesh: sort_coords = {sort_coords} not implemented, use latlon or lonlat")
+    order = get_coordinates_ordering(coords)
+    return lon[order], lat[order], order
+
+
+def build_mesh(recipe, cache_dir=default_cache_dir, overwrite=False):
+    """Build the combined, sorted latent mesh for a recipe, or read it from the cache
+
+    Returns:
+        mesh (dict): with sorted "lon", "lat", plus "n_conus" and "n_global",
+            the number of points from each mesh, and "path" to the cached npz
+    """
+    key = recipe_key(recipe)
+    fname = f"{cache_dir}/latent.{key}.sorted.npz"
+
+    if overwrite or not os.path.isfile(fname):
+        glon, glat = get_global_mesh(recipe["global"])
+        clon, clat = get_conus_mesh(recipe["conus"])
+        mask = cutout_mask(clon, clat, glon, glat, min_distance_km=recipe.get("min_distance_km", 0))
+
+        lon = np.concatenate([glon[mask], clon.ravel()])
+        lat = np.concatenate([glat[mask], clat.ravel()])
+        lon, lat, _ = sort_mesh(lon, lat, sort_coords=recipe.get("sort_coords", "latlon"))
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{fname}.{os.getpid()}.npz"
+        np.savez(
+            tmp,
+            lon=lon,
+            lat=lat,
+            n_conus=clon.size,
+            n_global=int(mask.sum()),
+            recipe=json.dumps(recipe, sort_keys=True),
+        )
+        os.replace(tmp, fname)
+
+    with np.load(fname) as npz:
+        mesh = {k: npz[k] for k in ["lon", "lat", "n_conus", "n_global"]}
+    mesh["path"] = fname
+
+    if "output" in recipe:
+        # same keys as the npz files that anemoi.graphs.nodes.NPZFileNodes reads in the graph recipes
+        np.savez(recipe["output"], lon=mesh["lon"], lat=mesh["lat"])
+    return mesh
+
+
+def sweep(recipe, trims, coarsens, sponges, cache_dir=default_cache_dir):
+    """Build a mesh for every combination of trim, coarsen, and sponge
+
+    Returns:
+        meshes (dict): keyed by (trim, coarsen, sponge)
+    """
+    meshes = {}
+    for trim, coarsen, sponge in itertools.product(trims, coarsens, sponges):
+        this_recipe = copy.deepcopy(recipe)
+        this_recipe.pop("output", None)
+        this_recipe["conus"].update({"trim": trim, "coarsen": coarsen, "sponge": sponge})
+        t0 = time.perf_counter()
+        meshes[trim, coarsen, sponge] = build_mesh(this_recipe, cache_dir=cache_dir)
+        mesh = meshes[trim, coarsen, sponge]
+        print(
+            f"trim={trim:>3d} coarsen={coarsen} sponge={sponge}: "
+            f"{len(mesh['lon'])} nodes ({int(mesh['n_global'])} global, {int(mesh['n_conus'])} conus) "
+            f"in {time.perf_counter() - t0:.2f} s -> {mesh['path']}"
+        )
+    return meshes
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Build nested latent meshes from a recipe")
+    parser.add_argument("recipe", help="mesh recipe yaml, e.g. csmswt-trim10/mesh.yaml")
+    parser.add_argument("--trim", type=int, nargs="+", help="sweep over these trims")
+    parser.add_argument("--coarsen", type=int, nargs="+", help="sweep over these coarsening factors")
+    parser.add_argument("--sponge", type=int, nargs="+", help="sweep over these sponge widths")
+    parser.add_argument("--cache-dir", default=default_cache_dir)
+    parser.add_argument("--overwrite", action="store_true", help="rebuild even if it's cached")
+    args = parser.parse_args()
+
+    recipe = read_recipe(args.recipe)
+    if args.trim or args.coarsen or args.sponge:
+        sweep(
+            recipe,
+            trims=args.trim or [recipe["conus"].get("trim", 10)],
+            coarsens=args.coarsen or [recipe["conus"].get("coarsen", 2)],
+            sponges=args.sponge or [recipe["conus"].get("sponge", 0)],
+            cache_dir=args.cache_dir,
+        )
+    else:
+        mesh = build_mesh(recipe, cache_dir=args.cache_dir, overwrite=args.overwrite)
+        print(f"{len(mesh['lon'])} nodes ({int(mesh['n_global'])} global, {int(mesh['n_conus'])} conus) -> {mesh['path']}")
+        if "output" in recipe:
+            print(f"Stored {recipe['output']}")
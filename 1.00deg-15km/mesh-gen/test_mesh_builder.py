@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import xarray as xr
+import pytest
+
+pytest.importorskip("anemoi.graphs")
+
+import mesh_builder
+
+
+@pytest.fixture
+def vertices(tmp_path):
+    """A fake HRRR 15 km vertex grid, 212 x 360, with the vertex index as lon/lat"""
+    lat_b, lon_b = np.meshgrid(np.arange(212.), np.arange(360.), indexing="ij")
+    path = str(tmp_path / "hrrr_15km.nc")
+    xr.Dataset(coords={"lat_b": (("y_b", "x_b"), lat_b), "lon_b": (("y_b", "x_b"), lon_b)}).to_netcdf(path)
+    return path
+
+
+@pytest.mark.parametrize("trim", [10, 15])
+def test_conus_mesh_matches_notebooks(vertices, trim):
+    lat_b = xr.load_dataset(vertices)["lat_b"]
+
+    # create_hrrr_latent_meshx2.ipynb
+    latentx2 = lat_b.isel(y_b=slice(trim, -trim-1), x_b=slice(trim, -trim-1)).isel(y_b=slice(1, None, 2), x_b=slice(1, None, 2))
+    _, lat = mesh_builder.get_conus_mesh({"path": vertices, "trim": trim, "coarsen": 2, "sponge": 0})
+    np.testing.assert_array_equal(lat, latentx2.values)
+
+    # create_hrrr_latent_meshx2_sponge.ipynb
+    spongex1 = lat_b.isel(y_b=slice(trim-1, -trim, 2), x_b=slice(trim-1, -trim, 2))
+    _, lat = mesh_builder.get_conus_mesh({"path": vertices, "trim": trim, "coarsen": 2, "sponge": 1})
+    np.testing.assert_array_equal(lat, spongex1.values)
+
+
+@pytest.mark.parametrize("coarsen", [2, 3, 4])
+def test_sponge_adds_coarse_layers(vertices, coarsen):
+    options = {"path": vertices, "trim": 15, "coarsen": coarsen}
+    lon0, lat0 = mesh_builder.get_conus_mesh({**options, "sponge": 0})
+    for sponge in [1, 2]:
+        lon, lat = mesh_builder.get_conus_mesh({**options, "sponge": sponge})
+        assert lat.shape == (lat0.shape[0] + 2*sponge, lat0.shape[1] + 2*sponge)
+        np.testing.assert_array_equal(lat[sponge:-sponge, sponge:-sponge], lat0)
+        np.testing.assert_array_equal(lon[sponge:-sponge, sponge:-sponge], lon0)
+        assert lat[0, 0] == lat0[0, 0] - sponge*coarsen
+
+
+def test_sponge_past_the_edge(vertices):
+    with pytest.raises(ValueError):
+        mesh_builder.get_conus_mesh({"path": vertices, "trim": 10, "coarsen": 4, "sponge": 3})
+
+
+def test_global_mesh_from_square_regular_file(tmp_path):
+    """1D lat(lat) and lon(lon) get meshgridded, even with the same number of points"""
+    path = str(tmp_path / "global.unsorted.nc")
+    lon, lat = np.arange(0., 360., 90.), np.array([-67.5, -22.5, 22.5, 67.5])
+    xr.Dataset(coords={"lon": lon, "lat": lat}).to_netcdf(path)
+
+    glon, glat = mesh_builder.get_global_mesh({"type": "file", "path": path})
+    expected_lon, expected_lat = np.meshgrid(lon, lat)
+    np.testing.assert_array_equal(glon, expected_lon.ravel())
+    np.testing.assert_array_equal(glat, expected_lat.ravel())
+
+
+def test_recipe_key_hashes_file_content(vertices):
+    recipe = {"conus": {"path": vertices, "trim": 10, "coarsen": 2, "sponge": 0}, "output": "a"}
+    key = mesh_builder.recipe_key(recipe)
+    assert mesh_builder.recipe_key({**recipe, "output": "b"}) == key
+
+    # touching the file doesn't change the key
+    os.utime(vertices, ns=(0, 0))
+    assert mesh_builder.recipe_key(recipe) == key
+
+    # but changing the content does, even with the same size and timestamp
+    with open(vertices, "rb") as f:
+        content = bytearray(f.read())
+    content[-1] ^= 1
+    with open(vertices, "wb") as f:
+        f.write(content)
+    os.utime(vertices, ns=(0, 0))
+    assert mesh_builder.recipe_key(recipe) != key
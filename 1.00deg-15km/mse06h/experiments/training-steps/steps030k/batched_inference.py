@@ -0,0 +1,434 @@
+"""
+Batched version of ``eagle-tools inference``, using the same inference yamls.
+
+``eagle-tools inference`` runs one initial condition at a time, and each one builds a new
+anemoi runner that reopens the input datasets, and does a forward pass with a batch size of 1.
+Here, the checkpoint is loaded and the input datasets are opened once per process,
+then ``batch_size`` initial conditions are stacked along the batch dimension of the input tensor
+and rolled out together, so each step is a single forward pass through the model for the whole batch.
+This is mostly useful on CPU, where the batched matrix multiplies use the cores much better
+than a batch size of 1.
+
+Each batch member is still written to its own file through its own anemoi output,
+so the results are stored in the same place:
+
+    {output_path}/{t0}.{lead_time}h.nc
+
+or, with ``output_format: zarr``, all initial conditions go into a single zarr store,
+see zarr_output.py for the layout and options.
+
+Config options, in addition to the ones used by ``eagle-tools inference``:
+
+    batch_size: 8       # number of initial conditions to roll out together, default 4
+    device: cpu         # default here is cpu, rather than cuda
+    n_threads: 64       # optional, number of torch threads
+    use_mpi: True       # optional, split initial conditions across MPI ranks, each running its own batches
+    write_queue_size: 4 # max number of states waiting to be written by the background writer thread,
+                        # 0 writes each step before starting the next one, default 2 * batch_size
+
+Output is written by a background thread, so that writing step n overlaps with computing step n+1.
+The states go through a bounded queue, so if writing falls behind, the rollout waits
+rather than holding more and more of the forecast in memory.
+
+BatchMember follows anemoi's DefaultRunner.execute, which means it calls a few private runner methods
+(see private_runner_api) and shares the template's model by setting the runner's cached model property.
+These were checked against anemoi-inference==0.9.0, as pinned in 0.25deg-06km/production/environment.yaml,
+and check_runner_api stops early with a clear error if a different version doesn't have them.
+
+Usage:
+    python batched_inference.py inference.validation.yaml
+    srun -n 4 python batched_inference.py inference.validation.yaml  # with use_mpi: True
+"""
+import os
+import sys
+import queue
+import inspect
+import logging
+import functools
+import threading
+import importlib.metadata
+
+import numpy as np
+import pandas as pd
+import torch
+
+from anemoi.inference.config.run import RunConfiguration
+from anemoi.inference.runners import create_runner
+from anemoi.inference.output import Output
+from anemoi.utils.dates import frequency_to_timedelta as to_timedelta
+
+from ufs2arco.mpi import MPITopology, SerialTopology
+
+from eagle.tools.utils import open_yaml_config
+from eagle.tools.inference import create_anemoi_config
+
+import zarr_output
+
+logger = logging.getLogger("eagle.tools")
+
+# the anemoi-inference version that BatchMember was written against, and the private runner methods it uses
+anemoi_inference_version = "0.9.0"
+private_runner_api = ("_check_state", "_combine_states", "_initial_state")
+
+
+def check_runner_api(runner):
+    """Make sure this runner has the private methods that BatchMember uses, and a cached model property to share"""
+    installed = importlib.metadata.version("anemoi-inference")
+    if installed != anemoi_inference_version:
+        logger.warning(
+            f"batched_inference was written against anemoi-inference=={anemoi_inference_version}, "
+            f"but {installed} is installed"
+        )
+
+    missing = [name for name in private_runner_api if not callable(getattr(runner, name, None))]
+    if not isinstance(inspect.getattr_static(type(runner), "model", None), functools.cached_property):
+        missing.append("model (as a cached_property)")
+    if missing:
+        raise RuntimeError(
+            f"check_runner_api: {type(runner).__name__} from anemoi-inference=={installed} is missing {missing}, "
+            f"batched_inference needs anemoi-inference=={anemoi_inference_version}"
+        )
+
+
+def load_template_runner(config):
+    """Create one runner with the model loaded and the inputs opened, to be shared by every batch member
+
+    Returns:
+        runner (anemoi.inference.runners.DefaultRunner): with "printer" output
+        inputs (dict): with the prognostics, constant_forcings, and dynamic_forcings inputs
+    """
+    anemoi_config, _ = create_anemoi_config(init_date=pd.Timestamp(config["start_date"]), main_config=config)
+    anemoi_config["output"] = "printer"
+    runner = create_runner(RunConfiguration.load(anemoi_config))
+    check_runner_api(runner)
+
+    # touch the model so it's loaded here, once
+    runner.model.eval()
+    inputs = {
+        "prognostics": runner.create_prognostics_input(),
+        "constant_forcings": runner.create_constant_coupled_forcings_input(),
+        "dynamic_forcings": runner.create_dynamic_forcings_input(),
+    }
+    return runner, inputs
+
+
+class BatchMember:
+    """A single initial condition in a batch, with its own runner and output file
+
+    This follows anemoi's DefaultRunner.execute and Runner.run up to the point where
+    the input tensor is ready, but uses the model and inputs from the template runner.
+
+    Args:
+        init_date (pd.Timestamp): initial condition
+        config (dict): the inference yaml
+        template (DefaultRunner): from load_template_runner
+        inputs (dict): from load_template_runner
+    """
+
+    def __init__(self, init_date, config, template, inputs):
+        anemoi_config, self.fname = create_anemoi_config(init_date=init_date, main_config=config)
+        self.init_date = init_date
+        self.runner = create_runner(RunConfiguration.load(anemoi_config))
+        self.runner.__dict__["model"] = template.model
+
+        runner = self.runner
+        runner.lead_time = to_timedelta(config["lead_time"])
+        runner.time_step = runner.checkpoint.timestep
+        if config.get("output_format", "netcdf") == "zarr":
+            self.fname = zarr_output.get_store_path(config)
+            self.output = zarr_output.ZarrOutput(self.fname, init_date, config)
+        else:
+            self.output = runner.create_output()
+
+        date = init_date.to_pydatetime()
+        prognostic_state = inputs["prognostics"].create_input_state(date=date)
+        constants_state = inputs["constant_forcings"].create_input_state(date=date)
+        forcings_state = inputs["dynamic_forcings"].create_input_state(date=date)
+        runner._check_state(prognostic_state, "prognostics")
+        runner._check_state(constants_state, "constant_forcings")
+        runner._check_state(forcings_state, "dynamic_forcings")
+
+        input_state = runner._combine_states(prognostic_state, constants_state, forcings_state)
+        runner.input_state_hook(constants_state)
+
+        initial_state = Output.reduce(runner._initial_state(prognostic_state, constants_state, forcings_state))
+        for processor in runner.post_processors:
+            initial_state = processor.process(initial_state)
+
+        self.output.open(initial_state)
+        self.output.write_initial_state(initial_state)
+
+        # from Runner.run
+        input_state = input_state.copy()
+        input_state["fields"] = input_state["fields"].copy()
+        runner.constant_forcings_inputs = runner.create_constant_forcings_inputs(input_state)
+        runner.dynamic_forcings_inputs = runner.create_dynamic_forcings_inputs(input_state)
+        runner.boundary_forcings_inputs = runner.create_boundary_forcings_inputs(input_state)
+
+        self.input_tensor = runner.prepare_input_tensor(input_state)
+        self.state = input_state.copy()
+        self.state["fields"] = dict()
+        self.state["step"] = to_timedelta(0)
+
+    def update_state(self, output, step):
+        """Put this member's prediction, with shape (values, variables), into its state"""
+        self.state["date"] = self.init_date.to_pydatetime() + step
+        self.state["previous_step"] = self.state.get("step")
+        self.state["step"] = step
+        index_to_variable = self.runner.checkpoint.output_tensor_index_to_variable
+        for i in range(output.shape[1]):
+            self.state["fields"][index_to_variable[i]] = output[:, i].cpu().numpy()
+
+    def snapshot(self):
+        """A copy of the current state, which is safe to hand to the writer thread while the next step runs"""
+        state = self.state.copy()
+        state["fields"] = self.state["fields"].copy()
+        return state
+
+    def write_state(self, state=None):
+        state = self.state if state is None else state
+        for processor in self.runner.post_processors:
+            state = processor.process(state)
+        self.output.write_state(state)
+
+    def next_input_tensor(self, input_tensor, y_pred, reset):
+        """Same as the update at the end of each step in Runner.forecast, for this member only
+
+        Args:
+            input_tensor, y_pred (torch.Tensor): this member's slice of the batch, so batch is 1
+            reset (np.ndarray): which variables are constant in time
+
+        Returns:
+            input_tensor (torch.Tensor): for the next step
+        """
+        runner = self.runner
+        next_date = self.state["date"]
+        check = reset.copy()
+
+        runner.output_state_hook(self.state)
+        input_tensor = runner.copy_prognostic_fields_to_input_tensor(input_tensor, y_pred, check)
+        input_tensor = runner.add_dynamic_forcings_to_input_tensor(input_tensor, self.state, next_date, check)
+        input_tensor = runner.add_boundary_forcings_to_input_tensor(input_tensor, self.state, next_date, check)
+
+        if not check.all():
+            mapping = {v: k for k, v in runner.checkpoint.variable_to_input_tensor_index.items()}
+            missing = [mapping[i] for i in np.flatnonzero(~check)]
+            raise ValueError(f"Missing variables in input tensor for {self.init_date}: {sorted(missing)}")
+        return input_tensor
+
+    def close(self):
+        self.runner.complete_forecast_hook()
+        self.output.close()
+
+
+class AsyncWriter:
+    """Write states from a background thread, while the main thread computes the next step
+
+    All writes happen on this one thread, in the order they were put in the queue,
+    since netCDF/HDF5 files should not be written from multiple threads at once.
+    An error on the writer thread is raised on the main thread the next time it puts, flushes, or closes.
+
+    Args:
+        maxsize (int): max number of states waiting to be written, put blocks when the queue is full
+    """
+
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="AsyncWriter", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            member, state = item
+            if self.error is None:
+                try:
+                    member.write_state(state)
+                except Exception as e:
+                    self.error = e
+            self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            raise RuntimeError("AsyncWriter: writing failed on the writer thread") from self.error
+
+    def put(self, member, state):
+        self._raise()
+        self.queue.put((member, state))
+
+    def flush(self):
+        """Wait until everything in the queue has been written"""
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
+
+
+def run_batch(init_dates, config, template, inputs, writer=None):
+    """Roll out a batch of initial conditions together, writing each one to its own file
+
+    If writer (AsyncWriter) is given, states are written in the background, otherwise
+    each step is written before the next one starts.
+    """
+
+    members = [BatchMember(d, config, template, inputs) for d in init_dates]
+    lead_time = to_timedelta(config["lead_time"])
+    model = template.model
+    device = template.device
+    checkpoint = template.checkpoint
+
+    # variables that are constant in time never get updated, see Runner.forecast
+    reset = np.full((checkpoint.number_of_input_features,), False)
+    for variable, i in checkpoint.variable_to_input_tensor_index.items():
+        if checkpoint.typed_variables[variable].is_constant_in_time:
+            reset[i] = True
+
+    with torch.inference_mode():
+        model.eval()
+
+        # (batch, multi_step_input, values, variables)
+        input_tensor = torch.from_numpy(
+            np.stack([np.swapaxes(m.input_tensor, -2, -1) for m in members])
+        ).to(device)
+
+        start = init_dates[0].to_pydatetime()
+        for s, (step, _, _, is_last_step) in enumerate(template.forecast_stepper(start, lead_time)):
+            logger.info(f"Forecasting step {step} for {len(members)} initial conditions")
+
+            amp_ctx = torch.autocast(device_type=device.type, dtype=template.autocast)
+            with amp_ctx:
+                y_pred = template.predict_step(model, input_tensor, fcstep=s, step=step)
+
+            for i, member in enumerate(members):
+                member.update_state(torch.squeeze(y_pred[i:i+1], dim=(0, 1)), step)
+                if writer is None:
+                    member.write_state()
+                else:
+                    writer.put(member, member.snapshot())
+
+            if is_last_step:
+                break
+
+            input_tensor = torch.cat([
+                member.next_input_tensor(input_tensor[i:i+1], y_pred[i:i+1], reset)
+                for i, member in enumerate(members)
+            ])
+            del y_pred
+
+    if writer is not None:
+        writer.flush()
+    for member in members:
+        member.close()
+    return [m.fname for m in members]
+
+
+def create_zarr_store(config, dates, template, inputs):
+    """Create the zarr store for output_format: zarr, with every initial condition in the config"""
+
+    checkpoint = template.checkpoint
+    step_hours = to_timedelta(checkpoint.timestep) // to_timedelta("1h")
+    fhrs = np.arange(0, config["lead_time"] + 1, step_hours)
+
+    variables = config.get("vars_of_interest", None)
+    if variables is None:
+        variables = list(checkpoint.output_tensor_index_to_variable.values())
+
+    latitudes = checkpoint.latitudes
+    longitudes = checkpoint.longitudes
+    if latitudes is None or longitudes is None:
+        state = inputs["prognostics"].create_input_state(date=dates[0].to_pydatetime())
+        latitudes = state["latitudes"]
+        longitudes = state["longitudes"]
+
+    zarr_output.create_store(
+        zarr_output.get_store_path(config),
+        config=config,
+        dates=dates,
+        fhrs=fhrs,
+        variables=variables,
+        latitudes=np.asarray(latitudes),
+        longitudes=np.asarray(longitudes),
+    )
+
+
+def main(config):
+    """Run inference over many initial conditions, in batches"""
+
+    use_mpi = config.get("use_mpi", False)
+    if use_mpi:
+        topo = MPITopology(log_dir=config.get("log_path", "eagle-logs/inference"))
+    else:
+        topo = SerialTopology()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(topo.log_handler)
+
+    config.setdefault("device", "cpu")
+    batch_size = config.get("batch_size", 4)
+    write_queue_size = config.get("write_queue_size", 2*batch_size)
+    if config.get("n_threads", None) is not None:
+        torch.set_num_threads(config["n_threads"])
+
+    dates = pd.date_range(start=config["start_date"], end=config["end_date"], freq=config["freq"])
+    local_dates = dates[topo.rank::topo.size]
+    use_zarr = config.get("output_format", "netcdf") == "zarr"
+    overwrite = config.get("overwrite_existing", False)
+    if use_zarr:
+        store_path = zarr_output.get_store_path(config)
+        new_store = overwrite or not os.path.isdir(store_path)
+        if not new_store:
+            completed = zarr_output.read_manifest(store_path)
+            local_dates = [d for d in local_dates if d.isoformat() not in completed]
+
+    elif not overwrite:
+        todo = []
+        for d in local_dates:
+            _, fname = create_anemoi_config(init_date=d, main_config=config)
+            if not os.path.isfile(fname):
+                todo.append(d)
+        local_dates = todo
+
+    logger.info(f" --- Running Batched Inference --- ")
+    logger.info(f"Initial Conditions:\n{local_dates}")
+    logger.info(f"batch_size = {batch_size}, device = {config['device']}, write_queue_size = {write_queue_size}")
+
+    logger.info("Loading model")
+    template, inputs = load_template_runner(config)
+    logger.info("Model loaded")
+
+    if use_zarr:
+        # every rank has looked at the store by now, so it's safe for root to (re)create it
+        topo.barrier()
+        if new_store and topo.is_root:
+            logger.info(f"Creating {store_path}")
+            if os.path.isfile(f"{store_path}.completed.txt"):
+                os.remove(f"{store_path}.completed.txt")
+            create_zarr_store(config, dates, template, inputs)
+        topo.barrier()
+
+    writer = AsyncWriter(maxsize=write_queue_size) if write_queue_size > 0 else None
+    try:
+        for i in range(0, len(local_dates), batch_size):
+            init_dates = local_dates[i:i+batch_size]
+            logger.info(f"Processing {[d.strftime('%Y-%m-%dT%H') for d in init_dates]}")
+            fnames = run_batch(init_dates, config, template, inputs, writer=writer)
+            for fname in fnames:
+                logger.info(f"Stored {fname}")
+    finally:
+        if writer is not None:
+            writer.close()
+
+    topo.barrier()
+    logger.info(f" --- Done ---")
+
+
+if __name__ == "__main__":
+
+    config = open_yaml_config(sys.argv[1])
+    main(config)
@@ -0,0 +1,374 @@
+"""
+Incremental version of ``eagle-tools metrics``, using the same metrics yamls.
+
+Rather than computing RMSE and MAE for every initial condition on each run,
+the weighted partial sums that go into them are stored for each initial condition
+in a local zarr store:
+
+    {output_path}/partial-sums.{model_type}/{t0:%Y-%m-%dT%H}.zarr
+
+with dims (stat, fhr, [level]) and stat = count, sum, sum_abs, sum_sq.
+On a rerun, only the initial conditions (or variables) that are missing from
+these stores are computed, and the final results come from reducing the stored sums:
+
+    {output_path}/rmse.{model_type}.nc
+    {output_path}/mae.{model_type}.nc
+    {output_path}/bias.{model_type}.nc
+
+where rmse and mae are the same as from ``eagle-tools metrics``, and bias is forecast - truth.
+The mean and standard deviation of each over all initial conditions are in
+
+    {output_path}/{rmse,mae,bias}.summary.{model_type}.nc
+
+Forecasts are read one lead time at a time, and the statistics over initial conditions
+are accumulated with Welford's algorithm, so memory stays bounded for long forecasts
+over large domains and for many initial conditions.
+
+Usage:
+    python incremental_metrics.py metrics.hrrr.validation.yaml
+"""
+import os
+import sys
+import logging
+
+import numpy as np
+import xarray as xr
+import pandas as pd
+
+from ufs2arco.transforms.horizontal_regrid import horizontal_regrid
+from ufs2arco.mpi import MPITopology, SerialTopology
+
+from eagle.tools.utils import open_yaml_config
+from eagle.tools.data import open_anemoi_dataset_with_xarray, open_anemoi_inference_dataset, open_forecast_zarr_dataset
+from eagle.tools.reshape import reshape_cell_dim
+from eagle.tools.nested import prepare_regrid_target_mask
+from eagle.tools.metrics import get_gridcell_area_weights, postprocess
+
+logger = logging.getLogger("eagle.tools")
+
+_stats = ("count", "sum", "sum_abs", "sum_sq")
+
+
+def get_sums_path(config):
+    return config.get(
+        "partial_sums_path",
+        f"{config['output_path']}/partial-sums.{config['model_type']}",
+    )
+
+
+def partial_sums(target, prediction, weights=1.):
+    """Weighted sums over the spatial dims, for each variable at each time and level
+
+    The dims that get summed are the same as what eagle.tools.metrics.rmse averages over,
+    and NaNs are skipped, so that e.g. sqrt(sum_sq / count) is exactly the rmse from there.
+    """
+    result = {}
+    dims = tuple(d for d in target.dims if d not in ("time", "level"))
+    for key in prediction.data_vars:
+        err = prediction[key] - target[key]
+        result[key] = xr.concat(
+            [
+                err.notnull().sum(dims).astype(np.float64),
+                (weights*err).sum(dims),
+                (weights*np.abs(err)).sum(dims),
+                (weights*err**2).sum(dims),
+            ],
+            dim="stat",
+        ).compute()
+
+    xds = xr.Dataset(result)
+    xds["stat"] = xr.DataArray(list(_stats), dims="stat")
+    return xds
+
+
+def open_partial_sums(path):
+    """Open one of the per t0 stores, or return None if it doesn't exist
+
+    The metadata are consolidated at the end of each write, so any variable
+    that was interrupted mid-write is not picked up here, and it will be recomputed.
+    """
+    if not os.path.isdir(path):
+        return None
+    try:
+        return xr.open_zarr(path, consolidated=True, decode_timedelta=True)
+    except (KeyError, FileNotFoundError):
+        return None
+
+
+def get_missing_variables(xds, config):
+    """Which variables in vars_of_interest still need to be computed for an initial condition
+
+    Returns:
+        missing (list or None): None means compute everything, and overwrite the store
+    """
+    if xds is None:
+        return None
+
+    levels = config.get("levels", None)
+    if levels is not None and "level" in xds.dims:
+        if not set(levels).issubset(set(xds["level"].values)):
+            return None
+
+    vars_of_interest = config.get("vars_of_interest", None)
+    if vars_of_interest is None:
+        return []
+    return [key for key in vars_of_interest if key not in xds.data_vars]
+
+
+def setup(config):
+    """Open the verification dataset and compute area weights, as in eagle.tools.metrics.main
+
+    Returns:
+        setup (dict): with everything needed to open and compare each forecast
+    """
+
+    model_type = config["model_type"]
+    subsample_kwargs = {
+        "levels": config.get("levels", None),
+        "vars_of_interest": config.get("vars_of_interest", None),
+        "lcc_info": config.get("lcc_info", None),
+    }
+    target_regrid_kwargs = config.get("target_regrid_kwargs", None)
+    forecast_regrid_kwargs = config.get("forecast_regrid_kwargs", None)
+    do_any_regridding = (target_regrid_kwargs is not None) or \
+            ((forecast_regrid_kwargs is not None) and (model_type != "nested-global"))
+
+    if model_type == "nested-global":
+        forecast_regrid_kwargs["target_grid_path"] = prepare_regrid_target_mask(
+            anemoi_reference_dataset_kwargs=config["anemoi_reference_dataset_kwargs"],
+            horizontal_regrid_kwargs=forecast_regrid_kwargs,
+        )
+
+    vds = open_anemoi_dataset_with_xarray(
+        path=config["verification_dataset_path"],
+        model_type=model_type,
+        trim_edge=config.get("trim_edge", None),
+        **subsample_kwargs,
+    )
+
+    weights = get_gridcell_area_weights(
+        vds,
+        model_type,
+        reshape_cell_to_2d=do_any_regridding,
+        regrid_kwargs=target_regrid_kwargs,
+    )
+    return {
+        "vds": vds,
+        "weights": weights,
+        "subsample_kwargs": subsample_kwargs,
+        "target_regrid_kwargs": target_regrid_kwargs,
+        "forecast_regrid_kwargs": forecast_regrid_kwargs,
+        "do_any_regridding": do_any_regridding,
+    }
+
+
+def open_forecast(t0, config, setup, variables=None):
+    """Lazily open a forecast, only with the requested variables"""
+
+    model_type = config["model_type"]
+    subsample_kwargs = setup["subsample_kwargs"].copy()
+    if variables is not None:
+        subsample_kwargs["vars_of_interest"] = variables
+
+    forecast_regrid_kwargs = setup["forecast_regrid_kwargs"]
+    if config.get("from_anemoi", True):
+        st0 = t0.strftime("%Y-%m-%dT%H")
+        fds = open_anemoi_inference_dataset(
+            f"{config['forecast_path']}/{st0}.{config['lead_time']}h.nc",
+            model_type=model_type,
+            lam_index=config.get("lam_index", None),
+            trim_edge=config.get("trim_forecast_edge", None),
+            load=False,
+            reshape_cell_to_2d=setup["do_any_regridding"],
+            horizontal_regrid_kwargs=forecast_regrid_kwargs if model_type == "nested-global" else None,
+            **subsample_kwargs,
+        )
+    else:
+        fds = open_forecast_zarr_dataset(
+            config["forecast_path"],
+            t0=t0,
+            trim_edge=config.get("trim_forecast_edge", None),
+            load=False,
+            reshape_cell_to_2d=setup["do_any_regridding"],
+            **subsample_kwargs,
+        )
+    return fds
+
+
+def open_target(times, variables, config, setup):
+    """Load the verification data at these times, on the same grid as the forecast"""
+
+    tds = setup["vds"][variables].sel(time=times).load()
+    if setup["do_any_regridding"]:
+        tds = reshape_cell_dim(tds, config["model_type"], setup["subsample_kwargs"]["lcc_info"])
+
+    if setup["target_regrid_kwargs"] is not None:
+        tds = horizontal_regrid(tds, **setup["target_regrid_kwargs"])
+    return tds
+
+
+def compute_partial_sums(t0, config, setup, variables=None):
+    """Partial sums for a single initial condition, reading one lead time at a time
+
+    Only one lead time of the forecast and verification are in memory at once,
+    so peak memory doesn't depend on the forecast length.
+    """
+
+    fds = open_forecast(t0, config, setup, variables=variables)
+    forecast_regrid_kwargs = setup["forecast_regrid_kwargs"]
+    regrid_forecast = forecast_regrid_kwargs is not None and config["model_type"] != "nested-global"
+
+    container = []
+    for time in fds.time.values:
+        fchunk = fds.sel(time=[time]).load()
+        if regrid_forecast:
+            fchunk = horizontal_regrid(fchunk, **forecast_regrid_kwargs)
+
+        tchunk = open_target([time], list(fchunk.data_vars), config, setup)
+        container.append(
+            partial_sums(target=tchunk, prediction=fchunk, weights=setup["weights"])
+        )
+
+    return postprocess(xr.concat(container, dim="time"))
+
+
+class Welford:
+    """Running mean and variance over samples of an xarray Dataset, e.g. one per initial condition
+
+    Uses Welford's update, so that the result is numerically stable and memory
+    only depends on the size of a single sample.
+    NaNs are skipped, so each point keeps its own count.
+    """
+
+    def __init__(self):
+        self.count = None
+        self.mean = None
+        self.m2 = None
+
+    def update(self, xds):
+        valid = xds.notnull()
+        xds = xds.fillna(0.)
+        if self.count is None:
+            self.count = valid.astype(np.float64)
+            self.mean = xds.where(valid, 0.)
+            self.m2 = xr.zeros_like(self.mean)
+            return
+
+        self.count = self.count + valid
+        delta = xds - self.mean
+        self.mean = self.mean + (delta / self.count.where(self.count > 0)).where(valid, 0.)
+        self.m2 = self.m2 + (delta * (xds - self.mean)).where(valid, 0.)
+
+    @property
+    def variance(self):
+        """Sample variance, NaN where there are less than 2 samples"""
+        return self.m2 / (self.count - 1).where(self.count > 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+def reduce_partial_sums(sums_path, dates):
+    """Combine the per t0 partial sums into rmse, mae, and bias
+
+    Each store is opened lazily, and the statistics over all initial conditions are
+    accumulated one t0 at a time, so memory doesn't depend on the number of initial conditions.
+
+    Returns:
+        result (dict): with lazy rmse, mae, and bias, each with a t0 dim
+        summary (dict): mean and standard deviation of rmse, mae, and bias over all initial conditions,
+            along a new "moment" dim
+    """
+
+    container = []
+    for t0 in dates:
+        xds = open_partial_sums(f"{sums_path}/{t0.strftime('%Y-%m-%dT%H')}.zarr")
+        if xds is None:
+            logger.warning(f"reduce_partial_sums: missing {t0}, skipping it")
+            continue
+        container.append(xds)
+
+    xds = xr.concat(container, dim="t0")
+    count = xds.sel(stat="count", drop=True)
+    result = {
+        "rmse": np.sqrt(xds.sel(stat="sum_sq", drop=True) / count),
+        "mae": xds.sel(stat="sum_abs", drop=True) / count,
+        "bias": xds.sel(stat="sum", drop=True) / count,
+    }
+
+    accumulators = {key: Welford() for key in result.keys()}
+    for ii in range(len(xds["t0"])):
+        for key, xda in result.items():
+            accumulators[key].update(xda.isel(t0=ii, drop=True).load())
+
+    summary = {}
+    for key, acc in accumulators.items():
+        summary[key] = xr.concat([acc.mean, acc.std], dim="moment")
+        summary[key]["moment"] = xr.DataArray(["mean", "std"], dims="moment")
+    return result, summary
+
+
+def main(config):
+
+    use_mpi = config.get("use_mpi", False)
+    if use_mpi:
+        topo = MPITopology(log_dir=config.get("log_path", "eagle-logs/metrics"))
+    else:
+        topo = SerialTopology()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(topo.log_handler)
+
+    sums_path = get_sums_path(config)
+    if topo.is_root and not os.path.isdir(sums_path):
+        os.makedirs(sums_path)
+    topo.barrier()
+
+    dates = pd.date_range(config["start_date"], config["end_date"], freq=config["freq"])
+
+    # figure out what's left to do, everyone gets the same answer
+    todo = []
+    for t0 in dates:
+        path = f"{sums_path}/{t0.strftime('%Y-%m-%dT%H')}.zarr"
+        missing = get_missing_variables(open_partial_sums(path), config)
+        if missing is None or len(missing) > 0:
+            todo.append((t0, missing))
+
+    logger.info(f" --- Computing Partial Sums for Error Metrics --- ")
+    logger.info(f"{len(dates) - len(todo)} / {len(dates)} initial conditions already done")
+
+    if len(todo) > 0:
+        state = setup(config)
+
+    for t0, missing in todo[topo.rank::topo.size]:
+
+        st0 = t0.strftime("%Y-%m-%dT%H")
+        path = f"{sums_path}/{st0}.zarr"
+        logger.info(f"Processing {st0}, variables = {'all' if missing is None else missing}")
+
+        xds = compute_partial_sums(t0, config, state, variables=missing)
+        xds.to_zarr(path, mode="w" if missing is None else "a", consolidated=True)
+        logger.info(f"Done with {st0}")
+
+    logger.info(f" --- Done Computing Partial Sums --- \n")
+    topo.barrier()
+
+    if topo.is_root:
+        logger.info(f" --- Reducing & Storing Results --- ")
+        result, summary = reduce_partial_sums(sums_path, dates)
+        for varname, xds in result.items():
+            fname = f"{config['output_path']}/{varname}.{config['model_type']}.nc"
+            xds.to_netcdf(fname)
+            logger.info(f"Stored result: {fname}")
+
+            fname = f"{config['output_path']}/{varname}.summary.{config['model_type']}.nc"
+            summary[varname].to_netcdf(fname)
+            logger.info(f"Stored result: {fname}")
+
+        logger.info(f" --- Done Storing Error Metrics --- \n")
+
+
+if __name__ == "__main__":
+
+    config = open_yaml_config(sys.argv[1])
+    main(config)
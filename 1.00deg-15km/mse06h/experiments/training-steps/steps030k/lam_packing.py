@@ -0,0 +1,148 @@
+"""
+Pack the LAM portion of anemoi style output, with a flattened "values" dimension,
+back onto its 2D (y, x) grid.
+
+The grid is defined by the same fields used in the eagle yamls:
+
+    lam_index: 64220        # number of LAM points at the start of "values" in nested output
+    lcc_info:               # LAM shape, after trim_edge has been applied
+      n_x: 338
+      n_y: 190
+
+Everything here is lazy, so variables are read and reshaped one dask chunk at a time
+when they get written, rather than loading whole files.
+"""
+import os
+import yaml
+
+import numpy as np
+import xarray as xr
+
+
+def read_config(config_path):
+    """Read a yaml, expanding environment variables like ${SCRATCH} in any strings"""
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+
+    def expand(item):
+        if isinstance(item, str):
+            return os.path.expandvars(item)
+        elif isinstance(item, dict):
+            return {key: expand(val) for key, val in item.items()}
+        elif isinstance(item, list):
+            return [expand(val) for val in item]
+        return item
+
+    return expand(config)
+
+
+def get_lam_shape(config):
+    """Get the (n_y, n_x) LAM shape from the lcc_info section of a config
+
+    If lam_index is in the config, check that it's consistent with the shape.
+    """
+    try:
+        n_y = config["lcc_info"]["n_y"]
+        n_x = config["lcc_info"]["n_x"]
+    except KeyError:
+        raise KeyError("get_lam_shape: need lcc_info with n_x and n_y in the config")
+
+    lam_index = config.get("lam_index", None)
+    if lam_index is not None and lam_index != n_y * n_x:
+        raise ValueError(
+            f"get_lam_shape: lam_index = {lam_index} doesn't match lcc_info n_y x n_x = {n_y} x {n_x}"
+        )
+    return n_y, n_x
+
+
+def pack_lam(xds, n_y, n_x, lam_index=None):
+    """Reshape everything along "values" to (y, x)
+
+    Args:
+        xds (xr.Dataset): with latitude/longitude as coordinates, and all data_vars with a "values" dim.
+            If the data are dask arrays, they stay lazy.
+        n_y, n_x (int): LAM shape
+        lam_index (int, optional): if given, the first lam_index points along "values" are the LAM,
+            as in nested output. This is a no-op for output that only contains the LAM.
+            If not given, xds is assumed to contain only the LAM.
+
+    Returns:
+        nds (xr.Dataset): with dims (..., y, x)
+    """
+    if lam_index is not None:
+        xds = xds.isel(values=slice(None, lam_index))
+
+    if len(xds["values"]) != n_y * n_x:
+        raise ValueError(
+            f"pack_lam: can't reshape {len(xds['values'])} points to (n_y, n_x) = ({n_y}, {n_x})"
+        )
+
+    nds = xr.Dataset(attrs=xds.attrs.copy())
+    for key in xds.dims:
+        if key != "values" and key in xds.coords:
+            nds[key] = xds[key]
+    nds["y"] = xr.DataArray(
+        np.arange(n_y),
+        coords={"y": np.arange(n_y)},
+    )
+    nds["x"] = xr.DataArray(
+        np.arange(n_x),
+        coords={"x": np.arange(n_x)},
+    )
+    for key in ["latitude", "longitude"]:
+        nds[key] = xr.DataArray(
+            xds[key].values.reshape((n_y, n_x)),
+            dims=("y", "x"),
+        )
+
+    for key in xds.data_vars:
+        xda = xds[key]
+        dims = tuple(d for d in xda.dims if d != "values")
+        xda = xda.transpose(*dims, "values")
+        # with dask, this is only lazy and cheap when "values" is a single chunk,
+        # which is what open_lam_dataset sets up
+        nds[key] = xr.DataArray(
+            xda.data.reshape(xda.shape[:-1] + (n_y, n_x)),
+            dims=dims + ("y", "x"),
+            attrs=xda.attrs.copy(),
+        )
+    nds = nds.set_coords(["latitude", "longitude"])
+    return nds
+
+
+def open_lam_dataset(path, n_y, n_x, lam_index=None, variables=None, **kwargs):
+    """Lazily open an inference output netcdf and pack the LAM onto (y, x)
+
+    Args:
+        path (str): to netcdf file
+        n_y, n_x (int): LAM shape
+        lam_index (int, optional): see pack_lam
+        variables (list, optional): only pack these variables, default is all of them
+        **kwargs: passed to xr.open_dataset
+
+    Returns:
+        xds (xr.Dataset): lazy, with one dask chunk per time step
+    """
+    kwargs.setdefault("decode_timedelta", True)
+    xds = xr.open_dataset(
+        path,
+        chunks={"time": 1, "values": -1},
+        **kwargs,
+    )
+    xds = xds.set_coords(["latitude", "longitude"])
+    if variables is not None:
+        xds = xds[variables]
+    return pack_lam(xds, n_y=n_y, n_x=n_x, lam_index=lam_index)
+
+
+def open_lam_from_config(path, config, variables=None, **kwargs):
+    """Same as open_lam_dataset, but the grid comes from an eagle style config"""
+    n_y, n_x = get_lam_shape(config)
+    return open_lam_dataset(
+        path,
+        n_y=n_y,
+        n_x=n_x,
+        lam_index=config.get("lam_index", None),
+        variables=variables,
+        **kwargs,
+    )
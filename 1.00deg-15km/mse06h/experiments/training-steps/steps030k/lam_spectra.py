@@ -0,0 +1,230 @@
+"""
+Radially averaged power spectra on the LAM (y, x) grid, computed directly with 2D FFTs.
+
+Unlike eagle.tools.spectra, there is no interpolation to a regular lat/lon grid,
+the LAM is treated as a regular grid with spacing dx, and everything in a
+(..., y, x) block, e.g. (time, level, y, x), gets windowed and transformed with a single FFT call.
+The radial bin assignment only depends on the grid, so it's computed once per grid and cached.
+
+Usage, with sharded_spectra.py, set the following in the spectra yaml:
+
+    spectra_engine: lcc_fft
+    dx_km: 15               # optional, grid spacing, only used to label wavelength
+    spectra_window: hann    # optional, "hann" or None, default "hann"
+    spectra_detrend: linear # optional, "mean", "linear", or None, default "linear"
+    spectra_dtype: float32  # optional, default float64
+
+and to check throughput:
+
+    python lam_spectra.py --n-y 480 --n-x 848 --batch 64 --dtype float32
+"""
+import time
+import argparse
+
+import numpy as np
+import xarray as xr
+import scipy.fft
+import scipy.sparse
+
+# caches, keyed by grid shape (and dtype, window, etc)
+_radial_bins = {}
+_windows = {}
+_detrend_operators = {}
+
+
+def get_radial_bins(n_y, n_x):
+    """Assign each point of an rfft2 output to a radial wavenumber bin
+
+    The bin width is the fundamental wavenumber of the longer side, so
+    bin k corresponds to a wavelength of max(n_y, n_x) / k grid points,
+    and bins go up to the 2dx Nyquist wavenumber, k = max(n_y, n_x) // 2.
+    The corners of the 2D spectrum, with a radial wavenumber beyond Nyquist, are not binned.
+
+    Returns:
+        bins (dict): with
+            "operator": sparse (n_y * (n_x//2+1), n_k) matrix that sums power into each bin
+            "k": wavenumber index, 0 ... n_k-1
+            "wavelength": in grid points
+    """
+    key = (n_y, n_x)
+    if key not in _radial_bins:
+        n_max = max(n_y, n_x)
+        ky = np.fft.fftfreq(n_y) * n_max
+        kx = np.fft.rfftfreq(n_x) * n_max
+        kr = np.sqrt(ky[:, None]**2 + kx[None, :]**2)
+
+        n_k = n_max // 2 + 1
+        k_index = np.rint(kr).astype(int).ravel()
+        valid = k_index < n_k
+
+        # rfft only keeps half the spectrum in x, so double all of the columns that
+        # have a conjugate pair that was dropped, i.e. all except x=0 and the x Nyquist for even n_x
+        weight = np.full(kr.shape, 2.0)
+        weight[:, 0] = 1.0
+        if n_x % 2 == 0:
+            weight[:, -1] = 1.0
+        weight = weight.ravel()
+
+        operator = scipy.sparse.csr_matrix(
+            (weight[valid], (np.flatnonzero(valid), k_index[valid])),
+            shape=(kr.size, n_k),
+        )
+        k = np.arange(n_k)
+        with np.errstate(divide="ignore"):
+            wavelength = n_max / k
+        _radial_bins[key] = {
+            "operator": operator,
+            "k": k,
+            "wavelength": wavelength,
+        }
+    return _radial_bins[key]
+
+
+def get_window(n_y, n_x, window="hann", dtype=np.float64):
+    """2D separable window, normalized so the mean of window**2 is 1, cached"""
+    key = (n_y, n_x, window, np.dtype(dtype).name)
+    if key not in _windows:
+        if window is None:
+            w2d = np.ones((n_y, n_x))
+        elif window == "hann":
+            w2d = np.outer(np.hanning(n_y), np.hanning(n_x))
+        else:
+            raise NotImplementedError(f"get_window: window = {window} not implemented, use 'hann' or None")
+        w2d /= np.sqrt(np.mean(w2d**2))
+        _windows[key] = w2d.astype(dtype)
+    return _windows[key]
+
+
+def get_detrend_operator(n_y, n_x, dtype=np.float64):
+    """Least squares operator to remove a plane a + b*x + c*y from each field, cached
+
+    Returns:
+        basis (n_y*n_x, 3), pinv (3, n_y*n_x): so the fitted plane is basis @ (pinv @ field)
+    """
+    key = (n_y, n_x, np.dtype(dtype).name)
+    if key not in _detrend_operators:
+        y, x = np.meshgrid(np.arange(n_y), np.arange(n_x), indexing="ij")
+        basis = np.stack([np.ones(n_y*n_x), x.ravel(), y.ravel()], axis=-1)
+        _detrend_operators[key] = (basis.astype(dtype), np.linalg.pinv(basis).astype(dtype))
+    return _detrend_operators[key]
+
+
+def radial_power_spectra(data, window="hann", detrend="linear", dtype=np.float64, workers=-1):
+    """Radially binned power spectra of a stack of 2D fields
+
+    Args:
+        data (array_like): with shape (..., n_y, n_x), e.g. (time, fhr, level, y, x), no NaNs
+        window (str, optional): "hann" or None
+        detrend (str, optional): "mean", "linear", or None
+        dtype (type, optional): np.float32 halves memory and is faster, np.float64 is the default
+        workers (int, optional): threads used by scipy.fft, -1 means all cores
+
+    Returns:
+        power (np.ndarray): with shape (..., n_k), normalized so that summing over k
+            gives the mean of the squared (detrended, windowed) field,
+            apart from the power in the corners of the 2D spectrum beyond the radial Nyquist wavenumber
+    """
+    data = np.asarray(data, dtype=dtype)
+    *lead_shape, n_y, n_x = data.shape
+    fields = data.reshape(-1, n_y*n_x)
+
+    if detrend == "mean":
+        fields = fields - fields.mean(axis=-1, keepdims=True)
+    elif detrend == "linear":
+        basis, pinv = get_detrend_operator(n_y, n_x, dtype=dtype)
+        fields = fields - (fields @ pinv.T) @ basis.T
+    elif detrend is not None:
+        raise NotImplementedError(f"radial_power_spectra: detrend = {detrend} not implemented, use 'mean', 'linear', or None")
+
+    fields = fields.reshape(-1, n_y, n_x)
+    if window is not None:
+        fields = fields * get_window(n_y, n_x, window=window, dtype=dtype)
+
+    spectrum = scipy.fft.rfft2(fields, axes=(-2, -1), workers=workers)
+    power = (spectrum.real**2 + spectrum.imag**2).reshape(len(fields), -1)
+    power /= (n_y*n_x)**2
+
+    bins = get_radial_bins(n_y, n_x)
+    power = bins["operator"].T.dot(power.T).T.astype(dtype, copy=False)
+    return power.reshape(tuple(lead_shape) + (len(bins["k"]),))
+
+
+def radial_spectra(xda, dx=None, **kwargs):
+    """Same as radial_power_spectra, but for an xarray DataArray with (y, x) as its last dims
+
+    Args:
+        xda (xr.DataArray): with dims (..., y, x)
+        dx (float, optional): grid spacing, if given wavelength is in these units, otherwise grid points
+        **kwargs: passed to radial_power_spectra
+
+    Returns:
+        xda (xr.DataArray): with dims (..., k)
+    """
+    xda = xda.transpose(..., "y", "x")
+    lead_dims = xda.dims[:-2]
+    power = radial_power_spectra(xda.values, **kwargs)
+
+    bins = get_radial_bins(len(xda["y"]), len(xda["x"]))
+    wavelength = bins["wavelength"] if dx is None else bins["wavelength"] * dx
+    coords = {key: xda[key] for key in lead_dims if key in xda.coords}
+    coords["k"] = bins["k"]
+    result = xr.DataArray(
+        power,
+        coords=coords,
+        dims=lead_dims + ("k",),
+        attrs=xda.attrs.copy(),
+    )
+    result["wavelength"] = xr.DataArray(wavelength, coords={"k": bins["k"]})
+    result = result.assign_coords(wavelength=result["wavelength"])
+    return result
+
+
+def compute_power_spectrum(xds, dx=None, **kwargs):
+    """Radial spectra of every variable in a Dataset with dims (..., y, x)"""
+    return xr.Dataset({key: radial_spectra(xds[key], dx=dx, **kwargs) for key in xds.data_vars})
+
+
+def kinetic_energy_spectrum(u, v, dx=None, **kwargs):
+    """0.5 * (|U|^2 + |V|^2), e.g. from u/v or u10/v10 DataArrays with dims (..., y, x)"""
+    return 0.5 * (radial_spectra(u, dx=dx, **kwargs) + radial_spectra(v, dx=dx, **kwargs))
+
+
+def benchmark(n_y, n_x, batch=64, dtype=np.float64, n_repeat=5, **kwargs):
+    """Time radial_power_spectra on random fields, and print the throughput in fields per second"""
+
+    data = np.random.default_rng(0).normal(size=(batch, n_y, n_x)).astype(dtype)
+
+    # first call fills the caches
+    t0 = time.perf_counter()
+    radial_power_spectra(data, dtype=dtype, **kwargs)
+    first = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for _ in range(n_repeat):
+        radial_power_spectra(data, dtype=dtype, **kwargs)
+    elapsed = (time.perf_counter() - t0) / n_repeat
+
+    print(f"grid = ({n_y}, {n_x}), batch = {batch}, dtype = {np.dtype(dtype).name}")
+    print(f"    first call (with caching): {first:.3f} s")
+    print(f"    per batch: {elapsed:.3f} s")
+    print(f"    throughput: {batch / elapsed:.1f} fields / s")
+    return batch / elapsed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark radial_power_spectra")
+    parser.add_argument("--n-y", type=int, default=190)
+    parser.add_argument("--n-x", type=int, default=338)
+    parser.add_argument("--batch", type=int, default=64, help="number of fields per FFT call")
+    parser.add_argument("--dtype", default="float64", choices=["float32", "float64"])
+    parser.add_argument("--n-repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    benchmark(
+        n_y=args.n_y,
+        n_x=args.n_x,
+        batch=args.batch,
+        dtype=np.dtype(args.dtype).type,
+        n_repeat=args.n_repeat,
+    )
@@ -1,5 +1,8 @@
+import os
 import sys
+import glob
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import xarray as xr
@@ -9,52 +12,21 @@ import dask.array
 sys.path.append("/global/homes/t/timothys/nested-eagle/")
 from eagle.log import setup_simple_log
 
+from lam_packing import read_config, open_lam_from_config
+
 logger = logging.getLogger("eagle")
 
-_n_y = 211 - 10 - 11
-_n_x = 359 - 10 - 11
+_config_path = "postprocess.precip.yaml"
 
-def reshape_dataset(xds):
 
-    nds = xr.Dataset()
-    nds["time"] = xds.time
-    nds["y"] = xr.DataArray(
-        np.arange(_n_y),
-        coords={"y": np.arange(_n_y)},
-    )
-    nds["x"] = xr.DataArray(
-        np.arange(_n_x),
-        coords={"x": np.arange(_n_x)},
-    )
-    nds["latitude"] = xr.DataArray(
-        xds.latitude.values.reshape((_n_y, _n_x)),
-        dims=("y", "x"),
-    )
-    nds["longitude"] = xr.DataArray(
-        xds.longitude.values.reshape((_n_y, _n_x)),
-        dims=("y", "x"),
-    )
-    for key in xds.data_vars:
-        nds[key] = xr.DataArray(
-            xds[key].values.reshape((len(xds.time),_n_y,_n_x)),
-            dims=("time", "y", "x"),
-        )
-    nds = nds.set_coords(["latitude", "longitude"])
-    return nds
-
-
-def open_dataset(t0: pd.Timestamp):
+def open_dataset(t0: pd.Timestamp, config: dict):
 
     st0 = t0.strftime("%Y-%m-%dT%H")
-    data_dir = "/pscratch/sd/t/timothys/nested-eagle/1.00deg-15km/mse06h/experiments/training-steps/steps030k/inference-precip"
-    xds = xr.open_dataset(
-        f"{data_dir}/{st0}.48h.lam.nc",
-        decode_timedelta=True,
-        chunks="auto",
+    xds = open_lam_from_config(
+        f"{config['forecast_path']}/{st0}.{config['lead_time']}h.lam.nc",
+        config=config,
+        variables=config["vars_of_interest"],
     )
-    xds = xds.set_coords(["latitude", "longitude"])
-    xds = xds[["accum_tp"]].load()
-    xds = reshape_dataset(xds)
 
 
     lead_time = xds["time"] - xds["time"][0]
@@ -111,32 +83,103 @@ def create_container(xds, t0):
     return nds
 
 
-if __name__ == "__main__":
+def get_region(xds, t0_index):
+    """Region of the container that xds gets written to
 
-    setup_simple_log()
-    store_path = "/pscratch/sd/t/timothys/nested-eagle/1.00deg-15km/mse06h/experiments/training-steps/steps030k/inference-precip/nested-eagle.conus15km.precip.zarr"
+    Args:
+        xds (xr.Dataset): output from open_dataset
+        t0_index (dict): mapping from each t0 (as pd.Timestamp) to its index in the container
 
+    Returns:
+        region (dict): to pass to xds.to_zarr
+    """
+    region = {}
+    for key in xds.dims:
+        if key in ("fhr", "y", "x"):
+            region[key] = slice(None, None)
+        elif key in ("t0",):
+            indices = [t0_index[pd.Timestamp(value)] for value in xds[key].values]
+            region[key] = slice(indices[0], indices[-1]+1)
+        else:
+            raise KeyError("Unrecognized dimension name")
+    return region
+
+
+def read_checkpoint(checkpoint_dir):
+    """All t0s that have been written, from every worker's checkpoint file"""
+    completed = set()
+    for fname in glob.glob(f"{checkpoint_dir}/completed.*.txt"):
+        with open(fname, "r") as f:
+            completed.update(pd.Timestamp(line.strip()) for line in f if line.strip())
+    return completed
+
+
+def fill_slice(t0_slice, t0_index, config, checkpoint_dir, worker=0):
+    """Open, reshape, and write each t0 in t0_slice to its region of the container
+
+    Each worker owns a disjoint set of t0s, and since the container has t0 chunks of 1
+    none of the workers touch the same zarr chunk.
+    Finished t0s are recorded in this worker's own checkpoint file.
+    Variables are read lazily, so each one is streamed one fhr at a time.
+    """
+    store_path = config["output_path"]
+    checkpoint_path = f"{checkpoint_dir}/completed.{worker:03d}.txt"
+    for t0 in t0_slice:
+        xds = open_dataset(t0, config)
+        region = get_region(xds, t0_index)
+        xds.to_zarr(store_path, region=region)
+        with open(checkpoint_path, "a") as f:
+            f.write(f"{t0.isoformat()}\n")
+        logger.info(f"Done with {t0}")
+
+
+def main(config, n_workers=1):
+    """Write every t0 into a zarr store at output_path, with n_workers processes
+
+    Each worker records the t0s it finishes in {output_path}.checkpoint/completed.NNN.txt,
+    and rerunning after a crash only does the t0s that aren't in any of them.
+    """
+    store_path = config["output_path"]
+    checkpoint_dir = f"{store_path}.checkpoint"
+
+    all_t0 = pd.date_range(config["start_date"], config["end_date"], freq=config["freq"])
+    t0_index = {t0: i for i, t0 in enumerate(all_t0)}
 
-    all_t0 = pd.date_range("2023-02-01T00", "2024-01-30T00", freq="6h")
+    # create a container, unless we're restarting
+    completed = read_checkpoint(checkpoint_dir) if os.path.isdir(store_path) else set()
+    if len(completed) == 0:
+        template = open_dataset(all_t0[0], config)
+        container = create_container(template, all_t0)
+        container.to_zarr(store_path, compute=False, mode="w")
+        for fname in glob.glob(f"{checkpoint_dir}/completed.*.txt"):
+            os.remove(fname)
+        logger.info(f"Created Container at {store_path}")
+    else:
+        logger.info(f"Restarting with {len(completed)} / {len(all_t0)} t0s already done")
 
-    # create a container
-    template = open_dataset(all_t0[0])
-    container = create_container(template, all_t0)
-    container.to_zarr(store_path, compute=False, mode="w")
-    logger.info(f"Created Container at {store_path}")
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    todo = [t0 for t0 in all_t0 if t0 not in completed]
 
     # loop and fill region
-    for t0 in all_t0:
-        xds = open_dataset(t0)
-        region = {}
-        for key in xds.dims:
-            if key in ("fhr", "y", "x"):
-                region[key] = slice(None, None)
-            elif key in ("t0",):
-                indices = [list(container[key].values).index(value) for value in xds[key].values]
-                region[key] = slice(indices[0], indices[-1]+1)
-            else:
-                raise KeyError("Unrecognized dimension name")
+    if n_workers == 1:
+        fill_slice(todo, t0_index, config, checkpoint_dir)
+
+    else:
+        slices = [list(x) for x in np.array_split(np.array(todo, dtype=object), n_workers)]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(fill_slice, t0_slice, t0_index, config, checkpoint_dir, worker)
+                for worker, t0_slice in enumerate(slices)
+                if len(t0_slice) > 0
+            ]
+            for future in futures:
+                future.result()
+        logger.info(f"Done filling {store_path} with {n_workers} workers")
 
-        xds.to_zarr(store_path, region=region)
-        logger.info(f"Done with {t0}")
+
+if __name__ == "__main__":
+
+    setup_simple_log()
+    config = read_config(_config_path)
+    n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    main(config, n_workers=n_workers)
@@ -0,0 +1,184 @@
+"""
+Run wxvx grids and stats for every cycle in a config, replacing
+write_wxvx_cycles.py + parallel_wxvx.sh + GNU parallel.
+
+Per cycle configs are made in memory from the base config, and each cycle runs
+grids -> stats as a pipeline on a bounded pool of workers, so one cycle's stats can
+run while another's grids are being made.
+The status of each stage is kept in <cycles_dir>/status.json, along with the error for
+any stage that failed, and on a rerun only cycles that didn't finish (e.g. failed ones) are run again.
+
+Usage:
+    python run_wxvx_cycles.py wxvx.hrrr.validation.yaml -n 128
+    python run_wxvx_cycles.py wxvx.hrrr.validation.yaml -n 128 --fetch-obs
+"""
+import os
+import copy
+import json
+import argparse
+import threading
+import subprocess
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import yaml
+
+
+_stages = ("grids", "stats")
+
+
+def get_cycles(base_config):
+    """List of datetimes from the start/stop/step in the 'cycles' section"""
+    cycle_info = base_config.get("cycles", {})
+    start_date = cycle_info.get("start")
+    end_date = cycle_info.get("stop")
+    step_hours = cycle_info.get("step")
+
+    if not all([start_date, end_date, isinstance(step_hours, int)]):
+        raise ValueError("'cycles' section must contain 'start', 'stop', and 'step' (as an integer).")
+
+    if not isinstance(start_date, datetime):
+        start_date = datetime.fromisoformat(start_date)
+        end_date = datetime.fromisoformat(end_date)
+
+    dates = []
+    current_date = start_date
+    while current_date <= end_date:
+        dates.append(current_date)
+        current_date += timedelta(hours=step_hours)
+    return dates
+
+
+def make_cycle_config(base_config, date_obj):
+    """Copy of base_config that only runs for one cycle"""
+    new_config = copy.deepcopy(base_config)
+    new_config["cycles"] = [date_obj.strftime("%Y-%m-%dT%H:%M:%S")]
+    return new_config
+
+
+class CycleStatus:
+    """Thread safe record of which stages are done for each cycle, stored as json"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.status = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self.status = json.load(f)
+
+    def get(self, cycle, stage):
+        return self.status.get(cycle, {}).get(stage, None)
+
+    def set(self, cycle, stage, value, error=None):
+        """Set a stage's status, and its error (as "<stage>_error"), which is cleared when there is none"""
+        with self.lock:
+            entry = self.status.setdefault(cycle, {})
+            entry[stage] = value
+            if error is None:
+                entry.pop(f"{stage}_error", None)
+            else:
+                entry[f"{stage}_error"] = error
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.status, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    def is_done(self, cycle):
+        return all(self.get(cycle, stage) == "done" for stage in _stages)
+
+
+def run_cycle(date_obj, base_config, config_name, cycles_dir, status):
+    """Run grids then stats for a single cycle, skipping any stage that already finished
+
+    wxvx needs a config file, so the in memory cycle config is written once,
+    right before it's needed.
+    """
+    cycle = date_obj.strftime("%Y%m%dT%H%M%S")
+    yamlfile = os.path.join(cycles_dir, f"{cycle}.{config_name}")
+    with open(yamlfile, "w") as f:
+        yaml.dump(make_cycle_config(base_config, date_obj), f, default_flow_style=False, sort_keys=False)
+
+    for stage in _stages:
+        if status.get(cycle, stage) == "done":
+            continue
+
+        status.set(cycle, stage, "running")
+        try:
+            with open(os.path.join(cycles_dir, f"log.wxvx.{stage}.{cycle}"), "w") as log:
+                result = subprocess.run(
+                    ["wxvx", "-c", yamlfile, "-t", stage],
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                )
+        except OSError as e:
+            # e.g. wxvx isn't on the PATH
+            status.set(cycle, stage, "failed", error=repr(e))
+            return cycle, False
+
+        if result.returncode != 0:
+            status.set(cycle, stage, "failed", error=f"wxvx exited with {result.returncode}, see the log")
+            return cycle, False
+
+        status.set(cycle, stage, "done")
+    return cycle, True
+
+
+def main(config_path, n_workers, cycles_dir="cycles-wxvx", fetch_obs=False, n_obs_threads=10):
+
+    with open(config_path, "r") as f:
+        base_config = yaml.safe_load(f)
+
+    os.makedirs(cycles_dir, exist_ok=True)
+    status = CycleStatus(os.path.join(cycles_dir, "status.json"))
+
+    # obs are shared by all cycles, so these are only pulled once, with the full config
+    # note that 10 threads is the default "connection pool limit"
+    if fetch_obs:
+        print("Pulling obs for all cycles")
+        with open(os.path.join(cycles_dir, "log.wxvx.obs"), "w") as log:
+            subprocess.run(
+                ["wxvx", "-c", config_path, "-t", "obs", "-n", str(n_obs_threads)],
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                check=True,
+            )
+
+    dates = get_cycles(base_config)
+    todo = [d for d in dates if not status.is_done(d.strftime("%Y%m%dT%H%M%S"))]
+    print(f"{len(dates) - len(todo)} / {len(dates)} cycles already done, running {len(todo)} with {n_workers} workers")
+
+    config_name = os.path.basename(config_path)
+    failed = []
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(run_cycle, d, base_config, config_name, cycles_dir, status)
+            for d in todo
+        ]
+        for future in as_completed(futures):
+            cycle, success = future.result()
+            print(f"-> {'Finished' if success else 'FAILED'} {cycle}")
+            if not success:
+                failed.append(cycle)
+
+    if failed:
+        print(f"\n{len(failed)} cycles failed, rerun to retry just these: {sorted(failed)}")
+    else:
+        print("\nProcessing complete.")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run wxvx grids and stats for all cycles in a config")
+    parser.add_argument("config_path", help="base wxvx config, with a cycles section with start, stop, step")
+    parser.add_argument("-n", "--n-workers", type=int, default=os.cpu_count(), help="number of cycles to run at once")
+    parser.add_argument("--cycles-dir", default="cycles-wxvx", help="where cycle configs, logs, and status.json go")
+    parser.add_argument("--fetch-obs", action="store_true", help="pull obs for all cycles first, with 'wxvx -t obs'")
+    args = parser.parse_args()
+
+    main(
+        config_path=args.config_path,
+        n_workers=args.n_workers,
+        cycles_dir=args.cycles_dir,
+        fetch_obs=args.fetch_obs,
+    )
@@ -0,0 +1,302 @@
+"""
+Sharded version of ``eagle-tools spectra``, using the same spectra yamls.
+
+Initial conditions are split across local processes, or across MPI ranks with
+``use_mpi: True``, and the power spectrum of each initial condition is gathered on
+the root process and averaged in date order, so that the result is identical to the serial path.
+The result is stored in the same place:
+
+    {output_path}/spectra.predictions.{model_type}.nc
+
+Config options, in addition to the ones used by ``eagle-tools spectra``:
+
+    n_workers: 8                # number of local processes, ignored with use_mpi, default 1
+    spectra_batch_size: 32      # optional, number of fields interpolated to the regular grid at once, default 32
+    spectra_engine: lcc_fft     # optional, use the batched FFT spectra in lam_spectra.py
+                                # on the (y, x) LAM grid, see there for more options
+
+By default the spectra are the same as eagle.tools.spectra, where each field is interpolated
+to a regular grid with scipy's griddata and expanded in spherical harmonics.
+Here the Delaunay triangulation behind griddata is computed once per grid instead of once per field,
+and all variables, levels, and times are interpolated together, spectra_batch_size fields at a time.
+The spherical harmonic expansion is still done one field at a time, since anemoi's compute_spectra takes a single 2D field.
+
+Usage:
+    python sharded_spectra.py spectra.hrrr.validation.yaml
+    python sharded_spectra.py spectra.hrrr.validation.yaml 8     # n_workers from the command line
+    srun -n 32 python sharded_spectra.py spectra.hrrr.validation.yaml  # with use_mpi: True
+"""
+import sys
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy.spatial import Delaunay
+from scipy.interpolate import CloughTocher2DInterpolator, LinearNDInterpolator
+
+from anemoi.training.diagnostics.plots import compute_spectra as compute_array_spectra
+from ufs2arco.mpi import MPITopology, SerialTopology
+
+from eagle.tools.utils import open_yaml_config
+from eagle.tools.data import open_anemoi_inference_dataset, open_forecast_zarr_dataset
+from eagle.tools.nested import prepare_regrid_target_mask
+from eagle.tools.spectra import get_regular_grid
+from eagle.tools.metrics import postprocess
+
+import lam_spectra
+
+logger = logging.getLogger("eagle.tools")
+
+# the regular grid only depends on lat/lon, so each process only computes it once
+_grid = None
+
+
+def get_fhr_select(config):
+    """fhr_select from the config as a list, or None to keep all forecast hours"""
+    fhr_select = config.get("fhr_select", None)
+    if fhr_select is not None and not isinstance(fhr_select, (list, tuple)):
+        fhr_select = [fhr_select]
+    return fhr_select
+
+
+def select_fhr(fds, fhr_select):
+    """Subsample forecast hours, same as in eagle.tools.spectra.main
+
+    As there, postprocess then counts fhr and lead_time from the first selected forecast hour.
+    """
+    if fhr_select is None:
+        return fds
+
+    time_select = [
+        fds["time"].values[0] + pd.Timedelta(hours=fhr)
+        for fhr in fhr_select
+    ]
+    return fds.sel(time=time_select)
+
+
+def get_grid(fds, min_delta):
+    """The regular grid from eagle.tools.spectra.get_regular_grid, plus the triangulation that griddata would compute"""
+    grid = get_regular_grid(fds, min_delta=min_delta)
+    grid["triangulation"] = Delaunay(np.column_stack([grid["lon"], grid["lat"]]))
+    return grid
+
+
+def interpolate_fields(fields, grid, method):
+    """Same as scipy's griddata with fill_value=0, for many fields at once, reusing the grid's triangulation
+
+    Args:
+        fields (np.ndarray): with shape (n_points, n_fields)
+        grid (dict): from get_grid
+        method (str): "cubic" or "linear"
+
+    Returns:
+        interpolated (np.ndarray): with shape (n_pix_lat, n_pix_lon, n_fields)
+    """
+    Interpolator = CloughTocher2DInterpolator if method == "cubic" else LinearNDInterpolator
+    interpolator = Interpolator(grid["triangulation"], fields, fill_value=0.0)
+    return interpolator((grid["mesh_lon"], grid["mesh_lat"]))
+
+
+def compute_power_spectrum(xds, grid, batch_size=32):
+    """Same result as eagle.tools.spectra.compute_power_spectrum, batched over variables, levels, and times
+
+    As there, fields without NaNs are interpolated with "cubic", fields with NaNs with "linear",
+    and NaNs left after interpolation are set to 0.
+
+    Args:
+        xds (xr.Dataset): with time and the spatial dims of latitude
+        grid (dict): from get_grid
+        batch_size (int, optional): number of fields to interpolate at once
+
+    Returns:
+        pspectra (xr.Dataset): with dims (fhr, ..., k), from postprocess
+    """
+    spatial_dims = xds["latitude"].dims
+    n_points = len(grid["lon"])
+
+    # every 2D field, as columns
+    blocks, columns = {}, []
+    for varname, xda in xds.data_vars.items():
+        xda = xda.transpose("time", ..., *spatial_dims)
+        blocks[varname] = xda
+        columns.append(xda.values.reshape(-1, n_points).T)
+    columns = np.concatenate(columns, axis=1)
+
+    nan_flag = np.isnan(columns).any(axis=0)
+    amplitudes = [None] * columns.shape[1]
+    for method, these in [("cubic", np.flatnonzero(~nan_flag)), ("linear", np.flatnonzero(nan_flag))]:
+        for start in range(0, len(these), batch_size):
+            indices = these[start:start+batch_size]
+            interpolated = interpolate_fields(columns[:, indices], grid, method)
+            if method == "linear":
+                interpolated = np.where(np.isnan(interpolated), 0.0, interpolated)
+            for i, index in enumerate(indices):
+                amplitudes[index] = np.array(compute_array_spectra(interpolated[..., i]))
+
+    nds = {}
+    n_done = 0
+    for varname, xda in blocks.items():
+        lead_dims = xda.dims[:-len(spatial_dims)]
+        lead_shape = xda.shape[:-len(spatial_dims)]
+        n_fields = int(np.prod(lead_shape))
+        amplitude = np.stack(amplitudes[n_done:n_done+n_fields])
+        n_done += n_fields
+        nds[varname] = xr.DataArray(
+            amplitude.reshape(lead_shape + amplitude.shape[-1:]),
+            coords={**{d: xda[d].values for d in lead_dims if d in xda.coords}, "k": np.arange(amplitude.shape[-1])},
+            dims=lead_dims + ("k",),
+        )
+    return postprocess(xr.Dataset(nds))
+
+
+def open_forecast(t0, config, reshape_cell_to_2d=False):
+    """Open a forecast, and subsample forecast hours with fhr_select, same as in eagle.tools.spectra.main"""
+
+    subsample_kwargs = {
+        "levels": config.get("levels", None),
+        "vars_of_interest": config.get("vars_of_interest", None),
+        "lcc_info": config.get("lcc_info", None),
+    }
+    st0 = t0.strftime("%Y-%m-%dT%H")
+    if config.get("from_anemoi", True):
+        fds = open_anemoi_inference_dataset(
+            f"{config['forecast_path']}/{st0}.{config['lead_time']}h.nc",
+            model_type=config["model_type"],
+            lam_index=config.get("lam_index", None),
+            trim_edge=config.get("trim_forecast_edge", None),
+            load=True,
+            reshape_cell_to_2d=reshape_cell_to_2d,
+            horizontal_regrid_kwargs=config.get("forecast_regrid_kwargs", None),
+            **subsample_kwargs,
+        )
+    else:
+        fds = open_forecast_zarr_dataset(
+            config["forecast_path"],
+            t0=t0,
+            trim_edge=config.get("trim_forecast_edge", None),
+            load=True,
+            reshape_cell_to_2d=reshape_cell_to_2d,
+            **subsample_kwargs,
+        )
+    return select_fhr(fds, get_fhr_select(config))
+
+
+def compute_spectra(t0, config):
+    """Power spectrum for a single initial condition
+
+    Returns:
+        t0, pspectra (xr.Dataset): with dims (fhr, k)
+    """
+    global _grid
+
+    st0 = t0.strftime("%Y-%m-%dT%H")
+    logger.info(f"Processing {st0}")
+    if config.get("spectra_engine", None) == "lcc_fft":
+        fds = open_forecast(t0, config, reshape_cell_to_2d=True)
+        pspectra = lam_spectra.compute_power_spectrum(
+            fds,
+            dx=config.get("dx_km", None),
+            window=config.get("spectra_window", "hann"),
+            detrend=config.get("spectra_detrend", "linear"),
+            dtype=np.dtype(config.get("spectra_dtype", "float64")).type,
+        )
+        pspectra = postprocess(pspectra)
+
+    else:
+        fds = open_forecast(t0, config)
+        if _grid is None:
+            _grid = get_grid(fds, min_delta=config.get("min_delta_lat", 0.0003))
+
+        pspectra = compute_power_spectrum(fds, _grid, batch_size=config.get("spectra_batch_size", 32))
+
+    logger.info(f"Done with {st0}")
+    return t0, pspectra
+
+
+def _compute_spectra(args):
+    return compute_spectra(*args)
+
+
+def flatten_gathered(container):
+    """topo.gather gives a list of each rank's (t0, pspectra) list with MPI, and the local list as is without it"""
+    if all(isinstance(item, list) for item in container):
+        return [item for sublist in container for item in sublist]
+    return container
+
+
+def average_spectra(container, n_dates):
+    """Average the per initial condition spectra, in date order, as in eagle.tools.spectra.main"""
+
+    container = sorted(container, key=lambda item: item[0])
+    pspectra = None
+    for _, this_pspectra in container:
+        if pspectra is None:
+            pspectra = this_pspectra / n_dates
+        else:
+            pspectra += this_pspectra / n_dates
+    return pspectra
+
+
+def main(config, n_workers=None):
+    """Compute the Power Spectrum averaged over all initial conditions,
+    splitting initial conditions over local processes or MPI ranks
+    """
+
+    use_mpi = config.get("use_mpi", False)
+    if use_mpi:
+        topo = MPITopology(log_dir=config.get("log_path", "eagle-logs/spectra"))
+    else:
+        topo = SerialTopology()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(topo.log_handler)
+
+    if n_workers is None:
+        n_workers = 1 if use_mpi else config.get("n_workers", 1)
+
+    if config["model_type"] == "nested-global":
+        config["forecast_regrid_kwargs"]["target_grid_path"] = prepare_regrid_target_mask(
+            anemoi_reference_dataset_kwargs=config["anemoi_reference_dataset_kwargs"],
+            horizontal_regrid_kwargs=config["forecast_regrid_kwargs"],
+        )
+
+    dates = pd.date_range(config["start_date"], config["end_date"], freq=config["freq"])
+    n_dates = len(dates)
+    if topo.size > n_dates:
+        raise ValueError(f"Cannot use more MPI ranks than initial conditions, which is {n_dates}")
+
+    local_dates = dates[topo.rank::topo.size]
+
+    logger.info(f" --- Computing Spectra --- ")
+    logger.info(f"Initial Conditions:\n{local_dates}")
+    if n_workers > 1:
+        logger.info(f"Using {n_workers} local processes")
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            container = list(executor.map(_compute_spectra, [(t0, config) for t0 in local_dates]))
+    else:
+        container = [compute_spectra(t0, config) for t0 in local_dates]
+
+    logger.info(f" --- Gathering Results on Root Process --- ")
+    container = topo.gather(container)
+
+    if topo.is_root:
+        container = flatten_gathered(container)
+
+        logger.info(f" --- Storing Results --- ")
+        result = average_spectra(container, n_dates)
+        fname = f"{config['output_path']}/spectra.predictions.{config['model_type']}.nc"
+        result.to_netcdf(fname)
+        logger.info(f"Stored result: {fname}")
+    logger.info(f" --- Done ---")
+
+
+if __name__ == "__main__":
+
+    config = open_yaml_config(sys.argv[1])
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    main(config, n_workers=n_workers)
@@ -0,0 +1,205 @@
+import datetime
+import functools
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("anemoi.inference")
+pytest.importorskip("ufs2arco")
+pytest.importorskip("eagle.tools.inference")
+
+import batched_inference
+
+n_values = 10
+variables = ["t", "u", "orog"]
+
+
+def initial_value(date):
+    """Different for every initial condition, so each member's output can be told apart"""
+    return float(date.day*100 + date.hour)
+
+
+class FakeInput:
+    def __init__(self, names):
+        self.names = names
+
+    def create_input_state(self, date):
+        return {
+            "date": date,
+            "latitudes": np.linspace(20, 50, n_values),
+            "longitudes": np.linspace(230, 300, n_values),
+            "fields": {name: np.full((1, n_values), initial_value(date)) for name in self.names},
+        }
+
+
+class FakeModel:
+    """Every prognostic variable goes up by 1 each step, with shape (batch, 1, values, 2)"""
+
+    def eval(self):
+        return self
+
+    def predict_step(self, x, **kwargs):
+        return x[:, -1:, :, :2] + 1
+
+
+class FakeOutput:
+    """Writes every step of the "t" field to fname on close"""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.steps = []
+        self.values = []
+
+    def open(self, state):
+        pass
+
+    def write_initial_state(self, state):
+        self.write_state({**state, "step": datetime.timedelta(0)})
+
+    def write_state(self, state):
+        self.steps.append(state["step"] // datetime.timedelta(hours=1))
+        self.values.append(np.asarray(state["fields"]["t"]).reshape(-1))
+
+    def close(self):
+        xr.Dataset(
+            {"t": (("fhr", "values"), np.stack(self.values))},
+            coords={"fhr": self.steps},
+        ).to_netcdf(self.fname)
+
+
+class FakeRunner:
+    """The pieces of anemoi's DefaultRunner that batched_inference uses"""
+
+    device = torch.device("cpu")
+    autocast = torch.float32
+    post_processors = []
+    n_model_loads = 0
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.checkpoint = SimpleNamespace(
+            timestep=datetime.timedelta(hours=6),
+            output_tensor_index_to_variable={0: "t", 1: "u"},
+            number_of_input_features=len(variables),
+            variable_to_input_tensor_index={v: i for i, v in enumerate(variables)},
+            typed_variables={v: SimpleNamespace(is_constant_in_time=v == "orog") for v in variables},
+            latitudes=None,
+            longitudes=None,
+        )
+
+    @functools.cached_property
+    def model(self):
+        FakeRunner.n_model_loads += 1
+        return FakeModel()
+
+    def create_prognostics_input(self):
+        return FakeInput(["t", "u"])
+
+    def create_constant_coupled_forcings_input(self):
+        return FakeInput(["orog"])
+
+    def create_dynamic_forcings_input(self):
+        return FakeInput([])
+
+    def create_output(self):
+        return FakeOutput(self.fname)
+
+    def _check_state(self, state, title):
+        pass
+
+    def _combine_states(self, *states):
+        combined = states[0].copy()
+        combined["fields"] = {k: v for state in states for k, v in state["fields"].items()}
+        return combined
+
+    def _initial_state(self, *states):
+        return self._combine_states(*states)
+
+    def input_state_hook(self, state):
+        pass
+
+    def output_state_hook(self, state):
+        pass
+
+    def complete_forecast_hook(self):
+        pass
+
+    def create_constant_forcings_inputs(self, state):
+        return []
+
+    create_dynamic_forcings_inputs = create_constant_forcings_inputs
+    create_boundary_forcings_inputs = create_constant_forcings_inputs
+
+    def prepare_input_tensor(self, state):
+        """(variables, multi_step, values), like anemoi's numpy input tensor"""
+        return np.stack([state["fields"][v] for v in variables])
+
+    def predict_step(self, model, input_tensor, **kwargs):
+        return model.predict_step(input_tensor, **kwargs)
+
+    def forecast_stepper(self, start_date, lead_time):
+        steps = lead_time // self.checkpoint.timestep
+        for s in range(steps):
+            step = (s + 1) * self.checkpoint.timestep
+            yield step, start_date + step, start_date + step, s == steps - 1
+
+    def copy_prognostic_fields_to_input_tensor(self, input_tensor, y_pred, check):
+        input_tensor = input_tensor.clone()
+        input_tensor[:, -1, :, :2] = y_pred[:, 0]
+        check[:2] = True
+        return input_tensor
+
+    def add_dynamic_forcings_to_input_tensor(self, input_tensor, state, date, check):
+        return input_tensor
+
+    add_boundary_forcings_to_input_tensor = add_dynamic_forcings_to_input_tensor
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    def create_anemoi_config(init_date, main_config):
+        fname = f"{main_config['output_path']}/{init_date:%Y-%m-%dT%H}.{main_config['lead_time']}h.nc"
+        return {"fname": fname}, fname
+
+    monkeypatch.setattr(batched_inference, "create_anemoi_config", create_anemoi_config)
+    monkeypatch.setattr(batched_inference.RunConfiguration, "load", staticmethod(lambda c: c))
+    monkeypatch.setattr(batched_inference, "create_runner", lambda c: FakeRunner(c["fname"]))
+    monkeypatch.setattr(batched_inference.importlib.metadata, "version", lambda name: batched_inference.anemoi_inference_version)
+    FakeRunner.n_model_loads = 0
+    return {
+        "start_date": "2023-02-01T00",
+        "end_date": "2023-02-02T12",
+        "freq": "12h",
+        "lead_time": 24,
+        "output_path": str(tmp_path),
+        "batch_size": 3,
+    }
+
+
+@pytest.mark.parametrize("write_queue_size", [0, 4])
+def test_each_member_writes_its_own_file(config, write_queue_size):
+    config["write_queue_size"] = write_queue_size
+    batched_inference.main(config)
+
+    # one model, shared by every batch member
+    assert FakeRunner.n_model_loads == 1
+
+    for t0 in pd.date_range(config["start_date"], config["end_date"], freq=config["freq"]):
+        xds = xr.load_dataset(f"{config['output_path']}/{t0:%Y-%m-%dT%H}.{config['lead_time']}h.nc")
+        np.testing.assert_array_equal(xds["fhr"], [0, 6, 12, 18, 24])
+        expected = initial_value(t0) + np.arange(5)
+        np.testing.assert_array_equal(xds["t"].values, np.broadcast_to(expected[:, None], (5, n_values)))
+
+
+def test_check_runner_api(config):
+    batched_inference.check_runner_api(FakeRunner("unused"))
+
+    class OldRunner(FakeRunner):
+        _combine_states = None
+
+    with pytest.raises(RuntimeError, match="_combine_states"):
+        batched_inference.check_runner_api(OldRunner("unused"))
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import lam_spectra
+
+
+@pytest.mark.parametrize("shape", [(190, 338), (211, 359), (64, 64)])
+def test_bins_reach_2dx(shape):
+    bins = lam_spectra.get_radial_bins(*shape)
+    assert bins["k"][-1] == max(shape) // 2
+    assert bins["wavelength"][-1] == pytest.approx(2, abs=0.02)
+
+
+@pytest.mark.parametrize("shape", [(190, 338), (211, 359)])
+def test_parseval_white_noise(shape):
+    """Binned power plus the corners beyond Nyquist is the mean square of the field"""
+    n_y, n_x = shape
+    field = np.random.default_rng(0).standard_normal((3, n_y, n_x))
+    power = lam_spectra.radial_power_spectra(field, window=None, detrend=None)
+
+    # all of it, as a full complex spectrum
+    n_max = max(n_y, n_x)
+    kr = np.hypot(np.fft.fftfreq(n_y)[:, None], np.fft.fftfreq(n_x)[None, :]) * n_max
+    full = np.abs(np.fft.fft2(field))**2 / (n_y*n_x)**2
+    corners = full[:, np.rint(kr) > n_max // 2].sum(axis=-1)
+
+    mean_square = (field**2).mean(axis=(-2, -1))
+    np.testing.assert_allclose(power.sum(axis=-1) + corners, mean_square, rtol=1e-10)
+    # the binned spectrum is most of it, white noise has ~pi/4 of the rectangle inside the Nyquist circle
+    assert np.all(power.sum(axis=-1) > 0.7 * mean_square)
+
+
+def test_parseval_band_limited_noise():
+    """With no power beyond Nyquist, the binned spectrum sums exactly to the mean square"""
+    n_y, n_x = 190, 338
+    rng = np.random.default_rng(1)
+    spectrum = np.fft.fft2(rng.standard_normal((n_y, n_x)))
+    kr = np.hypot(np.fft.fftfreq(n_y)[:, None], np.fft.fftfreq(n_x)[None, :]) * max(n_y, n_x)
+    spectrum[kr > max(n_y, n_x) // 2 - 1] = 0
+    field = np.fft.ifft2(spectrum).real
+
+    power = lam_spectra.radial_power_spectra(field, window=None, detrend=None)
+    np.testing.assert_allclose(power.sum(), (field**2).mean(), rtol=1e-10)
@@ -0,0 +1,96 @@
+import glob
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+pytest.importorskip("eagle.log")
+
+import postprocess_precip
+
+n_y, n_x = 6, 8
+n_global = 10
+
+
+class Killed(Exception):
+    pass
+
+
+@pytest.fixture
+def config(tmp_path):
+    """Synthetic nested forecasts, {t0}.{lead_time}h.lam.nc, with the LAM first along values"""
+    config = {
+        "forecast_path": str(tmp_path / "forecasts"),
+        "lead_time": 24,
+        "lam_index": n_y * n_x,
+        "lcc_info": {"n_x": n_x, "n_y": n_y},
+        "vars_of_interest": ["accum_tp"],
+        "start_date": "2023-02-01T00",
+        "end_date": "2023-02-03T00",
+        "freq": "6h",
+    }
+    (tmp_path / "forecasts").mkdir()
+    n_values = n_y * n_x + n_global
+    for t0 in pd.date_range(config["start_date"], config["end_date"], freq=config["freq"]):
+        time = pd.date_range(t0, periods=5, freq="6h")
+        rng = np.random.default_rng(t0.day*100 + t0.hour)
+        accum_tp = np.cumsum(rng.uniform(size=(len(time), n_values)), axis=0).astype(np.float32)
+        accum_tp[0] = 0
+        xr.Dataset(
+            {
+                "accum_tp": (("time", "values"), accum_tp),
+                "t2m": (("time", "values"), rng.normal(size=(len(time), n_values))),
+            },
+            coords={
+                "time": time,
+                "latitude": ("values", np.linspace(20, 50, n_values)),
+                "longitude": ("values", np.linspace(230, 300, n_values)),
+            },
+        ).to_netcdf(f"{config['forecast_path']}/{t0:%Y-%m-%dT%H}.24h.lam.nc")
+    return config
+
+
+def test_fill_resumes_after_a_crash(tmp_path, config, monkeypatch):
+    serial_config = {**config, "output_path": str(tmp_path / "serial.zarr")}
+    postprocess_precip.main(serial_config, n_workers=1)
+    expected = xr.open_zarr(serial_config["output_path"]).load()
+
+    # local threads, so that the crash below happens in the workers
+    monkeypatch.setattr(postprocess_precip, "ProcessPoolExecutor", ThreadPoolExecutor)
+    open_dataset = postprocess_precip.open_dataset
+    crash_at = [pd.Timestamp("2023-02-01T18"), pd.Timestamp("2023-02-02T18")]
+    all_t0 = pd.date_range(config["start_date"], config["end_date"], freq=config["freq"])
+    t0_index = {t0: i for i, t0 in enumerate(all_t0)}
+
+    def crashing_open_dataset(t0, config):
+        """Write garbage to this t0's region and die, like a job killed in the middle of a write"""
+        xds = open_dataset(t0, config)
+        if t0 in crash_at:
+            (xds * 0 - 999).to_zarr(config["output_path"], region=postprocess_precip.get_region(xds, t0_index))
+            raise Killed(f"killed at {t0}")
+        return xds
+
+    fill_config = {**config, "output_path": str(tmp_path / "fill.zarr")}
+    monkeypatch.setattr(postprocess_precip, "open_dataset", crashing_open_dataset)
+    with pytest.raises(Killed):
+        postprocess_precip.main(fill_config, n_workers=3)
+    completed = postprocess_precip.read_checkpoint(f"{fill_config['output_path']}.checkpoint")
+    assert 0 < len(completed) < len(all_t0)
+    assert not completed.intersection(crash_at)
+    assert len(glob.glob(f"{fill_config['output_path']}.checkpoint/completed.*.txt")) > 1
+
+    # the resumed run only does what's left, and gives the same store as the serial run
+    done = []
+
+    def counting_open_dataset(t0, config):
+        done.append(t0)
+        return open_dataset(t0, config)
+
+    monkeypatch.setattr(postprocess_precip, "open_dataset", counting_open_dataset)
+    postprocess_precip.main(fill_config, n_workers=2)
+    assert sorted(done) == sorted(set(all_t0) - completed)
+
+    result = xr.open_zarr(fill_config["output_path"]).load()
+    xr.testing.assert_identical(result, expected)
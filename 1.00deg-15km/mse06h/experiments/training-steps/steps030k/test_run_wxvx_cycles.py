@@ -0,0 +1,64 @@
+import os
+import json
+import subprocess
+
+import yaml
+import pytest
+
+import run_wxvx_cycles
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = str(tmp_path / "wxvx.yaml")
+    with open(path, "w") as f:
+        yaml.dump({"cycles": {"start": "2023-02-01T00:00:00", "stop": "2023-02-01T12:00:00", "step": 6}}, f)
+    return path
+
+
+def read_status(cycles_dir):
+    with open(os.path.join(cycles_dir, "status.json"), "r") as f:
+        return json.load(f)
+
+
+def test_missing_wxvx_is_a_failure(tmp_path, config_path, monkeypatch):
+    cycles_dir = str(tmp_path / "cycles")
+
+    def missing(*args, **kwargs):
+        raise FileNotFoundError(2, "No such file or directory", "wxvx")
+
+    monkeypatch.setattr(run_wxvx_cycles.subprocess, "run", missing)
+    run_wxvx_cycles.main(config_path, n_workers=2, cycles_dir=cycles_dir)
+
+    status = read_status(cycles_dir)
+    assert len(status) == 3
+    for entry in status.values():
+        assert entry["grids"] == "failed"
+        assert "No such file or directory" in entry["grids_error"]
+        assert "stats" not in entry
+
+    # once wxvx is there, everything gets rerun and the errors are cleared
+    calls = []
+
+    def wxvx(args, **kwargs):
+        calls.append(args)
+        return subprocess.CompletedProcess(args, 0)
+
+    monkeypatch.setattr(run_wxvx_cycles.subprocess, "run", wxvx)
+    run_wxvx_cycles.main(config_path, n_workers=2, cycles_dir=cycles_dir)
+    assert len(calls) == 6
+    assert all(entry == {"grids": "done", "stats": "done"} for entry in read_status(cycles_dir).values())
+
+
+def test_nonzero_exit_is_a_failure(tmp_path, config_path, monkeypatch):
+    cycles_dir = str(tmp_path / "cycles")
+    monkeypatch.setattr(
+        run_wxvx_cycles.subprocess,
+        "run",
+        lambda args, **kwargs: subprocess.CompletedProcess(args, 1 if args[-1] == "stats" else 0),
+    )
+    run_wxvx_cycles.main(config_path, n_workers=2, cycles_dir=cycles_dir)
+    for entry in read_status(cycles_dir).values():
+        assert entry["grids"] == "done"
+        assert entry["stats"] == "failed"
+        assert "exited with 1" in entry["stats_error"]
@@ -0,0 +1,127 @@
+import glob
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+pytest.importorskip("ufs2arco")
+pytest.importorskip("eagle.tools.spectra")
+
+import eagle.tools.spectra
+from ufs2arco.mpi import SerialTopology
+
+import sharded_spectra
+
+
+def fake_forecast(t0, n_y=12, n_x=20, lead_time=24, reshape_cell_to_2d=False):
+    """A forecast every 6 hours out to lead_time, on a small lat/lon patch, different for every t0
+
+    sp has a few NaNs at the first time, so it gets interpolated with "linear" there
+    """
+    time = pd.date_range(t0, periods=lead_time // 6 + 1, freq="6h")
+    lat, lon = np.meshgrid(np.linspace(30, 40, n_y), np.linspace(250, 270, n_x), indexing="ij")
+    rng = np.random.default_rng(t0.day*100 + t0.hour)
+    sp = rng.normal(size=(len(time), n_y, n_x))
+    sp[0, 3:5, 7:9] = np.nan
+    xds = xr.Dataset(
+        {
+            "t2m": (("time", "y", "x"), rng.normal(size=(len(time), n_y, n_x))),
+            "sp": (("time", "y", "x"), sp),
+        },
+        coords={
+            "time": time,
+            "latitude": (("y", "x"), lat),
+            "longitude": (("y", "x"), lon),
+        },
+    )
+    if not reshape_cell_to_2d:
+        xds = xds.stack(cell=("y", "x")).drop_vars(["cell", "y", "x"])
+    return xds
+
+
+def open_fake_forecast(fname, reshape_cell_to_2d=False, **kwargs):
+    return fake_forecast(pd.Timestamp(fname.split("/")[-1].split(".")[0]), reshape_cell_to_2d=reshape_cell_to_2d)
+
+
+@pytest.fixture
+def fake_data(monkeypatch):
+    monkeypatch.setattr(sharded_spectra, "open_anemoi_inference_dataset", open_fake_forecast)
+    monkeypatch.setattr(eagle.tools.spectra, "open_anemoi_inference_dataset", open_fake_forecast)
+    monkeypatch.setattr(sharded_spectra, "_grid", None)
+
+
+@pytest.mark.parametrize("spectra_engine", [None, "lcc_fft"])
+@pytest.mark.parametrize("fhr_select", [[0, 6, 24], [6, 12], 12])
+def test_fhr_select(fake_data, spectra_engine, fhr_select):
+    config = {
+        "forecast_path": "forecasts",
+        "lead_time": 24,
+        "model_type": "nested-lam",
+        "fhr_select": fhr_select,
+        "spectra_engine": spectra_engine,
+    }
+    _, pspectra = sharded_spectra.compute_spectra(pd.Timestamp("2023-02-01T06"), config)
+
+    # as in eagle.tools.spectra, lead time counts from the first selected forecast hour
+    expected = np.array(fhr_select if isinstance(fhr_select, list) else [fhr_select])
+    expected = expected - expected[0]
+    np.testing.assert_array_equal(pspectra["fhr"].values, expected)
+    np.testing.assert_array_equal(pspectra["lead_time"].values, pd.to_timedelta(expected, unit="h").values)
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 32])
+def test_batched_interpolation_matches_eagle(batch_size):
+    fds = fake_forecast(pd.Timestamp("2023-02-01T06"))
+    grid = sharded_spectra.get_grid(fds, min_delta=0.0003)
+    expected = eagle.tools.spectra.compute_power_spectrum(fds, grid)
+    result = sharded_spectra.compute_power_spectrum(fds, grid, batch_size=batch_size)
+    xr.testing.assert_allclose(result, expected, rtol=1e-10)
+
+
+def test_levels_are_batched_too():
+    fds = fake_forecast(pd.Timestamp("2023-02-01T06"))
+    fds["t"] = xr.concat([fds["t2m"], 2*fds["t2m"]], dim=pd.Index([500, 850], name="level"))
+    grid = sharded_spectra.get_grid(fds, min_delta=0.0003)
+    result = sharded_spectra.compute_power_spectrum(fds, grid)
+
+    assert result["t"].dims == ("fhr", "level", "k")
+    xr.testing.assert_allclose(result["t"].sel(level=500, drop=True), result["t2m"], rtol=1e-10)
+    doubled = sharded_spectra.compute_power_spectrum(2*fds[["t2m"]], grid)
+    xr.testing.assert_allclose(result["t"].sel(level=850, drop=True), doubled["t2m"], rtol=1e-10)
+
+
+def test_flatten_gathered():
+    t0 = pd.date_range("2023-02-01", periods=3, freq="12h")
+    local = [(t, None) for t in t0]
+    assert sharded_spectra.flatten_gathered(local) == local
+    assert sharded_spectra.flatten_gathered([local[::2], local[1:2]]) == [local[0], local[2], local[1]]
+    assert sharded_spectra.flatten_gathered([local, []]) == local
+
+
+def test_main_matches_serial(tmp_path, fake_data, monkeypatch):
+    monkeypatch.setattr(
+        sharded_spectra,
+        "ProcessPoolExecutor",
+        lambda max_workers, mp_context=None: ThreadPoolExecutor(max_workers=max_workers),
+    )
+    config = {
+        "forecast_path": "forecasts",
+        "lead_time": 24,
+        "model_type": "nested-lam",
+        "start_date": "2023-02-01T00",
+        "end_date": "2023-02-03T00",
+        "freq": "12h",
+    }
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "sharded").mkdir()
+
+    serial_config = {**config, "output_path": str(tmp_path / "serial"), "topo": SerialTopology()}
+    eagle.tools.spectra.main(serial_config)
+    expected = xr.load_dataset(glob.glob(f"{tmp_path}/serial/spectra.*.nc")[0])
+
+    sharded_spectra.main({**config, "output_path": str(tmp_path / "sharded")}, n_workers=3)
+    result = xr.load_dataset(f"{tmp_path}/sharded/spectra.predictions.nested-lam.nc")
+
+    xr.testing.assert_allclose(result, expected, rtol=1e-10)
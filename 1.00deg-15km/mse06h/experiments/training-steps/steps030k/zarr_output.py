@@ -0,0 +1,234 @@
+"""
+Write inference output for all initial conditions into a single, preallocated zarr store,
+rather than one netcdf per initial condition.
+
+The store has one array per anemoi variable (e.g. t_500, 2t, tp), with dims
+
+    (t0, fhr, values)   # the full nested (or global) output, with latitude/longitude along values
+    (t0, fhr, y, x)     # with zarr_lam: True, only the LAM, reshaped using lam_index and lcc_info
+
+It is created once, with every t0 and fhr, but nothing is written until each forecast comes in.
+Each initial condition is then written to its own t0 region, a block of fhr chunks at a time,
+so nothing beyond one chunk per variable is held in memory, and initial conditions
+can be written from separate processes or MPI ranks at the same time.
+Anything that has not been written yet reads as NaN.
+Each finished initial condition is recorded in "{store}.completed.txt".
+
+Config options, used by batched_inference.py:
+
+    output_format: zarr             # default is netcdf
+    zarr_output_path: ...           # default {output_path}/inference.{lead_time}h.zarr
+    zarr_lam: True                  # optional, only store the LAM on its (y, x) grid, default False
+    zarr_chunks:                    # optional, chunk size along each dim, t0 must be 1, -1 means the full dim
+      fhr: 1
+      values: -1                    # or y and x with zarr_lam: True
+    zarr_compressor:                # optional, kwargs for numcodecs.Blosc, or None for no compression
+      cname: zstd
+      clevel: 3
+      shuffle: 2
+    zarr_dtype: float32             # optional, default float32
+
+Reading it back, e.g. 2m temperature for one initial condition:
+
+    xds = xr.open_zarr(path)
+    xda = xds["2t"].sel(t0="2023-02-01T06")
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask.array
+import numcodecs
+
+_default_compressor = {"cname": "zstd", "clevel": 3, "shuffle": numcodecs.Blosc.BITSHUFFLE}
+
+
+def get_store_path(config):
+    return config.get("zarr_output_path", f"{config['output_path']}/inference.{config['lead_time']}h.zarr")
+
+
+def get_spatial_shape(config, n_values):
+    """The spatial dims and shape of each field in the store
+
+    Returns:
+        dims (tuple): ("values",) or ("y", "x")
+        shape (tuple): (n_values,) or (n_y, n_x)
+    """
+    if config.get("zarr_lam", False):
+        lcc_info = config["lcc_info"]
+        n_y, n_x = lcc_info["n_y"], lcc_info["n_x"]
+        if n_y * n_x != config["lam_index"]:
+            raise ValueError(f"zarr_output: lcc_info n_y * n_x = {n_y * n_x} does not match lam_index = {config['lam_index']}")
+        return ("y", "x"), (n_y, n_x)
+    return ("values",), (n_values,)
+
+
+def get_chunks(config, dims, shape):
+    """Chunk size along (t0, fhr, *spatial dims), from zarr_chunks, with -1 meaning the full dim"""
+    user_chunks = config.get("zarr_chunks", None) or {}
+    if user_chunks.get("t0", 1) != 1:
+        raise ValueError("zarr_output: zarr_chunks['t0'] must be 1, so that each initial condition is its own region")
+
+    chunks = [1, user_chunks.get("fhr", 1)]
+    for dim, size in zip(dims, shape):
+        chunk = user_chunks.get(dim, -1)
+        chunks.append(size if chunk == -1 else chunk)
+    return tuple(chunks)
+
+
+def get_encoding(config, variables, chunks):
+    compressor = config.get("zarr_compressor", _default_compressor)
+    compressor = numcodecs.Blosc(**compressor) if compressor is not None else None
+    return {
+        name: {"chunks": chunks, "compressor": compressor, "_FillValue": np.nan}
+        for name in variables
+    }
+
+
+def create_store(path, config, dates, fhrs, variables, latitudes, longitudes):
+    """Create the store with all of the metadata and coordinates, but no data
+
+    Args:
+        path (str): where to put it
+        config (dict): the inference yaml
+        dates (pd.DatetimeIndex): every initial condition
+        fhrs (array_like): every forecast hour, including 0
+        variables (list of str): anemoi variable names
+        latitudes, longitudes (np.ndarray): of the full (nested) grid, along values
+    """
+    dims, shape = get_spatial_shape(config, len(latitudes))
+    chunks = get_chunks(config, dims, shape)
+    dtype = np.dtype(config.get("zarr_dtype", "float32"))
+
+    xds = xr.Dataset()
+    xds["t0"] = xr.DataArray(pd.DatetimeIndex(dates).values, dims="t0")
+    xds["fhr"] = xr.DataArray(np.asarray(fhrs, dtype=int), dims="fhr", attrs={"description": "forecast hour"})
+    if dims == ("values",):
+        xds["latitude"] = xr.DataArray(latitudes, dims=dims)
+        xds["longitude"] = xr.DataArray(longitudes % 360, dims=dims)
+    else:
+        n_lam = config["lam_index"]
+        xds["latitude"] = xr.DataArray(latitudes[:n_lam].reshape(shape), dims=dims)
+        xds["longitude"] = xr.DataArray((longitudes[:n_lam] % 360).reshape(shape), dims=dims)
+    xds = xds.set_coords(["latitude", "longitude"])
+
+    full_shape = (len(dates), len(fhrs)) + shape
+    for name in variables:
+        xds[name] = xr.DataArray(
+            dask.array.zeros(full_shape, chunks=chunks, dtype=dtype),
+            dims=("t0", "fhr") + dims,
+        )
+
+    xds.attrs["lead_time"] = config["lead_time"]
+    xds.attrs["checkpoint_path"] = config["checkpoint_path"]
+    xds.to_zarr(path, mode="w", compute=False, encoding=get_encoding(config, variables, chunks))
+
+
+def read_manifest(path):
+    """Initial conditions that have been fully written, as ISO strings"""
+    fname = f"{path}.completed.txt"
+    if not os.path.isfile(fname):
+        return set()
+    with open(fname, "r") as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def append_manifest(path, t0):
+    with open(f"{path}.completed.txt", "a") as f:
+        f.write(f"{pd.Timestamp(t0).isoformat()}\n")
+
+
+class ZarrOutput:
+    """Stand in for an anemoi output, writing one initial condition into its region of the store
+
+    This has the open, write_initial_state, write_state, and close methods
+    that batched_inference.BatchMember uses from anemoi outputs.
+    Steps are buffered until a block of fhr chunks is full, and then written.
+
+    Args:
+        path (str): the store, made by create_store
+        t0 (pd.Timestamp): this initial condition, which must be in the store
+        config (dict): the inference yaml
+    """
+
+    def __init__(self, path, t0, config):
+        self.path = path
+        self.t0 = pd.Timestamp(t0)
+        self.lam = config.get("zarr_lam", False)
+        self.n_lam = config.get("lam_index", None)
+
+        xds = xr.open_zarr(path)
+        self.variables = [name for name in xds.data_vars]
+        self.dims = xds[self.variables[0]].dims
+        self.spatial_shape = xds[self.variables[0]].shape[2:]
+        self.dtype = xds[self.variables[0]].dtype
+        self.fhrs = xds["fhr"].values
+        self.fhr_chunk = xds[self.variables[0]].encoding["chunks"][1]
+
+        t0s = pd.DatetimeIndex(xds["t0"].values)
+        if self.t0 not in t0s:
+            raise KeyError(f"ZarrOutput: {self.t0} is not in {path}")
+        self.t0_index = t0s.get_loc(self.t0)
+        xds.close()
+
+        self.buffer = {}
+        self.buffer_start = None
+
+    def open(self, state):
+        pass
+
+    def _field(self, field):
+        field = np.asarray(field)
+        if self.lam:
+            field = field[:self.n_lam]
+        return field.reshape(self.spatial_shape).astype(self.dtype, copy=False)
+
+    def write_initial_state(self, state):
+        self.write_state(state)
+
+    def write_state(self, state):
+        step = pd.Timedelta(state.get("step", 0))
+        fhr_index = int(np.flatnonzero(self.fhrs == step // pd.Timedelta(hours=1))[0])
+        block_start = fhr_index - fhr_index % self.fhr_chunk
+
+        if self.buffer_start is not None and block_start != self.buffer_start:
+            self.flush()
+
+        if self.buffer_start is None:
+            self.buffer_start = block_start
+            n_fhr = min(self.fhr_chunk, len(self.fhrs) - block_start)
+            self.buffer = {
+                name: np.full((1, n_fhr) + self.spatial_shape, np.nan, dtype=self.dtype)
+                for name in self.variables
+            }
+
+        for name in self.variables:
+            if name in state["fields"]:
+                self.buffer[name][0, fhr_index - block_start] = self._field(state["fields"][name])
+
+        if fhr_index == len(self.fhrs) - 1:
+            self.flush()
+
+    def flush(self):
+        """Write whatever is buffered into its (t0, fhr) region"""
+        if self.buffer_start is None:
+            return
+        n_fhr = next(iter(self.buffer.values())).shape[1]
+        xds = xr.Dataset({
+            name: xr.DataArray(data, dims=self.dims)
+            for name, data in self.buffer.items()
+        })
+        xds.to_zarr(
+            self.path,
+            region={
+                "t0": slice(self.t0_index, self.t0_index + 1),
+                "fhr": slice(self.buffer_start, self.buffer_start + n_fhr),
+            },
+        )
+        self.buffer = {}
+        self.buffer_start = None
+
+    def close(self):
+        self.flush()
+        append_manifest(self.path, self.t0)
@@ -3,11 +3,16 @@ Script to preprocess and regrid nested anemoi output for use with weatherbench.
 Produces a zarr file in the desired wbx format and resolution (e.g. 1.5 degrees)
 """
 
+import os
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Tuple
 import xarray as xr
 import pandas as pd
 import xesmf as xe
 import numpy as np
+import dask.array
 from datetime import datetime
 import sys
 from inference_globals import (
@@ -16,8 +21,18 @@ from inference_globals import (
     PATH_TO_LAM_FILE,
     PATH_TO_OUTPUT_ZARR,
     LAM_TARGET_PATH,
+    REGRID_WEIGHTS_DIR,
+    LAM_INDEX,
+    GRID_LAYOUT_DIR,
+    N_WORKERS,
 )
 
+# in-memory cache of regridders, keyed by the hash from regridder_key
+_regridders = {}
+
+# in-memory cache of GridLayouts, keyed by grid_hash
+_layouts = {}
+
 
 def clip_to_vars_of_interest(
     ds_nested: xr.Dataset,
@@ -37,47 +52,283 @@ def clip_to_vars_of_interest(
     return ds_nested[var_list]
 
 
+def _as_indexer(
+    index: np.ndarray,
+) -> slice | np.ndarray:
+    """
+    Convert an index array to a slice if it is contiguous, so isel returns a view.
+
+    Args:
+        index (np.ndarray): Sorted integer indices along "values".
+
+    Returns:
+        slice | np.ndarray -- A slice for contiguous indices, otherwise the index array.
+    """
+    if len(index) > 0 and index[-1] - index[0] + 1 == len(index):
+        return slice(int(index[0]), int(index[-1]) + 1)
+    return index
+
+
+def get_index_plan(
+    ds_lam: xr.Dataset,
+    ds_nested: xr.Dataset,
+    lam_index: int | None = LAM_INDEX,
+) -> dict:
+    """
+    Compute which "values" in the nested dataset belong to the LAM and which to the global domain.
+    This only looks at the static grid, so it is computed once and reused for every date and variable.
+
+    If lam_index is given, the first lam_index points are the LAM (as in the anemoi cutout ordering).
+    Otherwise, the LAM is the bounding box of the static LAM grid.
+    TODO - when we switch to GFS/HRRR it wont be a simple bounding box, so lam_index is preferred.
+
+    Args:
+        ds_lam (xr.Dataset): Static dataset defining LAM region bounds.
+        ds_nested (xr.Dataset): Nested anemoi-dataset, only the latitude/longitude are used.
+        lam_index (int): Number of LAM points at the start of the "values" dimension.
+
+    Returns:
+        dict -- With "lam" and "global" indexers along "values", and "n_values" for validation.
+    """
+    n_values = ds_nested.latitude.size
+    if lam_index:
+        lam = np.arange(lam_index)
+        glo = np.arange(lam_index, n_values)
+
+    else:
+        lat_min, lat_max = ds_lam.latitude.min().values, ds_lam.latitude.max().values
+        lon_min, lon_max = ds_lam.longitude.min().values, ds_lam.longitude.max().values
+
+        lats = ds_nested.latitude.values
+        lons = ds_nested.longitude.values
+        mask = (
+            (lats >= lat_min)
+            & (lats <= lat_max)
+            & (lons >= lon_min)
+            & (lons <= lon_max)
+        )
+        lam = np.flatnonzero(mask)
+        glo = np.flatnonzero(~mask)
+
+    return {
+        "lam": _as_indexer(lam),
+        "global": _as_indexer(glo),
+        "n_values": n_values,
+    }
+
+
 def extract_data(
     ds_lam: xr.Dataset,
     ds_nested: xr.Dataset,
+    index_plan: dict | None = None,
 ) -> Tuple[xr.Dataset, xr.Dataset]:
     """
     Extract LAM and global regions from the nested dataset (as two separate datasets) based on LAM spatial bounds.
-    TODO - when we switch to GFS/HRRR it wont be a simple bounding box.
-    We will probably want to add an option to straight up mask the ds instead of clipping to a box in that case.
+    This is a single isel per region, using the index plan from get_index_plan,
+    so no masked copies are made and grid points are never dropped because their data are NaN.
 
     Args:
         ds_lam (xr.Dataset): Static dataset defining LAM region bounds.
         ds_nested (xr.Dataset): Full nested anemoi-dataset.
+        index_plan (dict): Precomputed output from get_index_plan. If None, it's computed here.
 
     Returns:
         Tuple[xr.Dataset, xr.Dataset] -- Separated LAM-only and global-only datasets.
     """
 
-    lat_min, lat_max = ds_lam.latitude.min(), ds_lam.latitude.max()
-    lon_min, lon_max = ds_lam.longitude.min(), ds_lam.longitude.max()
+    if index_plan is None:
+        index_plan = get_index_plan(ds_lam=ds_lam, ds_nested=ds_nested)
 
-    mask = (
-        (ds_nested.latitude >= lat_min)
-        & (ds_nested.latitude <= lat_max)
-        & (ds_nested.longitude >= lon_min)
-        & (ds_nested.longitude <= lon_max)
-    )
+    if index_plan["n_values"] != len(ds_nested["values"]):
+        raise ValueError(
+            f"extract_data: index plan was computed for {index_plan['n_values']} points, "
+            f"but dataset has {len(ds_nested['values'])}"
+        )
 
-    ds_lam_only = ds_nested.copy()
-    for var in ds_lam_only.data_vars:
-        ds_lam_only[var] = ds_lam_only[var].where(mask, drop=False)
+    ds_lam_only = ds_nested.isel(values=index_plan["lam"])
+    ds_global_only = ds_nested.isel(values=index_plan["global"])
+    return ds_lam_only, ds_global_only
 
-    ds_global_only = ds_nested.copy()
-    for var in ds_global_only.data_vars:
-        ds_global_only[var] = ds_global_only[var].where(~mask, drop=False)
 
-    return ds_lam_only.dropna(dim="values"), ds_global_only.dropna(dim="values")
+def grid_hash(
+    ds: xr.Dataset,
+) -> str:
+    """
+    Hash the latitude/longitude geometry of a grid.
+
+    Args:
+        ds (xr.Dataset): Dataset with latitude and longitude coordinates.
+
+    Returns:
+        str -- Hex digest that only changes when the grid geometry changes.
+    """
+    h = hashlib.sha1()
+    for key in ["latitude", "longitude"]:
+        values = np.ascontiguousarray(ds[key].values, dtype=np.float64)
+        h.update(key.encode())
+        h.update(str(values.shape).encode())
+        h.update(values.tobytes())
+    return h.hexdigest()
+
+
+class GridLayout:
+    """
+    Mapping between a 1D "values" dimension and a 2D (latitude, longitude) grid.
+
+    The sort permutation and 2D shape are computed once per grid, and then reshaping
+    any number of variables and time steps onto the grid is a single gather (to_2d).
+    Layouts can be stored as npz files so that later runs skip the sort entirely.
+
+    Args:
+        sort_index (np.ndarray): Permutation of "values" that sorts by latitude, then longitude.
+        latitude (np.ndarray): 1D latitude coordinate of the 2D grid.
+        longitude (np.ndarray): 1D longitude coordinate of the 2D grid.
+    """
+
+    def __init__(
+        self,
+        sort_index: np.ndarray,
+        latitude: np.ndarray,
+        longitude: np.ndarray,
+    ):
+        self.sort_index = np.asarray(sort_index)
+        self.latitude = np.asarray(latitude)
+        self.longitude = np.asarray(longitude)
+        self.shape = (len(self.latitude), len(self.longitude))
+
+        if len(self.sort_index) != self.shape[0] * self.shape[1]:
+            raise ValueError(
+                f"GridLayout: {len(self.sort_index)} points can't be reshaped to {self.shape}"
+            )
+
+    @classmethod
+    def from_dataset(
+        cls,
+        ds: xr.Dataset,
+    ):
+        """
+        Compute the layout from the latitude/longitude in an anemoi style dataset.
+
+        Args:
+            ds (xr.Dataset): Dataset with latitude and longitude along "values".
+
+        Returns:
+            GridLayout -- Layout for this grid.
+        """
+        lats = ds["latitude"].values
+        lons = ds["longitude"].values
+        sort_index = np.lexsort((lons, lats))
+        return cls(
+            sort_index=sort_index,
+            latitude=np.unique(lats),
+            longitude=np.unique(lons),
+        )
+
+    @classmethod
+    def from_npz(
+        cls,
+        path: str,
+    ):
+        """
+        Read a layout stored with to_npz.
+
+        Args:
+            path (str): Path to the npz file.
+
+        Returns:
+            GridLayout -- The stored layout.
+        """
+        with np.load(path) as f:
+            return cls(
+                sort_index=f["sort_index"],
+                latitude=f["latitude"],
+                longitude=f["longitude"],
+            )
+
+    def to_npz(
+        self,
+        path: str,
+    ) -> None:
+        """
+        Store the layout so it can be read back with from_npz.
+
+        Args:
+            path (str): Path to the npz file.
+        """
+        np.savez(
+            path,
+            sort_index=self.sort_index,
+            latitude=self.latitude,
+            longitude=self.longitude,
+        )
+
+    def to_2d(
+        self,
+        ds: xr.Dataset,
+        vars_of_interest: list[str],
+    ) -> xr.Dataset:
+        """
+        Gather variables from "values" onto the 2D grid, all time steps at once.
+
+        Args:
+            ds (xr.Dataset): Dataset with dims (..., values).
+            vars_of_interest (list[str]): Variables to reshape.
+
+        Returns:
+            xr.Dataset -- Dataset with dims (..., latitude, longitude).
+        """
+        data_vars = {}
+        for v in vars_of_interest:
+            xda = ds[v]
+            dims = tuple(d for d in xda.dims if d != "values")
+            data = xda.transpose(*dims, "values").values
+            # np.take returns a new C-contiguous array, which is what xesmf wants
+            reshaped = np.take(data, self.sort_index, axis=-1)
+            reshaped = reshaped.reshape(data.shape[:-1] + self.shape)
+            data_vars[v] = (dims + ("latitude", "longitude"), reshaped)
+
+        return xr.Dataset(
+            data_vars=data_vars,
+            coords={"latitude": self.latitude, "longitude": self.longitude},
+        )
+
+
+def get_grid_layout(
+    ds: xr.Dataset,
+    layout_dir: str = GRID_LAYOUT_DIR,
+) -> GridLayout:
+    """
+    Get the GridLayout for this dataset's grid from the cache, or compute and cache it.
+
+    Args:
+        ds (xr.Dataset): Anemoi dataset with a flattened "values" dimension.
+        layout_dir (str): Directory to store layouts in. If blank, layouts are only cached in memory.
+
+    Returns:
+        GridLayout -- Layout for this grid.
+    """
+    key = grid_hash(ds)
+    if key in _layouts:
+        return _layouts[key]
+
+    path = os.path.join(layout_dir, f"layout.{key[:16]}.npz") if layout_dir else None
+    if path is not None and os.path.isfile(path):
+        layout = GridLayout.from_npz(path)
+
+    else:
+        layout = GridLayout.from_dataset(ds)
+        if path is not None:
+            os.makedirs(layout_dir, exist_ok=True)
+            layout.to_npz(path)
+
+    _layouts[key] = layout
+    return layout
 
 
 def create_2D_grid(
     ds: xr.Dataset,
     vars_of_interest: list[str] = VARS_OF_INTEREST,
+    layout: GridLayout | None = None,
 ) -> xr.Dataset:
     """
     Reshape dataset from 1D 'values' dimension to 2D latitude and longitude.
@@ -86,48 +337,83 @@ def create_2D_grid(
     Args:
         ds (xr.Dataset): Anemoi dataset with a flattened "values" dimension.
         vars_of_interest (list): Variables to reshape.
+        layout (GridLayout): Precomputed layout for this grid. If None, it's taken from get_grid_layout.
 
     Returns:
         xr.Dataset -- Dataset with shape (time, latitude, longitude).
     """
-    ds_to_reshape = ds.copy()
+    if layout is None:
+        layout = get_grid_layout(ds)
 
-    lats = ds_to_reshape.latitude.values
-    lons = ds_to_reshape.longitude.values
-    sort_index = np.lexsort((lons, lats))
-    ds_to_reshape = ds_to_reshape.isel(values=sort_index)
+    return layout.to_2d(ds, vars_of_interest=vars_of_interest)
 
-    lat_length = len(np.unique(ds_to_reshape.latitude.values))
-    lon_length = len(np.unique(ds_to_reshape.longitude.values))
-    time_length = len(ds["time"].values)
 
-    lats = ds_to_reshape["latitude"][:].values.reshape((lat_length, lon_length))
-    lons = ds_to_reshape["longitude"][:].values.reshape((lat_length, lon_length))
-    lat_1d = lats[:, 0]
-    lon_1d = lons[0, :]
+def regridder_key(
+    ds_in: xr.Dataset,
+    ds_out: xr.Dataset,
+    method: str = "bilinear",
+) -> str:
+    """
+    Unique key for a regridder, based on source and target geometry plus method.
 
-    data_vars = {}
-    for v in vars_of_interest:
-        reshaped_var = ds_to_reshape[v].values.reshape(
-            (time_length, lat_length, lon_length)
-        )
-        data_vars[v] = (["time", "latitude", "longitude"], reshaped_var)
+    Args:
+        ds_in (xr.Dataset): Source grid.
+        ds_out (xr.Dataset): Target grid.
+        method (str): xesmf regridding method.
 
-    reshaped = xr.Dataset(
-        data_vars=data_vars, coords={"latitude": lat_1d, "longitude": lon_1d}
-    )
+    Returns:
+        str -- Key used for both the in-memory and on-disk weight caches.
+    """
+    key = "-".join([grid_hash(ds_in), grid_hash(ds_out), method])
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
 
-    # xesmf was complaining about array not being in C format?
-    # apparently just a performance issue - but was tired of getting the warnings.
-    for var in reshaped.data_vars:
-        reshaped[var].data = np.ascontiguousarray(reshaped[var].values)
-    for coord in reshaped.coords:
-        if coord not in reshaped.dims:
-            reshaped = reshaped.assign_coords(
-                {coord: np.ascontiguousarray(reshaped[coord].values)}
-            )
 
-    return reshaped
+def get_regridder(
+    ds_in: xr.Dataset,
+    ds_out: xr.Dataset,
+    method: str = "bilinear",
+    weights_dir: str = REGRID_WEIGHTS_DIR,
+) -> xe.Regridder:
+    """
+    Get a regridder from the cache, or build one and cache it.
+    The source and target grids don't change across forecast dates, so weights are
+    computed once, stored on disk in weights_dir, and then reused by every later
+    call (and every later run) with the same grids.
+
+    Args:
+        ds_in (xr.Dataset): Source grid.
+        ds_out (xr.Dataset): Target grid.
+        method (str): xesmf regridding method.
+        weights_dir (str): Directory to store weight files in.
+            If blank, weights are only cached in memory.
+
+    Returns:
+        xe.Regridder -- Regridder from ds_in to ds_out.
+    """
+    key = regridder_key(ds_in, ds_out, method=method)
+    if key in _regridders:
+        return _regridders[key]
+
+    kwargs = {}
+    filename = None
+    if weights_dir:
+        os.makedirs(weights_dir, exist_ok=True)
+        filename = os.path.join(weights_dir, f"{method}.{key}.nc")
+        kwargs["filename"] = filename
+        kwargs["reuse_weights"] = os.path.isfile(filename)
+
+    regridder = xe.Regridder(
+        ds_in,
+        ds_out,
+        method=method,
+        unmapped_to_nan=True,
+        **kwargs,
+    )
+    if filename is not None and not kwargs["reuse_weights"]:
+        regridder.to_netcdf(filename)
+
+    _regridders[key] = regridder
+    return regridder
 
 
 def regrid_ds(
@@ -138,6 +424,8 @@ def regrid_ds(
 ) -> xr.Dataset:
     """
     Regrid a dataset.
+    Weights are taken from the cache in get_regridder, so they are only generated
+    the first time a given pair of grids is seen.
 
     Args:
         ds_to_regrid (xr.Dataset): Input dataset to regrid.
@@ -147,11 +435,10 @@ def regrid_ds(
     Returns:
         xr.Dataset -- Regridded dataset.
     """
-    regridder = xe.Regridder(
+    regridder = get_regridder(
         ds_to_regrid,
         ds_out,
         method="bilinear",
-        unmapped_to_nan=True,
     )
     ds_regridded = regridder(ds_to_regrid)
 
@@ -180,25 +467,19 @@ def flatten_grid(
     Returns:
         xr.Dataset -- Flattened dataset with 'values' dimension like an anemoi-dataset.
     """
-    reshaped_lat_lon = np.meshgrid(
+    lats, lons = np.meshgrid(
         ds_to_flatten["latitude"].values,
         ds_to_flatten["longitude"].values,
+        indexing="ij",
     )
 
-    lats = reshaped_lat_lon[0].transpose().reshape(-1)
-    lons = reshaped_lat_lon[1].transpose().reshape(-1)
-
     data_vars = {}
     for v in vars_of_interest:
-        reshaped_array = []
-        for t in np.arange(len(ds_to_flatten["time"].values)):
-            arr = ds_to_flatten[v][t, :].values.reshape(-1)
-            reshaped_array.append(arr)
-        reshaped_array = np.array(reshaped_array)
-        data_vars[v] = (["time", "values"], reshaped_array)
+        data = ds_to_flatten[v].transpose("time", "latitude", "longitude").values
+        data_vars[v] = (["time", "values"], data.reshape((data.shape[0], -1)))
 
-    data_vars["latitude"] = ("values", lats)
-    data_vars["longitude"] = ("values", lons)
+    data_vars["latitude"] = ("values", lats.reshape(-1))
+    data_vars["longitude"] = ("values", lons.reshape(-1))
 
     ds_flattened = xr.Dataset(
         data_vars=data_vars,
@@ -279,6 +560,7 @@ def regrid_for_wbx(
     ds_nested: xr.Dataset,
     wbx_target_path=WBX_TARGET_PATH,
     lam_target_path=LAM_TARGET_PATH,
+    index_plan: dict | None = None,
 ) -> xr.Dataset:
     """
     Full regridding pipeline: regrid a nested anemoi dataset to match weatherbench target grid.
@@ -288,6 +570,7 @@ def regrid_for_wbx(
         ds_nested (xr.Dataset): Forecast dataset to regrid.
         wbx_target_path (str): Path to weatherbench grid.
         lam_target_path (str): Path to a global resolution to regrid the lam to global res.
+        index_plan (dict): Precomputed LAM/global split from get_index_plan, reused across dates.
 
     Returns:
         xr.Dataset -- Regridded dataset aligned to weatherbench grid.
@@ -297,6 +580,7 @@ def regrid_for_wbx(
     ds_lam, ds_global = extract_data(
         ds_lam=ds_lam_grid,
         ds_nested=ds_nested,
+        index_plan=index_plan,
     )
 
     ds_lam_2d = create_2D_grid(
@@ -361,62 +645,296 @@ def get_lam_grid(
     return ds
 
 
+def process_date(
+    idx: int,
+    date: pd.Timestamp,
+    ds_lam_grid: xr.Dataset,
+    index_plan: dict | None = None,
+) -> xr.Dataset:
+    """
+    Read and regrid the forecast from a single date, ready to be written to the wbx zarr.
+
+    Args:
+        idx (int): Index of this date in the full list of dates.
+        date (pd.Timestamp): Date to process.
+        ds_lam_grid (xr.Dataset): Static LAM file to define the domain.
+        index_plan (dict): Precomputed LAM/global split from get_index_plan.
+
+    Returns:
+        xr.Dataset -- Regridded forecast with dims (time, fhr, latitude, longitude), where len(time) = 1.
+    """
+    dt = datetime.fromisoformat(str(date))
+    date_str = dt.strftime("%Y%m%dT%H%M%SZ")
+
+    ds_nested = xr.open_dataset(f"{date_str}.nc")
+    if index_plan is None:
+        index_plan = get_index_plan(ds_lam=ds_lam_grid, ds_nested=ds_nested)
+
+    ds = regrid_for_wbx(
+        ds_lam_grid=ds_lam_grid,
+        ds_nested=ds_nested,
+        index_plan=index_plan,
+    )
+    ds = ds.rename({"time": "fhr"})
+
+    time_value = np.datetime64(date) + np.timedelta64(idx, "h")
+    ds = ds.expand_dims({"time": [time_value]})
+    ds = ds.transpose("time", "fhr", "latitude", "longitude")
+    return ds
+
+
+def get_container_times(
+    dates: pd.date_range,
+) -> list[np.datetime64]:
+    """
+    The time axis of the container, where each date is offset by its index in hours, as in process_date.
+
+    Args:
+        dates (pd.date_range): All dates that will be written.
+
+    Returns:
+        list[np.datetime64] -- One time per date.
+    """
+    return [np.datetime64(date) + np.timedelta64(idx, "h") for idx, date in enumerate(dates)]
+
+
+def check_container_times(
+    path_to_output_zarr: str,
+    dates: pd.date_range,
+) -> None:
+    """
+    Make sure that an existing container was created for these dates, before resuming into it.
+
+    Args:
+        path_to_output_zarr (str): Path to the container.
+        dates (pd.date_range): All dates that will be written.
+    """
+    expected = np.array(get_container_times(dates), dtype="datetime64[ns]")
+    with xr.open_zarr(path_to_output_zarr) as ds:
+        found = ds["time"].values.astype("datetime64[ns]")
+
+    if len(found) != len(expected) or not np.array_equal(found, expected):
+        raise ValueError(
+            f"create_zarr_for_wbx: the time axis in {path_to_output_zarr} doesn't match the requested dates "
+            f"({len(found)} vs {len(expected)} times), rerun with the same dates, or remove the store to start over"
+        )
+
+
+def create_container(
+    ds: xr.Dataset,
+    dates: pd.date_range,
+) -> xr.Dataset:
+    """
+    Create an empty dataset with the full time axis, to be filled with region writes.
+
+    Args:
+        ds (xr.Dataset): Output from process_date for any date, used as a template.
+        dates (pd.date_range): All dates that will be written.
+
+    Returns:
+        xr.Dataset -- Lazy container with one chunk per time.
+    """
+    times = get_container_times(dates)
+
+    nds = xr.Dataset(attrs=ds.attrs.copy())
+    nds["time"] = xr.DataArray(
+        times,
+        coords={"time": times},
+        dims="time",
+    )
+    for key in ds.dims:
+        if key != "time":
+            nds[key] = ds[key].copy()
+
+    chunks = {"time": 1, "fhr": -1, "latitude": -1, "longitude": -1}
+    for varname in ds.data_vars:
+        dims = ds[varname].dims
+        shape = tuple(len(nds[key]) for key in dims)
+        nds[varname] = xr.DataArray(
+            data=dask.array.zeros(
+                shape=shape,
+                chunks=tuple(chunks[key] for key in dims),
+                dtype=ds[varname].dtype,
+            ),
+            dims=dims,
+            attrs=ds[varname].attrs.copy(),
+        )
+    return nds
+
+
+def write_region(
+    ds: xr.Dataset,
+    idx: int,
+    path_to_output_zarr: str,
+) -> None:
+    """
+    Write a single date into its slot of the preallocated container.
+
+    Args:
+        ds (xr.Dataset): Output from process_date.
+        idx (int): Index of this date in the full list of dates.
+        path_to_output_zarr (str): Path to the container.
+    """
+    # only variables along time are written, everything else is already in the container
+    ds = ds.drop_vars([key for key in ds.variables if "time" not in ds[key].dims])
+    ds.to_zarr(path_to_output_zarr, region={"time": slice(idx, idx + 1)})
+
+
+def _process_and_write(
+    idx: int,
+    date: pd.Timestamp,
+    ds_lam_grid: xr.Dataset,
+    index_plan: dict,
+    path_to_output_zarr: str,
+) -> pd.Timestamp:
+    """Worker task for create_zarr_for_wbx"""
+    ds = process_date(idx=idx, date=date, ds_lam_grid=ds_lam_grid, index_plan=index_plan)
+    write_region(ds, idx=idx, path_to_output_zarr=path_to_output_zarr)
+    return date
+
+
+def read_manifest(
+    path: str,
+) -> set[str]:
+    """
+    Read the dates that have already been written.
+
+    Args:
+        path (str): Path to the manifest, one ISO date per line.
+
+    Returns:
+        set[str] -- Completed dates, empty if the manifest doesn't exist.
+    """
+    if not os.path.isfile(path):
+        return set()
+    with open(path, "r") as f:
+        return set(line.strip() for line in f if line.strip())
+
+
 def create_zarr_for_wbx(
     dates: pd.date_range,
     path_to_lam_file: str = PATH_TO_LAM_FILE,
     path_to_output_zarr: str = PATH_TO_OUTPUT_ZARR,
+    n_workers: int = N_WORKERS,
 ) -> None:
     """
     Main function: read, regrid, and write to Zarr format ready for weatherbench.
 
+    The full time axis is preallocated, and then each date is written to its own region,
+    so dates can be processed in parallel. Finished dates are recorded in a manifest
+    next to the zarr store ("<path_to_output_zarr>.completed.txt"),
+    and rerunning skips any dates that are in there, as long as the dates are the same as before.
+    A date that fails doesn't stop the others, the ones that succeed are recorded in the manifest,
+    and then a RuntimeError lists the failures, which the next run will retry.
+
     Args:
         dates (pd.date_range): List of dates to run inference for.
         path_to_lam_file (str): Path to LAM static file.
         path_to_output_zarr (str): Path to store zarr output.
+        n_workers (int): Number of processes to use. With 1, dates are processed one at a time.
 
     Returns:
         None
     """
-    ds_lam_grid = get_lam_grid(path_to_lam_file=path_to_lam_file)
-
-    for idx, date in enumerate(dates):
-        dt = datetime.fromisoformat(str(date))
-        date_str = dt.strftime("%Y%m%dT%H%M%SZ")
-
-        ds_nested = xr.open_dataset(f"{date_str}.nc")
-        ds = regrid_for_wbx(ds_lam_grid=ds_lam_grid, ds_nested=ds_nested)
-        ds = ds.rename({"time": "fhr"})
+    ds_lam_grid = get_lam_grid(path_to_lam_file=path_to_lam_file).load()
+
+    manifest_path = f"{path_to_output_zarr}.completed.txt"
+    completed = read_manifest(manifest_path) if os.path.isdir(path_to_output_zarr) else set()
+    if len(completed) > 0:
+        check_container_times(path_to_output_zarr, dates)
+
+    # the first date is done here, to create the container and the index plan,
+    # and so that regridding weights are on disk before any workers start
+    first = dates[0]
+    ds_nested = xr.open_dataset(
+        f"{datetime.fromisoformat(str(first)).strftime('%Y%m%dT%H%M%SZ')}.nc"
+    )
+    index_plan = get_index_plan(ds_lam=ds_lam_grid, ds_nested=ds_nested)
 
-        time_value = np.datetime64(date) + np.timedelta64(idx, "h")
-        ds = ds.expand_dims({"time": [time_value]})
-        ds = ds.transpose("time", "fhr", "latitude", "longitude")
+    if len(completed) == 0:
+        ds = process_date(idx=0, date=first, ds_lam_grid=ds_lam_grid, index_plan=index_plan)
 
+        print("saving container")
         encoding = {
             "time": {
                 "units": f"hours since {dates[0]}",
                 "calendar": "standard",
             }
         }
-
-        if idx == 0:
-            print("saving container")
-            ds.to_zarr(path_to_output_zarr, mode="w", encoding=encoding)
-        elif idx > 0:
+        container = create_container(ds, dates)
+        container.to_zarr(path_to_output_zarr, compute=False, mode="w", encoding=encoding)
+        if os.path.isfile(manifest_path):
+            os.remove(manifest_path)
+
+        print(f"saving timestep for {first}")
+        write_region(ds, idx=0, path_to_output_zarr=path_to_output_zarr)
+        completed.add(str(first))
+        with open(manifest_path, "a") as f:
+            f.write(f"{first}\n")
+
+    todo = [(idx, date) for idx, date in enumerate(dates) if str(date) not in completed]
+    print(f"{len(completed)} dates already done, {len(todo)} to go")
+
+    failed = []
+    if n_workers == 1:
+        for idx, date in todo:
+            try:
+                _process_and_write(idx, date, ds_lam_grid, index_plan, path_to_output_zarr)
+            except Exception as e:
+                print(f"failed on {date}: {e!r}")
+                failed.append(date)
+                continue
+            with open(manifest_path, "a") as f:
+                f.write(f"{date}\n")
             print(f"saving timestep for {date}")
-            ds.to_zarr(path_to_output_zarr, mode="a", append_dim="time")
+
+    else:
+        # ESMF doesn't like being forked, so use fresh processes
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as executor:
+            futures = {
+                executor.submit(
+                    _process_and_write,
+                    idx,
+                    date,
+                    ds_lam_grid,
+                    index_plan,
+                    path_to_output_zarr,
+                ): date
+                for idx, date in todo
+            }
+            # only this process writes to the manifest
+            for future in as_completed(futures):
+                date = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"failed on {date}: {e!r}")
+                    failed.append(date)
+                    continue
+                with open(manifest_path, "a") as f:
+                    f.write(f"{date}\n")
+                print(f"saving timestep for {date}")
+
+    if len(failed) > 0:
+        raise RuntimeError(
+            f"create_zarr_for_wbx: {len(failed)} / {len(todo)} dates failed: {sorted(str(date) for date in failed)}. "
+            f"The rest are in {manifest_path}, rerun to retry these"
+        )
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: create_wbx_zarr.py <start_date>  <end_date>  <freq>")
+    if len(sys.argv) not in (4, 5):
+        print("Usage: create_wbx_zarr.py <start_date>  <end_date>  <freq>  [n_workers]")
         print(
-            "Example: create_wbx_zarr.py '2018-01-06T00:00:00' '2018-01-08T00:00:00' '12h'"
+            "Example: create_wbx_zarr.py '2018-01-06T00:00:00' '2018-01-08T00:00:00' '12h' 32"
         )
         sys.exit(1)
 
     start_date = sys.argv[1]
     end_date = sys.argv[2]
     freq = sys.argv[3]
+    n_workers = int(sys.argv[4]) if len(sys.argv) == 5 else N_WORKERS
 
     dates = pd.date_range(start=start_date, end=end_date, freq=freq)
-    create_zarr_for_wbx(dates)
+    create_zarr_for_wbx(dates, n_workers=n_workers)
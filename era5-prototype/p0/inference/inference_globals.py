@@ -54,5 +54,21 @@ LAM_TARGET_PATH = "global_one_degree.nc"
 # tldr --- you just need a static lam (conus) file here that will be used to clip the nested file to the conus domain.
 PATH_TO_LAM_FILE = "lam.nc"
 
+# directory to store regridding weights, so they are only computed once for all dates (and runs)
+# if left blank, weights are only reused within a single run
+REGRID_WEIGHTS_DIR = "regrid-weights"
+
+# directory to store the sort permutations used to reshape "values" -> (latitude, longitude)
+# if left blank, these are only reused within a single run
+GRID_LAYOUT_DIR = "grid-layouts"
+
+# number of LAM points at the start of the nested "values" dimension (same as lam_index in the eagle yamls)
+# if given, this is used to split LAM/global instead of the bounding box of PATH_TO_LAM_FILE
+# leave as None to use the bounding box
+LAM_INDEX = None
+
 # path to save final zarr that will then go through wbx
 PATH_TO_OUTPUT_ZARR = "test.zarr"
+
+# number of processes used to regrid and write dates, can be overridden on the command line
+N_WORKERS = 1
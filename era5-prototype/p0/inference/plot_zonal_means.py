@@ -15,6 +15,8 @@ import xesmf
 
 from graphufs.log import setup_simple_log
 
+from visualize import get_cached_truth
+
 def plot_t2m(pda, tda):
 
     fig, axs = plt.subplots(
@@ -85,25 +87,106 @@ def regrid(pds, tds):
     ds_out = regridder(pds[["2m_temperature"]].isel(time=0), keep_attrs=True)
     return ds_out
 
-def nested_zonal_mean(xds):
+def binned_mean(
+    xda,
+    bin_edges,
+    coord="latitude",
+    dim="values",
+    bin_dim="lat",
+    weights=None,
+    chunk_size=None,
+):
+    """Mean of xda within bins of one of its coordinates along an unstructured dimension
+
+    This is done in a single pass over the data with np.bincount, rather than masking
+    the whole array once per bin. Everything that isn't along dim (e.g. time) is
+    streamed through in blocks of chunk_size, so only one block is in memory at a time.
+
+    Args:
+        xda (xr.DataArray): with dim and coord, e.g. nested data with (time, values)
+        bin_edges (array_like): monotonically increasing bin edges, each bin includes its lower edge,
+            and the last one its upper edge too, e.g. the north pole. Values outside are ignored
+        coord (str): coordinate to bin by, "latitude" for zonal means or "longitude" for meridional means
+        dim (str): the unstructured dimension to reduce
+        bin_dim (str): name of the output dimension, with bin centers as coordinate values
+        weights (array_like, optional): along dim, e.g. cell area or np.cos(np.deg2rad(latitude))
+            for an area weighted mean
+        chunk_size (int, optional): number of entries along the other dims to load at once,
+            default is everything
+
+    Returns:
+        xr.DataArray: with dim replaced by bin_dim
+    """
+    bin_edges = np.asarray(bin_edges)
+    n_bins = len(bin_edges) - 1
+    centers = 0.5 * (bin_edges[1:] + bin_edges[:-1])
+
+    values = xda[coord].values
+    bins = np.digitize(values, bin_edges) - 1
+    bins[values == bin_edges[-1]] = n_bins - 1
+    inside = (bins >= 0) & (bins < n_bins)
+    bins = bins[inside]
+    weights = np.ones(len(xda[dim])) if weights is None else np.asarray(weights)
+    weights = weights[inside]
+
+    other_dims = [d for d in xda.dims if d != dim]
+    other_shape = tuple(len(xda[d]) for d in other_dims)
+    n_rows = int(np.prod(other_shape))
+    chunk_size = n_rows if chunk_size is None else chunk_size
+
+    flat = xda.transpose(*other_dims, dim).data.reshape((n_rows, -1))
+    result = np.empty((n_rows, n_bins))
+    for start in range(0, n_rows, chunk_size):
+        data = np.asarray(flat[start:start + chunk_size])[:, inside]
+        rows = data.shape[0]
+
+        valid = np.isfinite(data)
+        index = (np.arange(rows)[:, None] * n_bins + bins[None, :])[valid]
+        total = np.bincount(
+            index,
+            weights=(data * weights[None, :])[valid],
+            minlength=rows * n_bins,
+        )
+        norm = np.bincount(
+            index,
+            weights=np.broadcast_to(weights, data.shape)[valid],
+            minlength=rows * n_bins,
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result[start:start + rows] = (total / norm).reshape((rows, n_bins))
+
+    coords = {d: xda[d] for d in other_dims if d in xda.coords}
+    coords[bin_dim] = centers
+    return xr.DataArray(
+        result.reshape(other_shape + (n_bins,)),
+        coords=coords,
+        dims=other_dims + [bin_dim],
+        attrs=xda.attrs.copy(),
+        name=xda.name,
+    )
+
 
+def nested_zonal_mean(xds, bin_edges=None, **kwargs):
+    """Zonal mean of nested data, with latitude bins (default 1 degree) ordered north -> south
 
-    nds = xr.Dataset()
-    lat = np.arange(89.5, -90, -1)
-    nds["lat"] = xr.DataArray(
-        lat,
-        coords={"lat": lat},
-        dims=("lat",),
-    )
+    Args:
+        xds (xr.DataArray or xr.Dataset): with "values" dimension and "latitude" coordinate
+        bin_edges (array_like, optional): latitude bin edges, default is every degree from -90 to 90
+        **kwargs: passed to binned_mean
 
-    dslist = []
-    for thislat in lat:
+    Returns:
+        xr.DataArray or xr.Dataset: with "values" replaced by "lat"
+    """
 
-        tmp = xds.where(xds["latitude"] == thislat).mean("values")
-        tmp = tmp.expand_dims({"lat": [thislat]})
-        dslist.append(tmp)
+    bin_edges = np.arange(-90, 91, 1) if bin_edges is None else bin_edges
+    if isinstance(xds, xr.Dataset):
+        xds = xds.set_coords([key for key in ["latitude", "longitude"] if key in xds.data_vars])
+        zds = xds.map(binned_mean, bin_edges=bin_edges, **kwargs)
+    else:
+        zds = binned_mean(xds, bin_edges, **kwargs)
 
-    return xr.concat(dslist, dim="lat")
+    zds = zds.sortby("lat", ascending=False)
+    return zds.transpose("lat", ...)
 
 
 
@@ -112,6 +195,7 @@ def main(
     store_dir,
     t0="2019-01-01T00",
     tf="2019-12-31T18",
+    truth_cache_dir="truth-cache",
 ):
 
     setup_simple_log()
@@ -123,12 +207,12 @@ def main(
     pds = xr.open_dataset(read_path)
     pds = pds.set_coords(["latitude", "longitude"])
 
-    era = xr.open_zarr(
-        "gs://weatherbench2/datasets/era5/1959-2023_01_10-wb13-6h-1440x721_with_derived_variables.zarr",
-        storage_options={"token": "anon"},
-    )
-    era = era.sel(
+    era = get_cached_truth(
+        "ERA5",
+        variables=["2m_temperature", "geopotential"],
         time=pds.time.values,
+        levels=[500],
+        cache_dir=truth_cache_dir,
     )
     era = era.rename({"latitude": "lat", "longitude": "lon"})
 
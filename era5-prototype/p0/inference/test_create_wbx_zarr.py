@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+pytest.importorskip("xesmf")
+
+import create_wbx_zarr
+
+
+def value(date):
+    return float(date.day*100 + date.hour)
+
+
+@pytest.fixture
+def fake_regrid(tmp_path, monkeypatch):
+    """Stand in for reading and regridding, every date is filled with value(date), and can be told to fail"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(create_wbx_zarr, "get_lam_grid", lambda path_to_lam_file: xr.Dataset())
+    monkeypatch.setattr(create_wbx_zarr, "get_index_plan", lambda ds_lam, ds_nested: {})
+    monkeypatch.setattr(
+        create_wbx_zarr,
+        "ProcessPoolExecutor",
+        lambda max_workers, mp_context=None: ThreadPoolExecutor(max_workers=max_workers),
+    )
+    fail, processed = set(), []
+
+    def process_date(idx, date, ds_lam_grid, index_plan=None):
+        processed.append(date)
+        if date in fail:
+            raise OSError(f"could not read {date}")
+        time_value = np.datetime64(date) + np.timedelta64(idx, "h")
+        return xr.Dataset(
+            {"2m_temperature": (("time", "fhr", "latitude", "longitude"), np.full((1, 2, 3, 4), value(date)))},
+            coords={"time": [time_value], "fhr": [0, 6], "latitude": np.arange(3.), "longitude": np.arange(4.)},
+        )
+
+    monkeypatch.setattr(create_wbx_zarr, "process_date", process_date)
+    for date in pd.date_range("2018-01-06", "2018-01-08", freq="6h"):
+        xr.Dataset().to_netcdf(tmp_path / f"{date:%Y%m%dT%H%M%SZ}.nc")
+    return fail, processed
+
+
+@pytest.mark.parametrize("n_workers", [1, 3])
+def test_failed_dates_are_retried(tmp_path, fake_regrid, n_workers):
+    fail, processed = fake_regrid
+    dates = pd.date_range("2018-01-06", "2018-01-08", freq="12h")
+    store = str(tmp_path / "wbx.zarr")
+    fail.update([dates[1], dates[3]])
+
+    # the other dates are still written and recorded, and then the failures are raised
+    with pytest.raises(RuntimeError, match="2 / 4 dates failed"):
+        create_wbx_zarr.create_zarr_for_wbx(dates, path_to_lam_file="lam.nc", path_to_output_zarr=store, n_workers=n_workers)
+    assert create_wbx_zarr.read_manifest(f"{store}.completed.txt") == {str(d) for d in dates.delete([1, 3])}
+    assert sorted(processed) == list(dates)
+
+    fail.clear()
+    processed.clear()
+    create_wbx_zarr.create_zarr_for_wbx(dates, path_to_lam_file="lam.nc", path_to_output_zarr=store, n_workers=n_workers)
+    assert sorted(processed) == [dates[1], dates[3]]
+
+    ds = xr.open_zarr(store)
+    np.testing.assert_array_equal(ds["time"].values, np.array(create_wbx_zarr.get_container_times(dates), dtype="datetime64[ns]"))
+    np.testing.assert_array_equal(ds["2m_temperature"].isel(fhr=0, latitude=0, longitude=0), [value(d) for d in dates])
+
+
+def test_resume_with_other_dates_raises(tmp_path, fake_regrid):
+    fail, processed = fake_regrid
+    dates = pd.date_range("2018-01-06", "2018-01-08", freq="12h")
+    store = str(tmp_path / "wbx.zarr")
+    fail.add(dates[-1])
+    with pytest.raises(RuntimeError):
+        create_wbx_zarr.create_zarr_for_wbx(dates, path_to_lam_file="lam.nc", path_to_output_zarr=store)
+
+    processed.clear()
+    for other in [dates[:-1], pd.date_range("2018-01-06", "2018-01-08", freq="6h")]:
+        with pytest.raises(ValueError, match="time axis"):
+            create_wbx_zarr.create_zarr_for_wbx(other, path_to_lam_file="lam.nc", path_to_output_zarr=store)
+    assert processed == []
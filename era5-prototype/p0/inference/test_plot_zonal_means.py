@@ -0,0 +1,62 @@
+import numpy as np
+import xarray as xr
+import pytest
+
+pytest.importorskip("cartopy")
+pytest.importorskip("cmocean")
+pytest.importorskip("xesmf")
+pytest.importorskip("graphufs")
+
+import plot_zonal_means
+
+
+@pytest.fixture
+def nested():
+    """Nested data on a flattened 0.25 degree grid, from pole to pole, with a few NaNs"""
+    lat, lon = np.meshgrid(np.arange(-90, 90.1, 0.25), np.arange(0, 360, 5.), indexing="ij")
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(3, lat.size))
+    data[1, ::17] = np.nan
+    return xr.DataArray(
+        data,
+        coords={"time": [0, 1, 2], "latitude": ("values", lat.ravel()), "longitude": ("values", lon.ravel())},
+        dims=("time", "values"),
+        name="2m_temperature",
+    )
+
+
+def groupby_bins_zonal_mean(xda, bin_edges):
+    """The reference, with the top edge nudged up so the last bin includes the north pole"""
+    edges = np.array(bin_edges, dtype=float)
+    edges[-1] = np.nextafter(edges[-1], np.inf)
+    result = xda.groupby_bins("latitude", edges, right=False).mean("values")
+    result = result.rename({"latitude_bins": "lat"})
+    result["lat"] = 0.5 * (np.asarray(bin_edges)[1:] + np.asarray(bin_edges)[:-1])
+    return result.sortby("lat", ascending=False).transpose("lat", ...)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 2])
+def test_matches_groupby_bins(nested, chunk_size):
+    bin_edges = np.arange(-90, 91, 1)
+    expected = groupby_bins_zonal_mean(nested, bin_edges)
+    result = plot_zonal_means.nested_zonal_mean(nested, chunk_size=chunk_size)
+    np.testing.assert_array_equal(result["lat"], expected["lat"])
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-12)
+
+
+def test_poles(nested):
+    """Both poles land in the outermost bins, which aren't NaN"""
+    result = plot_zonal_means.nested_zonal_mean(nested)
+    assert result["lat"].values[0] == 89.5 and result["lat"].values[-1] == -89.5
+    assert np.isfinite(result.values).all()
+
+    for pole, center in [(90, 89.5), (-90, -89.5)]:
+        lat = nested["latitude"]
+        below_top = lat <= 90 if pole == 90 else lat < center + 0.5
+        in_bin = nested.where((lat >= center - 0.5) & below_top)
+        nudged = nested.where(nested["latitude"] != pole, 1e6)
+        assert not np.allclose(
+            plot_zonal_means.nested_zonal_mean(nudged).sel(lat=center).values,
+            result.sel(lat=center).values,
+        )
+        np.testing.assert_allclose(result.sel(lat=center).values, in_bin.mean("values").values, rtol=1e-12)
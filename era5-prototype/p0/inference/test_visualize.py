@@ -0,0 +1,138 @@
+import glob
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+pytest.importorskip("cartopy")
+pytest.importorskip("cmocean")
+
+import visualize
+
+
+@pytest.fixture
+def remote(monkeypatch):
+    """A fake remote truth dataset, counting how many times it gets opened"""
+    calls = []
+    time = pd.date_range("2018-01-01", periods=8, freq="6h")
+    level = [250, 500, 850]
+    rng = np.random.default_rng(0)
+    xds = xr.Dataset(
+        {
+            "temperature": (("time", "level", "lat", "lon"), rng.normal(size=(8, 3, 4, 5))),
+            "2m_temperature": (("time", "lat", "lon"), rng.normal(size=(8, 4, 5))),
+        },
+        coords={"time": time, "level": level, "lat": np.arange(4.), "lon": np.arange(5.)},
+    )
+
+    def get_truth(name):
+        calls.append(name)
+        truth = xds.copy()
+        truth.attrs["name"] = name
+        return truth
+
+    monkeypatch.setattr(visualize, "get_truth", get_truth)
+    return xds, calls
+
+
+def test_cache_hit_and_miss(tmp_path, remote):
+    xds, calls = remote
+    cache_dir = str(tmp_path)
+    times = xds["time"].values
+
+    # miss, then hit
+    truth = visualize.get_cached_truth("ERA5", ["temperature"], times[:4], cache_dir=cache_dir)
+    assert len(calls) == 1
+    truth = visualize.get_cached_truth("ERA5", ["temperature"], times[:4], cache_dir=cache_dir)
+    assert len(calls) == 1
+    xr.testing.assert_allclose(truth["temperature"], xds["temperature"].isel(time=slice(4)))
+
+    # a cache with all levels has any subset of levels and times
+    truth = visualize.get_cached_truth("ERA5", ["temperature"], times[1:3], levels=[500], cache_dir=cache_dir)
+    assert len(calls) == 1
+    xr.testing.assert_allclose(truth["temperature"], xds["temperature"].isel(time=slice(1, 3)).sel(level=[500]))
+
+    # but not other times or variables
+    visualize.get_cached_truth("ERA5", ["temperature"], times[4:], cache_dir=cache_dir)
+    assert len(calls) == 2
+    visualize.get_cached_truth("ERA5", ["2m_temperature"], times[:4], cache_dir=cache_dir)
+    assert len(calls) == 3
+
+
+def test_explicit_levels_vs_all_levels(tmp_path, remote):
+    xds, calls = remote
+    cache_dir = str(tmp_path)
+    times = xds["time"].values[:2]
+
+    visualize.get_cached_truth("ERA5", ["temperature"], times, levels=[500, 850], cache_dir=cache_dir)
+    assert len(calls) == 1
+
+    # a subset of the cached levels is a hit
+    truth = visualize.get_cached_truth("ERA5", ["temperature"], times, levels=[850], cache_dir=cache_dir)
+    assert len(calls) == 1
+    np.testing.assert_array_equal(truth["level"], [850])
+
+    # a level that wasn't cached is a miss
+    visualize.get_cached_truth("ERA5", ["temperature"], times, levels=[250], cache_dir=cache_dir)
+    assert len(calls) == 2
+
+    # levels=None means all levels, which neither store is known to have
+    truth = visualize.get_cached_truth("ERA5", ["temperature"], times, levels=None, cache_dir=cache_dir)
+    assert len(calls) == 3
+    np.testing.assert_array_equal(truth["level"], xds["level"])
+
+
+def test_interrupted_write_is_not_a_hit(tmp_path, remote, monkeypatch):
+    xds, calls = remote
+    cache_dir = str(tmp_path)
+    times = xds["time"].values[:2]
+
+    to_zarr = xr.Dataset.to_zarr
+
+    def crash(self, store, *args, **kwargs):
+        # write the metadata and then die, like a killed job
+        to_zarr(self.isel(time=slice(1)), store, *args, **kwargs)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(xr.Dataset, "to_zarr", crash)
+    with pytest.raises(KeyboardInterrupt):
+        visualize.get_cached_truth("ERA5", ["temperature"], times, cache_dir=cache_dir)
+    monkeypatch.setattr(xr.Dataset, "to_zarr", to_zarr)
+
+    assert glob.glob(f"{cache_dir}/*.zarr") == []
+    truth = visualize.get_cached_truth("ERA5", ["temperature"], times, cache_dir=cache_dir)
+    assert len(calls) == 2
+    xr.testing.assert_allclose(truth["temperature"], xds["temperature"].isel(time=slice(2)))
+
+
+def test_pixel_lookups_are_built_before_the_pool(monkeypatch):
+    """Workers get the lookups from render_movies, rather than each building their own"""
+    truth_lon, truth_lat = np.meshgrid(np.arange(0., 360., 10.), np.arange(-85., 90., 10.))
+    nested = xr.Dataset(
+        {"Prediction: Nested-ERA5": (("time", "values"), np.zeros((2, 50)))},
+        coords={
+            "longitudes": ("values", np.linspace(230, 300, 50)),
+            "latitudes": ("values", np.linspace(20, 50, 50)),
+        },
+    )
+    datasets = {"2m_temperature": nested, "10m_wind": nested}
+    options = {
+        varname: {"renderer": "raster", "raster_shape": (40, 40), "truth_x": truth_lon, "truth_y": truth_lat}
+        for varname in datasets
+    }
+
+    monkeypatch.setattr(visualize, "_pixel_lookups", {})
+    lookups = visualize.build_pixel_lookups(datasets, options)
+    assert len(lookups) == 2
+
+    def no_tree(*args, **kwargs):
+        raise AssertionError("a worker built its own pixel lookup")
+
+    monkeypatch.setattr(visualize, "_pixel_lookups", {})
+    monkeypatch.setattr(visualize, "cKDTree", no_tree)
+    visualize._init_movie_worker(datasets, options, 4, 3, 50, lookups)
+    visualize.plt.close(visualize._worker_state["fig"])
+    for lons, lats in [(truth_lon, truth_lat), (nested.longitudes, nested.latitudes)]:
+        visualize.get_pixel_lookup(lons, lats, shape=(40, 40))
+    assert visualize._pixel_lookups.keys() == lookups.keys()
@@ -1,6 +1,13 @@
 import os
+import io
 import sys
+import glob
+import json
+import shutil
+import hashlib
 import logging
+import subprocess
+import multiprocessing
 
 import numpy as np
 import xarray as xr
@@ -10,6 +17,7 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import BoundaryNorm
 import cartopy.crs as ccrs
 import cmocean
+from scipy.spatial import cKDTree
 
 try:
     import xmovie
@@ -22,6 +30,12 @@ _projection = ccrs.Orthographic(
     central_latitude = 20,
 )
 
+# pixel -> node lookups for renderer="raster", see get_pixel_lookup
+_pixel_lookups = {}
+
+# each movie worker's datasets, options, and figure, see render_movies
+_worker_state = {}
+
 class SimpleFormatter(logging.Formatter):
     def format(self, record):
         record.relativeCreated = record.relativeCreated // 1000
@@ -71,24 +85,7 @@ def get_precip_kwargs():
     cmap = plt.get_cmap("cmo.rain", len(levels)+1)
     return {"norm": norm, "cmap": cmap, "cbar_kwargs": {"ticks": [0, 1, 10, 50]}}
 
-def nested_scatter(ax, xds, varname, **kwargs):
-    n_conus = 38_829
-    mappables = []
-    for slc, s in zip(
-        [slice(None, n_conus), slice(n_conus, None)],
-        [1/2, 12],
-    ):
-
-        p = ax.scatter(
-            xds.longitudes.isel(values=slc),
-            xds.latitudes.isel(values=slc),
-            c=xds[varname].isel(values=slc),
-            s=s,
-            transform=ccrs.PlateCarree(),
-            **kwargs
-        )
-        mappables.append(p)
-
+def plot_conus_box(ax):
     # Define bounding box corners
     lons = 225, 300
     lats = 21, 53
@@ -108,8 +105,121 @@ def nested_scatter(ax, xds, varname, **kwargs):
         xL = np.arange(*lons, .25)
         yL = np.full_like(xL, lat)
         ax.scatter(xL, yL, **kw)
+
+def nested_scatter(ax, xds, varname, **kwargs):
+    n_conus = 38_829
+    mappables = []
+    for slc, s in zip(
+        [slice(None, n_conus), slice(n_conus, None)],
+        [1/2, 12],
+    ):
+
+        p = ax.scatter(
+            xds.longitudes.isel(values=slc),
+            xds.latitudes.isel(values=slc),
+            c=xds[varname].isel(values=slc),
+            s=s,
+            transform=ccrs.PlateCarree(),
+            **kwargs
+        )
+        mappables.append(p)
+
+    plot_conus_box(ax)
     return mappables
 
+def lonlat_to_xyz(lons, lats):
+    lons = np.deg2rad(lons)
+    lats = np.deg2rad(lats)
+    return np.stack(
+        [
+            np.cos(lats) * np.cos(lons),
+            np.cos(lats) * np.sin(lons),
+            np.sin(lats),
+        ],
+        axis=-1,
+    )
+
+def get_pixel_lookup(lons, lats, shape=(1000, 1000), projection=_projection):
+    """For each pixel of an image in projection, find the index of the nearest node
+
+    This only depends on the grid, image shape, and projection, so it's cached and
+    every frame after the first is just an array lookup.
+
+    Args:
+        lons, lats (array_like): node locations, any shape, they get flattened
+        shape (tuple): (n_y, n_x) pixels in the image
+        projection (ccrs.Projection): that the image is drawn in
+
+    Returns:
+        lookup (np.ndarray): with shape, index of nearest node or -1 if the pixel is off the globe
+        extent (tuple): (x0, x1, y0, y1) of the image in projection coordinates, for imshow
+    """
+    lons = np.asarray(lons).reshape(-1)
+    lats = np.asarray(lats).reshape(-1)
+    # hashlib rather than hash, so that keys are the same in every process
+    key = (
+        hashlib.sha1(lons.tobytes()).hexdigest(),
+        hashlib.sha1(lats.tobytes()).hexdigest(),
+        tuple(shape),
+        projection.proj4_init,
+    )
+    if key not in _pixel_lookups:
+
+        x0, x1 = projection.x_limits
+        y0, y1 = projection.y_limits
+        px, py = np.meshgrid(
+            np.linspace(x0, x1, shape[1]),
+            np.linspace(y0, y1, shape[0]),
+        )
+        pixels = ccrs.PlateCarree().transform_points(projection, px.reshape(-1), py.reshape(-1))
+        on_globe = np.isfinite(pixels[:, 0]) & np.isfinite(pixels[:, 1])
+
+        tree = cKDTree(lonlat_to_xyz(lons, lats))
+        _, index = tree.query(lonlat_to_xyz(pixels[on_globe, 0], pixels[on_globe, 1]))
+
+        lookup = np.full(on_globe.shape, -1, dtype=np.int64)
+        lookup[on_globe] = index
+        _pixel_lookups[key] = (lookup.reshape(shape), (x0, x1, y0, y1))
+
+    return _pixel_lookups[key]
+
+def raster_plot(ax, lons, lats, values, shape=(1000, 1000), **kwargs):
+    """Draw an unstructured field as an image, using the nearest node to each pixel
+
+    Args:
+        ax (GeoAxes): with projection=_projection
+        lons, lats, values (array_like): node locations and data, same number of elements
+        shape (tuple): (n_y, n_x) pixels in the image
+        **kwargs: passed to imshow, e.g. cmap, vmin, vmax, norm
+
+    Returns:
+        p (AxesImage): for the colorbar
+    """
+    lookup, extent = get_pixel_lookup(lons, lats, shape=shape, projection=ax.projection)
+    values = np.asarray(values).reshape(-1)
+    image = np.ma.masked_array(values[lookup], mask=lookup < 0)
+    return ax.imshow(
+        image,
+        origin="lower",
+        extent=extent,
+        transform=ax.projection,
+        interpolation="nearest",
+        **kwargs,
+    )
+
+def nested_raster(ax, xds, varname, shape=(1000, 1000), **kwargs):
+    """Same as nested_scatter, but rasterized with raster_plot, which is much faster for movies"""
+    p = raster_plot(
+        ax,
+        xds.longitudes.values,
+        xds.latitudes.values,
+        xds[varname].values,
+        shape=shape,
+        **kwargs,
+    )
+    plot_conus_box(ax)
+    return [p]
+
 def plot_single_timestamp(xds, fig, time, *args, **kwargs):
 
     axs = []
@@ -124,6 +234,8 @@ def plot_single_timestamp(xds, fig, time, *args, **kwargs):
     t0 = kwargs.pop("t0", "")
     truth_x = kwargs.pop("truth_x", None)
     truth_y = kwargs.pop("truth_y", None)
+    renderer = kwargs.pop("renderer", "scatter")
+    raster_shape = kwargs.pop("raster_shape", (1000, 1000))
 
 
     # Create axes
@@ -133,14 +245,25 @@ def plot_single_timestamp(xds, fig, time, *args, **kwargs):
     # Note that this scatter is very slow for movies
     # But... it is the truest comparison to the other plot
     # We could move to datashader eventually
-    p = ax.scatter(
-        truth_x,
-        truth_y,
-        c=xds[truthname].isel(time=time),
-        s=.5,
-        transform=ccrs.PlateCarree(),
-        **kwargs,
-    )
+    # ... or use renderer="raster", which uses the nearest grid point to each pixel
+    if renderer == "raster":
+        p = raster_plot(
+            ax,
+            truth_x,
+            truth_y,
+            xds[truthname].isel(time=time).values,
+            shape=raster_shape,
+            **kwargs,
+        )
+    else:
+        p = ax.scatter(
+            truth_x,
+            truth_y,
+            c=xds[truthname].isel(time=time),
+            s=.5,
+            transform=ccrs.PlateCarree(),
+            **kwargs,
+        )
     # pcolormesh option
     #p = xds[truthname].isel(time=time).plot(
     #    ax=ax,
@@ -154,7 +277,10 @@ def plot_single_timestamp(xds, fig, time, *args, **kwargs):
     # Plot model
     ax = fig.add_subplot(1, 2, 2, projection=_projection)
 
-    pp = nested_scatter(ax, xds.isel(time=time), "Prediction: Nested-ERA5", **kwargs)
+    if renderer == "raster":
+        pp = nested_raster(ax, xds.isel(time=time), "Prediction: Nested-ERA5", shape=raster_shape, **kwargs)
+    else:
+        pp = nested_scatter(ax, xds.isel(time=time), "Prediction: Nested-ERA5", **kwargs)
     ax.set(title="Prediction: Nested-ERA5")
     axs.append(ax)
 
@@ -180,6 +306,103 @@ def plot_single_timestamp(xds, fig, time, *args, **kwargs):
 
     return None, None
 
+def build_pixel_lookups(datasets, options):
+    """Build the raster lookups that every frame of these movies will use, e.g. before starting a pool
+
+    Args:
+        datasets, options (dict): as passed to render_movies
+
+    Returns:
+        lookups (dict): a copy of all cached lookups, to hand to the workers
+    """
+    for varname, xds in datasets.items():
+        if options[varname].get("renderer", "scatter") != "raster":
+            continue
+        shape = options[varname].get("raster_shape", (1000, 1000))
+        get_pixel_lookup(options[varname]["truth_x"], options[varname]["truth_y"], shape=shape)
+        get_pixel_lookup(xds.longitudes.values, xds.latitudes.values, shape=shape)
+    return dict(_pixel_lookups)
+
+def _init_movie_worker(datasets, options, width, height, dpi, lookups=None):
+    # lookups from the parent, so no worker has to build its own
+    _pixel_lookups.update(lookups or {})
+    _worker_state["datasets"] = datasets
+    _worker_state["options"] = options
+    _worker_state["dpi"] = dpi
+    # one figure per worker, which gets cleared and reused for every frame
+    _worker_state["fig"] = plt.figure(figsize=(width, height))
+
+def _render_frame(task):
+    varname, itime = task
+    fig = _worker_state["fig"]
+    fig.clf()
+    plot_single_timestamp(
+        xds=_worker_state["datasets"][varname],
+        fig=fig,
+        time=itime,
+        **_worker_state["options"][varname],
+    )
+    buffer = io.BytesIO()
+    # no bbox_inches="tight", every frame needs the same size
+    fig.savefig(buffer, format="png", dpi=_worker_state["dpi"])
+    return varname, buffer.getvalue()
+
+def render_movies(datasets, options, fnames, n_workers, width, height, dpi, framerate=10):
+    """Render movies for many variables at once, with frames spread across a process pool
+
+    Each worker holds its own figure and renders single frames as png.
+    Frames come back in order and are piped straight to one ffmpeg process per movie,
+    so encoding happens while the rest of the frames are still being rendered.
+    All frames from all variables go through the same pool, so workers don't sit idle
+    at the end of each movie.
+    With renderer="raster", the pixel lookups are built once here, before the pool starts,
+    rather than once in every worker.
+
+    Args:
+        datasets (dict): varname -> xr.Dataset, as passed to plot_single_timestamp
+        options (dict): varname -> dict with kwargs for plot_single_timestamp
+        fnames (dict): varname -> path to the mp4 file to create
+        n_workers (int): number of processes to render with
+        width, height (float): figure size in inches
+        dpi (int): dots per inch
+        framerate (int): frames per second in the movie
+    """
+
+    n_frames = {varname: len(xds["time"]) for varname, xds in datasets.items()}
+    encoders = {}
+    for varname, fname in fnames.items():
+        encoders[varname] = subprocess.Popen(
+            [
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "image2pipe", "-framerate", str(framerate), "-i", "-",
+                "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+                "-c:v", "libx264", "-pix_fmt", "yuv420p",
+                fname,
+            ],
+            stdin=subprocess.PIPE,
+        )
+
+    lookups = build_pixel_lookups(datasets, options)
+    tasks = [(varname, itime) for varname in datasets for itime in range(n_frames[varname])]
+    written = {varname: 0 for varname in datasets}
+    context = multiprocessing.get_context("fork")
+    with context.Pool(
+        n_workers,
+        initializer=_init_movie_worker,
+        initargs=(datasets, options, width, height, dpi, lookups),
+    ) as pool:
+        for varname, png in pool.imap(_render_frame, tasks):
+            encoders[varname].stdin.write(png)
+            written[varname] += 1
+            if written[varname] == n_frames[varname]:
+                encoders[varname].stdin.close()
+                logging.info(f"Rendered all {n_frames[varname]} frames for {varname}")
+
+    for varname, encoder in encoders.items():
+        if encoder.wait() != 0:
+            raise RuntimeError(f"render_movies: ffmpeg failed for {fnames[varname]}")
+        logging.info(f"Stored movie at: {fnames[varname]}\n")
+
 def calc_wind_speed(xds):
     if "ugrd10m" in xds:
         ws = np.sqrt(xds["ugrd10m"]**2 + xds["vgrd10m"]**2)
@@ -205,6 +428,86 @@ def get_truth(name):
     truth.attrs["name"] = name
     return truth
 
+def _find_cached_truth(name, variables, times, levels, cache_dir):
+    """Look for any cached store for this truth dataset that contains everything requested"""
+    for path in sorted(glob.glob(f"{cache_dir}/{name.lower()}.*.zarr")):
+        cached = xr.open_zarr(path)
+        if not all(v in cached for v in variables):
+            continue
+        if not np.all(np.isin(times.values, cached["time"].values)):
+            continue
+        if levels is None and cached.attrs.get("cached_levels", None) != "all":
+            continue
+        if levels is not None and "level" in cached.dims and not np.all(np.isin(levels, cached["level"].values)):
+            continue
+        return cached
+    return None
+
+def get_cached_truth(name, variables, time, levels=None, cache_dir="truth-cache"):
+    """Get a subset of the truth dataset from a local zarr cache, only reading remotely if needed
+
+    The first call for a given set of variables, levels, and times pulls just those
+    from the remote store and writes them to a small local zarr.
+    Later calls, from any script, read that instead.
+    If any store in cache_dir already has everything requested, it's used,
+    so this also works offline with a pre-seeded cache_dir.
+
+    Args:
+        name (str): "ERA5" or "Replay", see get_truth
+        variables (list): variable names to get
+        time (array_like): times to get
+        levels (list, optional): vertical levels to get, default is all of them
+        cache_dir (str): where local zarr stores are kept
+
+    Returns:
+        truth (xr.Dataset): subset of the truth dataset, lazily read from the local store
+    """
+    times = pd.DatetimeIndex(np.atleast_1d(time))
+    levels = None if levels is None else list(levels)
+
+    key = json.dumps(
+        {
+            "variables": sorted(variables),
+            "levels": levels,
+            "time": [str(t) for t in times],
+        },
+    )
+    key = hashlib.sha1(key.encode()).hexdigest()[:12]
+    path = f"{cache_dir}/{name.lower()}.{times[0]:%Y-%m-%dT%H}.{times[-1]:%Y-%m-%dT%H}.{key}.zarr"
+
+    if os.path.isdir(cache_dir):
+        truth = _find_cached_truth(name, variables, times, levels, cache_dir)
+        if truth is not None:
+            logging.info(f"Reading {name} from local cache in {cache_dir}")
+            truth = truth[variables].sel(time=times)
+            if levels is not None and "level" in truth.dims:
+                truth = truth.sel(level=levels)
+            truth.attrs["name"] = name
+            return truth
+
+    logging.info(f"Caching {name} subset at {path}")
+    truth = get_truth(name)
+    truth = truth[variables].sel(time=times)
+    if levels is not None and "level" in truth.dims:
+        truth = truth.sel(level=levels)
+    truth.attrs["cached_levels"] = "all" if levels is None else levels
+
+    for varname in truth.variables:
+        truth[varname].encoding = {}
+    truth = truth.chunk({"time": 1})
+
+    # write somewhere _find_cached_truth won't look, and only move it into place once it's complete,
+    # so an interrupted write never looks like a cache hit
+    tmp = f"{path}.{os.getpid()}.tmp"
+    truth.to_zarr(tmp, mode="w")
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+    truth = xr.open_zarr(path)
+    truth.attrs["name"] = name
+    return truth
+
 
 def main(
     read_path,
@@ -213,6 +516,9 @@ def main(
     tf,
     ifreq=1,
     mode="figure", # or movie
+    renderer="scatter", # or raster, which is much faster for movies
+    n_workers=1,
+    truth_cache_dir="truth-cache",
 ):
     """A note about t0
     In the inference yaml, I think this means "the very first initial condition"... makes sense
@@ -220,11 +526,15 @@ def main(
     But when I'm visualizing the data, I think about t0 as the last initial condition...
     as in the last data given to the model before making a forecast.
     So... the t0 given here is that one... the last IC.
+
+    With mode="movie" and n_workers > 1, frames for all variables are rendered
+    across a process pool with render_movies, rather than one at a time with xmovie.
     """
 
     setup_simple_log()
 
     assert mode in ["figure", "movie"]
+    assert renderer in ["scatter", "raster"]
 
 
     logging.info(f"Time Bounds:\n\tt0 = {t0}\n\ttf = {tf}\n")
@@ -238,7 +548,18 @@ def main(
 
     for tname in ["ERA5"]:
 
-        truth = get_truth(tname)
+        truth = get_cached_truth(
+            tname,
+            variables=[
+                "total_precipitation_6hr",
+                "2m_temperature",
+                "10m_u_component_of_wind",
+                "10m_v_component_of_wind",
+                "total_column_water",
+            ],
+            time=psl["time"].values,
+            cache_dir=truth_cache_dir,
+        )
         truth_x, truth_y = np.meshgrid(truth.longitude, truth.latitude)
         logging.info(f"Retrieved truth = {tname}\n{truth}\n")
         fig_dir = os.path.join(store_dir, f"{mode}s", f"{truth.name.lower()}-vs-nested")
@@ -271,6 +592,10 @@ def main(
 
         }
 
+        # for parallel movies, which are all rendered together at the end
+        movie_datasets = {}
+        movie_options = {}
+        movie_fnames = {}
 
         for varname, options in plot_options.items():
 
@@ -330,6 +655,10 @@ def main(
             pixelwidth = width*dpi
             pixelheight = height*dpi
 
+            # two panels side by side, so each image only needs about half the width
+            options["renderer"] = renderer
+            options["raster_shape"] = (int(pixelwidth//2), int(pixelwidth//2))
+
             if mode == "figure":
 
                 fig = plt.figure(figsize=(width, height))
@@ -344,6 +673,11 @@ def main(
                 fig.savefig(fname, dpi=dpi, bbox_inches="tight")
                 logging.info(f"Stored figure at: {fname}\n")
 
+            elif n_workers > 1:
+                movie_datasets[varname] = ds
+                movie_options[varname] = options
+                movie_fnames[varname] = f"{fig_dir}/{varname}.{t0}.{tf}.mp4"
+
             else:
                 mov = xmovie.Movie(
                     ds,
@@ -358,3 +692,14 @@ def main(
                 fname = f"{fig_dir}/{varname}.{t0}.{tf}.mp4"
                 mov.save(fname, progress=True, overwrite_existing=True)
                 logging.info(f"Stored movie at: {fname}\n")
+
+        if len(movie_datasets) > 0:
+            render_movies(
+                datasets=movie_datasets,
+                options=movie_options,
+                fnames=movie_fnames,
+                n_workers=n_workers,
+                width=width,
+                height=height,
+                dpi=dpi,
+            )
@@ -0,0 +1,308 @@
+"""
+Columnar store of decoded PREPBUFR observations.
+
+The wxvx ``obs`` and ``ncobs`` tasks (see g004/ and g104/) pull each
+gdas.{yyyymmdd}.t{hh}z.prepbufr.nr file and decode it with pb2nc into a MET point
+observation netcdf, for the obs within each grid subset:
+
+    {workdir}/obs/{yyyymmdd}/{hh}/gdas.{yyyymmdd}.t{hh}z.prepbufr.nc
+
+This ingests those files once, into a Parquet dataset partitioned by grid subset, day,
+and message type (ADPUPA, ADPSFC, AIRCFT, ...):
+
+    {store}/subset=g004/date=20230201/message_type=ADPUPA/g004.20230201T06-0.parquet
+
+with one row per observation and the columns in ``schema`` below.
+Longitudes are stored in [0, 360), to match the forecasts.
+Then read_obs can filter by time, variable, QC, and bounding box, and only the
+partitions and row groups that are needed get read.
+
+Usage:
+    python prepbufr_store.py /pscratch/sd/t/timothys/nested-eagle/observations/prepbufr.parquet g004/config.wxvx.yaml g104/config.wxvx.yaml -n 16
+
+and then, e.g. in a notebook
+
+    from prepbufr_store import read_obs
+    df = read_obs(
+        store,
+        start="2023-02-01T05:30",
+        end="2023-02-01T06:30",
+        variables=["TMP", "UGRD", "VGRD"],
+        max_qc=2,
+        bbox=[225, 300, 20, 55],
+        subset="g104",
+    )
+"""
+import os
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import yaml
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pyarrow as pa
+import pyarrow.dataset as pds
+
+
+schema = pa.schema([
+    ("valid_time", pa.timestamp("ns")),
+    ("cycle", pa.timestamp("ns")),
+    ("station_id", pa.string()),
+    ("report_type", pa.int32()),
+    ("latitude", pa.float32()),
+    ("longitude", pa.float32()),
+    ("elevation", pa.float32()),
+    ("variable", pa.string()),
+    ("level", pa.float32()),
+    ("height", pa.float32()),
+    ("value", pa.float32()),
+    ("qc", pa.float32()),
+])
+
+partitioning = pds.partitioning(
+    pa.schema([
+        ("subset", pa.string()),
+        ("date", pa.string()),
+        ("message_type", pa.string()),
+    ]),
+    flavor="hive",
+)
+
+# partitions are keyed by cycle date, and each cycle holds the obs valid within +/- 3 hours of it,
+# e.g. the 00Z cycle on 2023-02-02 has obs from 21Z on 2023-02-01
+cycle_half_window = pd.Timedelta(hours=3)
+
+
+def _decode_strings(xda):
+    """MET stores string tables as char arrays, which xarray may or may not have joined already"""
+    values = xda.values
+    if values.ndim > 1:
+        values = values.reshape(len(values), -1).astype("S1")
+        values = np.array([b"".join(row) for row in values])
+    return np.char.strip(np.char.decode(values.astype("S"), "ascii", errors="ignore"))
+
+
+def _qc_to_float(qty):
+    """QC flags are strings like '2', missing ones are e.g. 'NA', which become NaN"""
+    return pd.to_numeric(pd.Series(qty), errors="coerce").to_numpy(np.float32)
+
+
+def read_met_point_obs(path, cycle):
+    """Read a pb2nc (MET point observation) netcdf into a flat table, one row per observation
+
+    Returns:
+        df (pd.DataFrame): with the columns in schema, plus message_type
+    """
+    xds = xr.open_dataset(path, decode_cf=False, mask_and_scale=False)
+
+    hid = xds["obs_hid"].values.astype(np.int64)
+    vid = xds["obs_vid"].values.astype(np.int64)
+
+    var_table = _decode_strings(xds["obs_var"])
+    qty_table = _qc_to_float(_decode_strings(xds["obs_qty_table"]))
+    typ_table = _decode_strings(xds["hdr_typ_table"])
+    sid_table = _decode_strings(xds["hdr_sid_table"])
+    vld_table = pd.to_datetime(_decode_strings(xds["hdr_vld_table"]), format="%Y%m%d_%H%M%S")
+
+    if "hdr_prpt_typ" in xds:
+        report_type = xds["hdr_prpt_typ"].values.astype(np.int32)
+    else:
+        report_type = np.full(xds.sizes["nhdr"], -1, dtype=np.int32)
+
+    df = pd.DataFrame({
+        "valid_time": vld_table[xds["hdr_vld"].values.astype(np.int64)][hid],
+        "cycle": pd.Timestamp(cycle),
+        "station_id": sid_table[xds["hdr_sid"].values.astype(np.int64)][hid],
+        "report_type": report_type[hid],
+        "latitude": xds["hdr_lat"].values[hid].astype(np.float32),
+        "longitude": (xds["hdr_lon"].values[hid] % 360).astype(np.float32),
+        "elevation": xds["hdr_elv"].values[hid].astype(np.float32),
+        "variable": var_table[vid],
+        "level": xds["obs_lvl"].values.astype(np.float32),
+        "height": xds["obs_hgt"].values.astype(np.float32),
+        "value": xds["obs_val"].values.astype(np.float32),
+        "qc": qty_table[xds["obs_qty"].values.astype(np.int64)],
+        "message_type": typ_table[xds["hdr_typ"].values.astype(np.int64)][hid],
+    })
+    xds.close()
+    return df
+
+
+def ingest_cycle(path, cycle, subset, store):
+    """Decode one pb2nc file and write it to the store, overwriting anything from a previous run"""
+    df = read_met_point_obs(path, cycle)
+    df["subset"] = subset
+    df["date"] = cycle.strftime("%Y%m%d")
+
+    table = pa.Table.from_pandas(
+        df,
+        schema=schema.append(pa.field("message_type", pa.string()))
+            .append(pa.field("subset", pa.string()))
+            .append(pa.field("date", pa.string())),
+        preserve_index=False,
+    )
+    pds.write_dataset(
+        table,
+        store,
+        format="parquet",
+        partitioning=partitioning,
+        basename_template=f"{subset}.{cycle:%Y%m%dT%H}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    return len(df)
+
+
+def _ledger_path(store, subset, cycle):
+    return f"{store}/_ingested/{subset}.{cycle:%Y%m%dT%H}"
+
+
+def get_cycles(wxvx_config):
+    """Cycles and pb2nc file paths from a wxvx config, e.g. g004/config.wxvx.yaml
+
+    Returns:
+        subset (str): e.g. "g004", the name of the wxvx workdir
+        cycles (list of (datetime, str)): each cycle and the path to its pb2nc file
+    """
+    with open(wxvx_config, "r") as f:
+        config = yaml.safe_load(f)
+
+    workdir = config["meta"]["workdir"]
+    obs_dir = config["paths"]["obs"].replace("{{ meta.workdir }}", workdir)
+    subset = os.path.basename(os.path.normpath(workdir))
+
+    start = config["cycles"]["start"]
+    stop = config["cycles"]["stop"]
+    if not isinstance(start, datetime):
+        start = datetime.fromisoformat(start)
+        stop = datetime.fromisoformat(stop)
+
+    cycles = []
+    cycle = start
+    while cycle <= stop:
+        yyyymmdd = cycle.strftime("%Y%m%d")
+        hh = cycle.strftime("%H")
+        cycles.append((cycle, f"{obs_dir}/{yyyymmdd}/{hh}/gdas.{yyyymmdd}.t{hh}z.prepbufr.nc"))
+        cycle += timedelta(hours=config["cycles"]["step"])
+    return subset, cycles
+
+
+def ingest(store, wxvx_configs, n_workers=1, overwrite=False):
+    """Ingest every cycle from these wxvx configs that isn't already in the store
+
+    A cycle is only marked as done in {store}/_ingested after it's been written,
+    so an interrupted ingest can be rerun and will pick up where it left off.
+    """
+    os.makedirs(f"{store}/_ingested", exist_ok=True)
+
+    todo = []
+    for wxvx_config in wxvx_configs:
+        subset, cycles = get_cycles(wxvx_config)
+        for cycle, path in cycles:
+            if not overwrite and os.path.isfile(_ledger_path(store, subset, cycle)):
+                continue
+            if not os.path.isfile(path):
+                print(f"Missing {path}, skipping")
+                continue
+            todo.append((path, cycle, subset))
+
+    print(f"Ingesting {len(todo)} cycles into {store}")
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(ingest_cycle, path, cycle, subset, store): (cycle, subset)
+            for path, cycle, subset in todo
+        }
+        for future in as_completed(futures):
+            cycle, subset = futures[future]
+            n_obs = future.result()
+            with open(_ledger_path(store, subset, cycle), "w") as f:
+                f.write(f"{n_obs}\n")
+            print(f" ... {subset} {cycle:%Y-%m-%dT%H}: {n_obs} obs")
+
+
+def open_obs_dataset(store):
+    """The store as a lazy pyarrow dataset"""
+    return pds.dataset(store, format="parquet", partitioning=partitioning, exclude_invalid_files=True, ignore_prefixes=["_", "."])
+
+
+def read_obs(
+    store,
+    start=None,
+    end=None,
+    variables=None,
+    max_qc=None,
+    bbox=None,
+    subset=None,
+    message_types=None,
+    columns=None,
+):
+    """Read observations from the store, with filters that are pushed down to the parquet reader
+
+    Args:
+        store (str): path to the store
+        start, end (str or pd.Timestamp, optional): valid time window, start <= valid_time < end
+        variables (list, optional): MET/GRIB names, e.g. ["TMP", "UGRD", "VGRD", "SPFH", "PRES"]
+        max_qc (int, optional): keep obs with qc <= max_qc, or with a missing qc flag,
+            same as max_qc_value in the obs-metrics configs
+        bbox (list, optional): [lon_min, lon_max, lat_min, lat_max] with longitude in [0, 360),
+            if lon_min > lon_max the box wraps across 0
+        subset (str, optional): e.g. "g004" or "g104"
+        message_types (list, optional): e.g. ["ADPUPA", "ADPSFC"]
+        columns (list, optional): only read these columns
+
+    Returns:
+        df (pd.DataFrame)
+    """
+    field = pds.field
+    filters = []
+
+    if subset is not None:
+        filters.append(field("subset") == subset)
+
+    if message_types is not None:
+        filters.append(field("message_type").isin(list(message_types)))
+
+    if start is not None:
+        start = pd.Timestamp(start)
+        filters.append(field("date") >= (start - cycle_half_window).strftime("%Y%m%d"))
+        filters.append(field("valid_time") >= pa.scalar(start.to_pydatetime(), type=pa.timestamp("ns")))
+
+    if end is not None:
+        end = pd.Timestamp(end)
+        filters.append(field("date") <= (end + cycle_half_window).strftime("%Y%m%d"))
+        filters.append(field("valid_time") < pa.scalar(end.to_pydatetime(), type=pa.timestamp("ns")))
+
+    if variables is not None:
+        filters.append(field("variable").isin(list(variables)))
+
+    if max_qc is not None:
+        filters.append((field("qc") <= max_qc) | field("qc").is_null(nan_is_null=True))
+
+    if bbox is not None:
+        lon_min, lon_max, lat_min, lat_max = bbox
+        filters.append((field("latitude") >= lat_min) & (field("latitude") <= lat_max))
+        if lon_min <= lon_max:
+            filters.append((field("longitude") >= lon_min) & (field("longitude") <= lon_max))
+        else:
+            filters.append((field("longitude") >= lon_min) | (field("longitude") <= lon_max))
+
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+
+    dataset = open_obs_dataset(store)
+    table = dataset.to_table(columns=columns, filter=expression)
+    return table.to_pandas()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Ingest pb2nc PREPBUFR netcdf files from wxvx into a Parquet store")
+    parser.add_argument("store", help="path to the parquet store")
+    parser.add_argument("wxvx_configs", nargs="+", help="wxvx configs with the cycles and obs paths, e.g. g004/config.wxvx.yaml")
+    parser.add_argument("-n", "--n-workers", type=int, default=1)
+    parser.add_argument("--overwrite", action="store_true", help="re-ingest cycles that are already in the store")
+    args = parser.parse_args()
+
+    ingest(args.store, args.wxvx_configs, n_workers=args.n_workers, overwrite=args.overwrite)
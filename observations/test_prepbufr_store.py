@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import prepbufr_store
+
+
+def fake_cycle(path, cycle):
+    """One TMP observation every 30 minutes within +/- 3 hours of the cycle"""
+    valid_time = pd.date_range(cycle - pd.Timedelta(hours=3), cycle + pd.Timedelta(hours=3), freq="30min")
+    n_obs = len(valid_time)
+    return pd.DataFrame({
+        "valid_time": valid_time,
+        "cycle": pd.Timestamp(cycle),
+        "station_id": [f"{i:05d}" for i in range(n_obs)],
+        "report_type": np.full(n_obs, 181, dtype=np.int32),
+        "latitude": np.full(n_obs, 40.0, dtype=np.float32),
+        "longitude": np.full(n_obs, 255.0, dtype=np.float32),
+        "elevation": np.zeros(n_obs, dtype=np.float32),
+        "variable": "TMP",
+        "level": np.full(n_obs, 1000.0, dtype=np.float32),
+        "height": np.full(n_obs, 2.0, dtype=np.float32),
+        "value": np.full(n_obs, 280.0, dtype=np.float32),
+        "qc": np.full(n_obs, 1.0, dtype=np.float32),
+        "message_type": "ADPSFC",
+    })
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(prepbufr_store, "read_met_point_obs", fake_cycle)
+    for cycle in pd.date_range("2023-02-01T00", "2023-02-02T18", freq="6h"):
+        prepbufr_store.ingest_cycle(None, cycle, "g004", str(tmp_path))
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize(
+    "start, end",
+    [
+        ("2023-02-01T21:00", "2023-02-02T03:00"),
+        ("2023-02-01T20:30", "2023-02-01T23:30"),
+        ("2023-02-01T22:00", "2023-02-02T00:00"),
+    ],
+)
+def test_read_obs_across_midnight(store, start, end):
+    df = prepbufr_store.read_obs(store, start=start, end=end, subset="g004")
+
+    # every cycle has one obs per 30 minutes, and neighboring cycles overlap at the +/- 3 hour edges
+    expected = pd.concat([
+        fake_cycle(None, cycle)
+        for cycle in pd.date_range("2023-02-01T00", "2023-02-02T18", freq="6h")
+    ])
+    expected = expected[(expected["valid_time"] >= start) & (expected["valid_time"] < end)]
+
+    assert len(df) == len(expected) > 0
+    pd.testing.assert_frame_equal(
+        df[["cycle", "valid_time"]].sort_values(["cycle", "valid_time"]).reset_index(drop=True),
+        expected[["cycle", "valid_time"]].sort_values(["cycle", "valid_time"]).reset_index(drop=True),
+        check_dtype=False,
+    )